@@ -3,16 +3,4328 @@
 Audion - A simple music player
 """
 
+import time
+
+# Measured from here, before the slower imports, for the startup budget
+STARTUP_STARTED = time.perf_counter()
+
 import tkinter as tk
-from tkinter import filedialog, ttk
-import pygame
+from tkinter import filedialog, messagebox, simpledialog, ttk, font as tkfont
 import os
 import random
 import json
-from mutagen import File as MutagenFile
+import sqlite3
+import threading
+import queue
+import io
+import sys
+import socket
+import select
+import selectors
+import signal
+import struct
+import argparse
+import atexit
+import bisect
+import errno
+import functools
+import re
+import math
+import operator
+import mmap
+import hashlib
+import multiprocessing
+from array import array
+from collections import OrderedDict
+from itertools import compress, count, islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import unquote, urlsplit
+
+# Audio formats the player can load, and playlist files it can import and export
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.ogg', '.flac')
+PLAYLIST_EXTENSIONS = ('.m3u', '.m3u8', '.pls')
+
+# pygame is imported on first use (see import_pygame), since importing it
+# initializes SDL and makes up a large part of startup time
+pygame = None
+
+# Seconds from launch until the empty window is painted, until its controls
+# are built, and until the player is ready
+STARTUP_BUDGETS = {'window': 0.5, 'ui': 1.0, 'ready': 1.5}
+
+# How many upcoming tracks to read ahead, and how much memory they may use
+PREFETCH_TRACKS = 3
+PREFETCH_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# Control socket used by headless mode, and the one an open window takes files
+# from later launches on, with how long either side waits for the other in seconds
+DEFAULT_SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or os.path.expanduser("~"), ".audion.sock")
+INSTANCE_SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or os.path.expanduser("~"), ".audion-window.sock")
+INSTANCE_TIMEOUT = 2
+
+# Settings and playlist changes are written once nothing has changed for
+# this many seconds, and at most this long after the first pending change
+PERSIST_DELAY = 0.5
+PERSIST_MAX_DELAY = 5
+
+# Progress refresh intervals in milliseconds
+PROGRESS_INTERVAL_VISIBLE = 250
+PROGRESS_INTERVAL_MINIMIZED = 1000
+
+# How often the window checks for files handed over by later launches, in milliseconds
+INSTANCE_POLL_INTERVAL = 500
+
+# How often watched folders are checked where inotify isn't available, in seconds,
+# and how often the UI applies the changes found, in milliseconds
+WATCH_POLL_INTERVAL = 5
+WATCH_APPLY_INTERVAL = 1000
+
+# Words the playlist search index splits names and tags into, how many tracks
+# are indexed at a time in the background, and how often the UI merges them in milliseconds
+SEARCH_WORD_PATTERN = re.compile(r'\w+')
+SEARCH_INDEX_BATCH_SIZE = 2000
+SEARCH_INDEX_POLL_INTERVAL = 50
+
+# Keys of the numbered entries in a PLS playlist
+PLS_KEY_PATTERN = re.compile(r'(File|Title|Length)(\d+)', re.IGNORECASE)
+
+# Layer III bitrates in kbit/s for MPEG-1 and MPEG-2/2.5, and sample rates by version bits
+MP3_BITRATES = {
+    True: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    False: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+# Seek points further than this before the target fall back to the decoder's own seek
+SEEK_INDEX_MAX_GAP = 2.0
+
+# Bytes of audio hashed from the start, middle and end of a file for its fingerprint,
+# and how many files are sent to the fingerprinting processes at a time
+FINGERPRINT_SAMPLE_SIZE = 64 * 1024
+FINGERPRINT_BATCH_SIZE = 64
+
+# How many files a search for moved tracks may look at before giving up
+RELINK_MAX_FILES = 20000
+
+# Memory the buffered mixer may use to decode the next track before it starts
+DECODE_AHEAD_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# Loudness in LUFS that ReplayGain 2.0 track gains bring tracks to, and the
+# BS.1770 gates: blocks quieter than the absolute gate, or this far below the
+# average of the louder blocks, don't count towards a track's loudness
+REPLAYGAIN_REFERENCE_LOUDNESS = -18.0
+LOUDNESS_ABSOLUTE_GATE = -70.0
+LOUDNESS_RELATIVE_GATE = -10.0
+
+# Tracks sent to the loudness workers at a time; each is decoded in full
+LOUDNESS_BATCH_SIZE = 4
+
+# Waveforms are stored as this many peak and RMS levels per track, one byte
+# each, after a header of the magic number, the level count and the duration
+WAVEFORM_BUCKETS = 2048
+PEAKS_HEADER = struct.Struct('<8sIf')
+PEAKS_MAGIC = b'AUDPEAK1'
+
+
+def import_pygame():
+    """Import pygame if it hasn't been yet, and return it"""
+    global pygame
+    if pygame is None:
+        import pygame as pygame_module
+        pygame = pygame_module
+    return pygame
+
+
+def parse_mp3_frame_header(header):
+    """Decode a 4-byte MPEG Layer III frame header, or return None if it isn't one"""
+    if len(header) < 4:
+        return None
+    bits = int.from_bytes(header[:4], 'big')
+    if bits >> 21 != 0x7FF:
+        return None
+    version = (bits >> 19) & 3
+    layer = (bits >> 17) & 3
+    bitrate_index = (bits >> 12) & 0xF
+    rate_index = (bits >> 10) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = MP3_BITRATES[mpeg1][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    return {
+        'mpeg1': mpeg1,
+        'mono': (bits >> 6) & 3 == 3,
+        'bitrate': bitrate,
+        'length': (144 if mpeg1 else 72) * bitrate // sample_rate + ((bits >> 9) & 1),
+    }
+
+
+def find_mp3_frame(data, start=0):
+    """Offset of the first frame header in data that is followed by another one"""
+    for offset in range(start, len(data) - 3):
+        if data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+            continue
+        frame = parse_mp3_frame_header(data[offset:offset + 4])
+        if frame is None:
+            continue
+        following = offset + frame['length']
+        if following + 4 > len(data) or parse_mp3_frame_header(data[following:following + 4]):
+            return offset, frame
+    return None, None
+
+
+def build_mp3_seek_index(f):
+    """Seek index from the Xing/Info header's TOC, or a constant bitrate if there is none"""
+    header = f.read(10)
+    start = 0
+    if header[:3] == b'ID3' and len(header) == 10:
+        # ID3v2 sizes are "syncsafe": 7 bits per byte
+        size = 0
+        for byte in header[6:10]:
+            size = (size << 7) | (byte & 0x7F)
+        start = 10 + size + (10 if header[5] & 0x10 else 0)
+
+    f.seek(start)
+    data = f.read(64 * 1024)
+    offset, frame = find_mp3_frame(data)
+    if frame is None:
+        return {}
+    frame_start = start + offset
+    f.seek(0, io.SEEK_END)
+    file_size = f.tell()
+
+    # The Xing/Info header sits in the first frame, right after the side information
+    if frame['mpeg1']:
+        xing = offset + 4 + (17 if frame['mono'] else 32)
+    else:
+        xing = offset + 4 + (9 if frame['mono'] else 17)
+    tag = data[xing:xing + 4]
+    if tag not in (b'Xing', b'Info'):
+        # No header: treat the file as constant bitrate
+        return {'format': 'mp3', 'audio_start': frame_start, 'bitrate': frame['bitrate']}
+
+    flags = int.from_bytes(data[xing + 4:xing + 8], 'big')
+    position = xing + 8
+    if flags & 1:
+        position += 4
+    audio_size = file_size - frame_start
+    if flags & 2:
+        audio_size = int.from_bytes(data[position:position + 4], 'big') or audio_size
+        position += 4
+    index = {'format': 'mp3', 'audio_start': frame_start + frame['length'], 'frame_start': frame_start}
+    if flags & 4 and len(data) >= position + 100:
+        index['audio_size'] = audio_size
+        index['toc'] = list(data[position:position + 100])
+    elif tag == b'Info':
+        # LAME writes "Info" for constant bitrate files
+        index['bitrate'] = frame['bitrate']
+    else:
+        return {}
+    return index
+
+
+def build_flac_seek_index(f):
+    """Seek index from the FLAC SEEKTABLE block"""
+    if f.read(4) != b'fLaC':
+        return {}
+    position = 4
+    streaminfo = None
+    points = []
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            return {}
+        block_type = header[0] & 0x7F
+        length = int.from_bytes(header[1:4], 'big')
+        if block_type in (0, 3):
+            body = f.read(length)
+        else:
+            f.seek(length, io.SEEK_CUR)
+        if block_type == 0:
+            streaminfo = body
+        elif block_type == 3:
+            for point in range(0, len(body) - 17, 18):
+                sample = int.from_bytes(body[point:point + 8], 'big')
+                # All-ones sample numbers mark placeholder points
+                if sample != 0xFFFFFFFFFFFFFFFF:
+                    points.append([sample, int.from_bytes(body[point + 8:point + 16], 'big')])
+        position += 4 + length
+        if header[0] & 0x80:
+            break
+
+    if streaminfo is None or len(streaminfo) < 18 or not points:
+        return {}
+    return {
+        'format': 'flac',
+        'audio_start': position,
+        'sample_rate': int.from_bytes(streaminfo[10:13], 'big') >> 4,
+        'streaminfo': streaminfo.hex(),
+        'points': sorted(points),
+    }
+
+
+def build_seek_index(file_path):
+    """Byte offsets for fast seeking in MP3 and FLAC files, or {} if none can be built"""
+    extension = os.path.splitext(file_path)[1].lower()
+    try:
+        with open(file_path, 'rb') as f:
+            if extension == '.mp3':
+                return build_mp3_seek_index(f)
+            if extension == '.flac':
+                return build_flac_seek_index(f)
+    except (OSError, ValueError) as e:
+        print(f"Could not build seek index: {e}")
+    return {}
+
+
+def find_audio_range(f, size):
+    """(start, end) byte offsets of the audio in a file, leaving out ID3 tags and FLAC metadata"""
+    start = 0
+    header = f.read(10)
+    if header[:3] == b'ID3' and len(header) == 10:
+        # Tag size is a 28-bit synchsafe integer, plus a 10 byte footer if flagged
+        start = 10 + ((header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9])
+        if header[5] & 0x10:
+            start += 10
+    elif header[:4] == b'fLaC':
+        start = 4
+        while True:
+            f.seek(start)
+            block = f.read(4)
+            if len(block) < 4:
+                break
+            start += 4 + int.from_bytes(block[1:4], 'big')
+            if block[0] & 0x80:
+                break
+
+    end = size
+    if size - start >= 128:
+        f.seek(size - 128)
+        if f.read(3) == b'TAG':
+            end = size - 128
+    return min(start, end), end
+
+
+def compute_fingerprint(file_path):
+    """Hash of the audio data, unchanged when the file is renamed, moved or retagged
+
+    Only three samples of the audio are read, so even large files hash quickly.
+    The audio length leads the fingerprint, so candidates can be ruled out by size.
+    """
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start, end = find_audio_range(f, size)
+        length = end - start
+        digest = hashlib.blake2b(digest_size=16)
+        if length <= 3 * FINGERPRINT_SAMPLE_SIZE:
+            offsets = (start,)
+            sample_size = length
+        else:
+            offsets = (start, start + (length - FINGERPRINT_SAMPLE_SIZE) // 2, end - FINGERPRINT_SAMPLE_SIZE)
+            sample_size = FINGERPRINT_SAMPLE_SIZE
+        for offset in offsets:
+            f.seek(offset)
+            digest.update(f.read(sample_size))
+    return f"{length:x}-{digest.hexdigest()}"
+
+
+def fingerprint_length(fingerprint):
+    """The audio length in bytes recorded in a fingerprint"""
+    return int(fingerprint.split('-', 1)[0], 16)
+
+
+def init_background_worker():
+    """Run a worker process at low priority, so it doesn't compete with playback and the UI"""
+    if hasattr(os, 'nice'):
+        try:
+            os.nice(10)
+        except OSError:
+            pass
+    # Workers only decode, so pygame never needs a sound card (or to greet us)
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+
+
+def analyze_track(file_path):
+    """Probe and fingerprint one file; runs in a worker process. Returns (path, entry or None)"""
+    try:
+        stat = os.stat(file_path)
+        entry = MetadataCache.probe(file_path)
+        entry['fingerprint'] = compute_fingerprint(file_path)
+    except OSError:
+        return file_path, None
+    entry['size'] = stat.st_size
+    entry['mtime'] = stat.st_mtime
+    return file_path, entry
+
+
+def parse_replaygain(tags):
+    """Track gain in dB from ReplayGain tags read by Mutagen, or None"""
+    values = tags.get('replaygain_track_gain') if tags is not None else None
+    if not values:
+        return None
+    try:
+        # Stored as text such as "-6.54 dB"
+        return float(str(values[0]).split()[0])
+    except (ValueError, IndexError):
+        return None
+
+
+def read_replaygain(file_path):
+    """Track gain in dB from the file's ReplayGain tags, or None"""
+    try:
+        from mutagen import File as MutagenFile
+        audio = MutagenFile(file_path, easy=True)
+    except Exception:
+        return None
+    return parse_replaygain(audio.tags) if audio is not None else None
+
+
+def decode_pcm(file_path):
+    """Decode a whole track to 16-bit PCM with pygame; returns (data, sample_rate, channels)"""
+    import_pygame()
+    if not pygame.mixer.get_init():
+        pygame.mixer.init(44100, -16, 2)
+    sample_rate, _, channels = pygame.mixer.get_init()
+    return pygame.mixer.Sound(file_path).get_raw(), sample_rate, channels
+
+
+def k_weighting_filters(sample_rate):
+    """BS.1770 K-weighting as two biquads ((b0, b1, b2), (a1, a2)) for a sample rate
+
+    A high shelf for the head's acoustic effect, then a high pass.
+    """
+    k = math.tan(math.pi * 1681.974450955533 / sample_rate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = (((vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0),
+             (2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0))
+
+    k = math.tan(math.pi * 38.13547087602444 / sample_rate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    high_pass = ((1.0, -2.0, 1.0), (2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0))
+    return shelf, high_pass
+
+
+def gated_loudness(block_powers):
+    """Integrated loudness in LUFS from the mean square of each 400 ms block, or None if silent"""
+    threshold = 10 ** ((LOUDNESS_ABSOLUTE_GATE + 0.691) / 10)
+    loud = [power for power in block_powers if power > threshold]
+    if not loud:
+        return None
+    threshold = sum(loud) / len(loud) * 10 ** (LOUDNESS_RELATIVE_GATE / 10)
+    gated = [power for power in loud if power > threshold]
+    return -0.691 + 10 * math.log10(sum(gated) / len(gated))
+
+
+def pcm_samples(data):
+    """16-bit PCM as an array of ints, for measuring without NumPy"""
+    samples = array('h')
+    samples.frombytes(data[:len(data) // 2 * 2])
+    return samples
+
+
+def sum_of_squares(samples):
+    """Sum of the squared samples, at C speed"""
+    return sum(map(operator.mul, samples, samples))
+
+
+def measure_loudness(data, sample_rate, channels):
+    """Integrated loudness in LUFS of 16-bit PCM, following EBU R128 / ITU-R BS.1770
+
+    With NumPy, each 100 ms step is K-weighted in the frequency domain, which
+    gives its weighted mean square directly (Parseval). Without NumPy the
+    mean squares are taken unweighted, which slightly underrates bass-heavy
+    tracks. 400 ms blocks overlap by 75%, made of four steps each.
+    """
+    step = sample_rate // 10
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    if numpy is not None:
+        samples = numpy.frombuffer(data, dtype='<i2')
+        steps = len(samples) // (channels * step)
+        samples = samples[:steps * step * channels].reshape(steps, step, channels)
+
+        # Power response of the filters at each rfft bin, doubled for the
+        # bins that stand for both positive and negative frequencies
+        z = numpy.exp(-2j * numpy.pi * numpy.fft.rfftfreq(step))
+        response = numpy.ones(len(z), dtype=complex)
+        for (b0, b1, b2), (a1, a2) in k_weighting_filters(sample_rate):
+            response *= (b0 + b1 * z + b2 * z * z) / (1 + a1 * z + a2 * z * z)
+        weights = numpy.abs(response) ** 2 * 2
+        weights[0] /= 2
+        if step % 2 == 0:
+            weights[-1] /= 2
+        weights /= (step * 32768.0) ** 2
+
+        powers = numpy.empty(steps)
+        # A minute at a time, to bound memory for long tracks
+        for start in range(0, steps, 600):
+            spectrum = numpy.fft.rfft(samples[start:start + 600].astype(numpy.float32), axis=1)
+            powers[start:start + 600] = (numpy.abs(spectrum) ** 2 * weights[:, None]).sum(axis=(1, 2))
+        # convolve swaps its arguments when powers is the shorter, so check for a whole block
+        blocks = numpy.convolve(powers, numpy.full(4, 0.25), 'valid').tolist() if steps >= 4 else []
+    else:
+        samples = pcm_samples(data)
+        size = step * channels
+        # The sum of each channel's mean square
+        powers = [sum_of_squares(samples[start:start + size]) / (step * 32768.0 ** 2)
+                  for start in range(0, len(samples) - size + 1, size)]
+        blocks = [sum(powers[index:index + 4]) / 4 for index in range(len(powers) - 3)]
+
+    if not blocks:
+        return None
+    return gated_loudness(blocks)
+
+
+def compute_peaks(data, sample_rate, channels, buckets=WAVEFORM_BUCKETS):
+    """Peak and RMS levels of 16-bit PCM in evenly sized buckets, scaled to 0-255, as two bytes objects"""
+    frames = len(data) // (2 * channels)
+    per_bucket = frames // buckets
+    if per_bucket == 0:
+        return b'', b''
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    if numpy is not None:
+        samples = numpy.frombuffer(data, dtype='<i2')[:buckets * per_bucket * channels]
+        samples = samples.reshape(buckets, per_bucket * channels).astype(numpy.float32)
+        peaks = numpy.abs(samples).max(axis=1)
+        rms = numpy.sqrt((samples * samples).mean(axis=1))
+        scale = 255 / 32768.0
+        return ((peaks * scale).clip(0, 255).astype(numpy.uint8).tobytes(),
+                (rms * scale).clip(0, 255).astype(numpy.uint8).tobytes())
+
+    samples = pcm_samples(data)
+    size = per_bucket * channels
+    chunks = [samples[start:start + size] for start in range(0, buckets * size, size)]
+    return (bytes(min(255, max(max(chunk), -min(chunk)) * 255 // 32768) for chunk in chunks),
+            bytes(min(255, int(math.sqrt(sum_of_squares(chunk) / size) * 255 / 32768)) for chunk in chunks))
+
+
+def write_peaks(peaks_path, data, sample_rate, channels):
+    """Save the waveform of decoded PCM to a peaks file, replacing it atomically"""
+    peaks, rms = compute_peaks(data, sample_rate, channels)
+    if not peaks:
+        return
+    os.makedirs(os.path.dirname(peaks_path), exist_ok=True)
+    temp_path = f"{peaks_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(PEAKS_HEADER.pack(PEAKS_MAGIC, len(peaks), len(data) / (2 * channels * sample_rate)))
+        f.write(peaks)
+        f.write(rms)
+    os.replace(temp_path, peaks_path)
+
+
+class PeaksFile:
+    """A peaks file mapped into memory, with its levels as memoryviews"""
+
+    def __init__(self, peaks_path):
+        with open(peaks_path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, self.duration = PEAKS_HEADER.unpack_from(self.map)
+        if magic != PEAKS_MAGIC or len(self.map) < PEAKS_HEADER.size + 2 * count:
+            self.map.close()
+            raise ValueError(f"Not a peaks file: {peaks_path}")
+        view = memoryview(self.map)
+        self.peaks = view[PEAKS_HEADER.size:PEAKS_HEADER.size + count]
+        self.rms = view[PEAKS_HEADER.size + count:PEAKS_HEADER.size + 2 * count]
+
+    def close(self):
+        self.peaks.release()
+        self.rms.release()
+        self.map.close()
+
+
+def analyze_audio(file_path, peaks_path=None, measure=True):
+    """Work out a track's gain and save its waveform; runs in a worker process
+
+    The gain comes from ReplayGain tags, or by decoding and measuring the
+    track if measure is set and it has none. The track is also decoded if a
+    peaks_path is given, to save the waveform there. Returns (path, values or
+    None), with values holding gain, gain_source, size and mtime.
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return file_path, None
+    gain = read_replaygain(file_path)
+    values = {'size': stat.st_size, 'mtime': stat.st_mtime, 'gain': gain, 'gain_source': 'tag' if gain is not None else None}
+    measure = measure and gain is None
+    if not measure and not peaks_path:
+        return file_path, values
+
+    try:
+        decoded = decode_pcm(file_path)
+        if peaks_path:
+            write_peaks(peaks_path, *decoded)
+    except Exception as e:
+        print(f"Could not decode {file_path}: {e}")
+        decoded = None
+    if measure:
+        loudness = None
+        if decoded is not None:
+            try:
+                loudness = measure_loudness(*decoded)
+            except Exception as e:
+                print(f"Could not measure {file_path}: {e}")
+        if loudness is None:
+            # Undecodable, unmeasurable or silent; don't try again until the file changes
+            values['gain_source'] = 'none'
+        else:
+            values['gain'] = REPLAYGAIN_REFERENCE_LOUDNESS - loudness
+            values['gain_source'] = 'analysis'
+    return file_path, values
+
+
+def open_at_time(source, seek_index, seconds, duration):
+    """Wrap source so it starts at a frame near seconds; returns (stream, start_seconds) or None"""
+    stream_format = seek_index.get('format') if seek_index else None
+    if stream_format == 'flac':
+        sample_rate = seek_index['sample_rate']
+        points = seek_index['points']
+        point = bisect.bisect_right(points, [seconds * sample_rate, float('inf')]) - 1
+        if point < 0:
+            return None
+        sample, offset = points[point]
+        start = sample / sample_rate
+        if seconds - start > SEEK_INDEX_MAX_GAP:
+            return None
+        # Keep only STREAMINFO, with the total sample count and MD5 cleared to "unknown",
+        # since the other blocks (the seek table itself) no longer match the stream
+        streaminfo = bytearray.fromhex(seek_index['streaminfo'])
+        streaminfo[13] &= 0xF0
+        streaminfo[14:18] = bytes(4)
+        streaminfo[18:34] = bytes(16)
+        header = b'fLaC' + bytes([0x80]) + len(streaminfo).to_bytes(3, 'big') + bytes(streaminfo)
+        return SpliceReader(source, seek_index['audio_start'] + offset, header), start
+
+    if stream_format == 'mp3':
+        if 'toc' in seek_index:
+            if duration <= 0:
+                return None
+            # The TOC maps each percent of the duration to a fraction (/256) of the audio bytes
+            percent = min(max(seconds / duration * 100, 0), 99.999)
+            step = int(percent)
+            low = seek_index['toc'][step]
+            high = seek_index['toc'][step + 1] if step < 99 else 256
+            fraction = (low + (high - low) * (percent - step)) / 256
+            offset = seek_index['frame_start'] + int(fraction * seek_index['audio_size'])
+        else:
+            offset = seek_index['audio_start'] + int(seconds * seek_index['bitrate'] / 8)
+        offset = max(offset, seek_index['audio_start'])
+
+        # Move forward to the next real frame boundary
+        source.seek(offset)
+        frame_offset, frame = find_mp3_frame(source.read(8192))
+        if frame is None:
+            return None
+        return SpliceReader(source, offset + frame_offset), seconds
+
+    return None
+
+
+class Profiler:
+    """Timing histograms for hot paths, enabled with --profile or AUDION_PROFILE"""
+
+    # Histogram bucket upper bounds in milliseconds
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)
+
+    def __init__(self):
+        self.enabled = False
+        self.samples = {}
+        self.cprofile = None
+        self.cprofile_path = None
+
+    def enable(self, cprofile_path=None):
+        """Start recording, optionally also running cProfile; the summary is printed on exit"""
+        self.enabled = True
+        if cprofile_path:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile_path = cprofile_path
+            self.cprofile.enable()
+        atexit.register(self.dump)
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = array('d')
+        samples.append(seconds * 1000)
+
+    def summary(self):
+        """A table of count, total and percentiles per hot path, each with its histogram"""
+        lines = [f"{'(ms)':<28}{'count':>8}{'total':>11}{'mean':>9}{'p50':>9}{'p95':>9}{'max':>9}"]
+        for name in sorted(self.samples):
+            values = sorted(self.samples[name])
+            count = len(values)
+            total = sum(values)
+            lines.append(
+                f"{name:<28}{count:>8}{total:>11.1f}{total / count:>9.2f}"
+                f"{values[count // 2]:>9.2f}{values[min(count - 1, int(count * 0.95))]:>9.2f}{values[-1]:>9.2f}"
+            )
+            lines.append("    " + self.histogram(values))
+        return "\n".join(lines)
+
+    def histogram(self, values):
+        counts = [0] * (len(self.BUCKETS) + 1)
+        for value in values:
+            counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        labels = [f"<{bound}" for bound in self.BUCKETS] + [f">={self.BUCKETS[-1]}"]
+        return "  ".join(f"{label}:{count}" for label, count in zip(labels, counts) if count)
+
+    def dump(self):
+        """Print the summary, and the cProfile statistics if they were collected"""
+        if self.samples:
+            print("Audion profile", file=sys.stderr)
+            print(self.summary(), file=sys.stderr)
+        if self.cprofile is not None:
+            import pstats
+            self.cprofile.disable()
+            try:
+                self.cprofile.dump_stats(self.cprofile_path)
+                print(f"cProfile statistics saved to {self.cprofile_path}", file=sys.stderr)
+            except OSError as e:
+                print(f"Could not save cProfile statistics: {e}", file=sys.stderr)
+            pstats.Stats(self.cprofile, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+            self.cprofile = None
+
+
+profiler = Profiler()
+
+
+def profiled(name):
+    """Record a function's run time under name while profiling is enabled"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.record(name, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+class MetadataCache:
+    """On-disk cache of track durations and tags, keyed by path, size and mtime"""
+
+    COLUMNS = ('size', 'mtime', 'duration', 'title', 'artist', 'album', 'track_number', 'seek_index',
+               'fingerprint', 'gain', 'gain_source')
+    # Columns holding structured values, stored as JSON text
+    JSON_COLUMNS = ('seek_index',)
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.conn = None
+        try:
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS tracks ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, duration REAL, "
+                "title TEXT, artist TEXT, album TEXT, track_number INTEGER)"
+            )
+            # Add columns introduced after the table was first created
+            existing = {row[1] for row in self.conn.execute("PRAGMA table_info(tracks)")}
+            for column in self.COLUMNS:
+                if column not in existing:
+                    self.conn.execute(f"ALTER TABLE tracks ADD COLUMN {column}")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS tracks_fingerprint ON tracks (fingerprint)")
+            self.conn.commit()
+        except sqlite3.Error as e:
+            # Fall back to an in-memory only cache
+            print(f"Could not open metadata cache: {e}")
+            self.conn = None
+
+    def get(self, file_path):
+        """Return metadata for a file, probing it with Mutagen only on a cache miss"""
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+
+        entry = self.peek(file_path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry
+
+        entry = self.probe(file_path)
+        entry['size'] = stat.st_size
+        entry['mtime'] = stat.st_mtime
+        self.put(file_path, entry)
+        return entry
+
+    def peek(self, file_path):
+        """Return the cached entry for a file without touching the file itself"""
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is None and self.conn is not None:
+                try:
+                    row = self.conn.execute(
+                        f"SELECT {', '.join(self.COLUMNS)} FROM tracks WHERE path = ?", (file_path,)
+                    ).fetchone()
+                except sqlite3.Error:
+                    row = None
+                if row:
+                    entry = self.decode_row(row)
+                    self.entries[file_path] = entry
+            return entry
+
+    def peek_many(self, paths):
+        """Cached entries for many files at once, as {path: entry}; files without one are left out"""
+        found = {}
+        missing = []
+        with self.lock:
+            for path in paths:
+                entry = self.entries.get(path)
+                if entry is None:
+                    missing.append(path)
+                else:
+                    found[path] = entry
+            if self.conn is None:
+                return found
+
+            # SQLite limits the number of parameters in one statement
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                try:
+                    rows = self.conn.execute(
+                        f"SELECT path, {', '.join(self.COLUMNS)} FROM tracks "
+                        f"WHERE path IN ({', '.join('?' * len(chunk))})", chunk
+                    ).fetchall()
+                except sqlite3.Error:
+                    break
+                for row in rows:
+                    entry = self.decode_row(row[1:])
+                    self.entries[row[0]] = entry
+                    found[row[0]] = entry
+        return found
+
+    def decode_row(self, row):
+        """Turn a row of COLUMNS into an entry dict"""
+        entry = dict(zip(self.COLUMNS, row))
+        for column in self.JSON_COLUMNS:
+            if entry[column] is not None:
+                entry[column] = json.loads(entry[column])
+        return entry
+
+    def put(self, file_path, entry):
+        """Store an entry in memory and on disk"""
+        self.put_many({file_path: entry})
+
+    def put_many(self, entries):
+        """Store {path: entry} in memory and on disk in one transaction"""
+        with self.lock:
+            self.entries.update(entries)
+            if self.conn is None:
+                return
+            try:
+                self.conn.executemany(
+                    f"INSERT OR REPLACE INTO tracks (path, {', '.join(self.COLUMNS)}) "
+                    f"VALUES (?{', ?' * len(self.COLUMNS)})",
+                    [(file_path, *self.encode_entry(entry)) for file_path, entry in entries.items()]
+                )
+                self.conn.commit()
+            except sqlite3.Error as e:
+                print(f"Could not save metadata: {e}")
+
+    def encode_entry(self, entry):
+        """Turn an entry dict into values for COLUMNS"""
+        values = [entry.get(column) for column in self.COLUMNS]
+        for position, column in enumerate(self.COLUMNS):
+            if column in self.JSON_COLUMNS and values[position] is not None:
+                values[position] = json.dumps(values[position])
+        return values
+
+    def find_fingerprint(self, fingerprint):
+        """Paths of every cached file with this fingerprint"""
+        with self.lock:
+            if self.conn is None:
+                return [path for path, entry in self.entries.items() if entry.get('fingerprint') == fingerprint]
+            try:
+                rows = self.conn.execute("SELECT path FROM tracks WHERE fingerprint = ?", (fingerprint,)).fetchall()
+            except sqlite3.Error:
+                return []
+            return [row[0] for row in rows]
+
+    def remove(self, path, folder=False):
+        """Drop the entry of a deleted file, or of every file under a deleted folder"""
+        with self.lock:
+            if folder:
+                prefix = os.path.join(path, '')
+                for key in [key for key in self.entries if key.startswith(prefix)]:
+                    del self.entries[key]
+                self.execute("DELETE FROM tracks WHERE path >= ? AND path < ?", (prefix, self.prefix_end(prefix)))
+            else:
+                self.entries.pop(path, None)
+                self.execute("DELETE FROM tracks WHERE path = ?", (path,))
+
+    def rename(self, old_path, new_path, folder=False):
+        """Move the entries of a renamed file or folder, so the files aren't probed again"""
+        with self.lock:
+            if folder:
+                old_prefix = os.path.join(old_path, '')
+                new_prefix = os.path.join(new_path, '')
+                for key in [key for key in self.entries if key.startswith(old_prefix)]:
+                    self.entries[new_prefix + key[len(old_prefix):]] = self.entries.pop(key)
+                self.execute(
+                    "UPDATE OR REPLACE tracks SET path = ? || substr(path, ?) WHERE path >= ? AND path < ?",
+                    (new_prefix, len(old_prefix) + 1, old_prefix, self.prefix_end(old_prefix))
+                )
+            else:
+                if old_path in self.entries:
+                    self.entries[new_path] = self.entries.pop(old_path)
+                self.execute("UPDATE OR REPLACE tracks SET path = ? WHERE path = ?", (new_path, old_path))
+
+    def prefix_end(self, prefix):
+        """The smallest string greater than every string starting with prefix"""
+        return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    def execute(self, sql, parameters):
+        """Run a write statement and commit it; call with the lock held"""
+        if self.conn is None:
+            return
+        try:
+            self.conn.execute(sql, parameters)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"Could not update metadata: {e}")
+
+    @staticmethod
+    def probe(file_path):
+        """Read duration and tags from the file with Mutagen"""
+        entry = {'duration': 0, 'title': None, 'artist': None, 'album': None, 'track_number': None}
+        try:
+            # Imported here so startup doesn't pay for Mutagen's format modules
+            from mutagen import File as MutagenFile
+            audio = MutagenFile(file_path, easy=True)
+            # Mutagen objects without tags are falsy, so compare against None
+            if audio is not None and audio.info:
+                entry['duration'] = audio.info.length
+            if audio is not None and audio.tags:
+                for field in ('title', 'artist', 'album'):
+                    values = audio.tags.get(field)
+                    if values:
+                        entry[field] = str(values[0])
+                entry['gain'] = parse_replaygain(audio.tags)
+                if entry['gain'] is not None:
+                    entry['gain_source'] = 'tag'
+                track = audio.tags.get('tracknumber')
+                if track:
+                    # Track numbers are often stored as "3/12"
+                    entry['track_number'] = int(str(track[0]).split('/')[0])
+        except Exception:
+            pass
+        entry['seek_index'] = build_seek_index(file_path)
+        return entry
+
+    def get_seek_index(self, file_path):
+        """Return the seek index for a file, building it for entries cached before it existed"""
+        entry = self.get(file_path)
+        if entry is None:
+            return {}
+        if entry.get('seek_index') is None:
+            entry['seek_index'] = build_seek_index(file_path)
+            self.put(file_path, entry)
+        return entry['seek_index']
+
+    def close(self):
+        """Close the database connection"""
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+class PersistenceService:
+    """The settings file, and deferred writes run on a background thread
+
+    Each write is scheduled under a key, replacing any write still pending
+    under the same key, so a burst of changes to the same thing is written
+    once. Writes run in the order they were last scheduled, once nothing
+    new has been scheduled for a moment; flush runs them right away.
+    """
+
+    def __init__(self, config_path, delay=PERSIST_DELAY, max_delay=PERSIST_MAX_DELAY):
+        self.config_path = config_path
+        self.delay = delay
+        self.max_delay = max_delay
+        self.settings = self.load_settings()
+        self.pending = OrderedDict()
+        self.first_scheduled = None
+        self.deadline = None
+        self.closed = False
+        self.condition = threading.Condition()
+        # Held while writes run, so flush returns only once earlier writes are on disk
+        self.write_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def load_settings(self):
+        try:
+            with open(self.config_path, 'r') as f:
+                settings = json.load(f)
+            if isinstance(settings, dict):
+                return settings
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"Could not load settings: {e}")
+        return {}
+
+    def get(self, key, default=None):
+        return self.settings.get(key, default)
+
+    def set(self, key, value):
+        """Change a setting; the settings file is rewritten shortly after"""
+        if key in self.settings and self.settings[key] == value:
+            return
+        self.settings[key] = value
+        settings = dict(self.settings)
+        self.schedule('settings', lambda: self.write_settings(settings))
+
+    def write_settings(self, settings):
+        """Replace the settings file in one step, so it is never left half written"""
+        temp_path = f"{self.config_path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(settings, f, indent=2)
+        os.replace(temp_path, self.config_path)
+
+    def schedule(self, key, write):
+        """Run write on the background thread soon, instead of any write pending under key"""
+        with self.condition:
+            self.pending.pop(key, None)
+            self.pending[key] = write
+            now = time.monotonic()
+            if self.first_scheduled is None:
+                self.first_scheduled = now
+            # Keep putting the write off while changes keep coming, but not forever
+            self.deadline = min(now + self.delay, self.first_scheduled + self.max_delay)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.closed and (self.deadline is None or self.deadline > time.monotonic()):
+                    self.condition.wait(None if self.deadline is None else self.deadline - time.monotonic())
+                if self.closed:
+                    return
+            self.write_pending()
+
+    def write_pending(self):
+        with self.write_lock:
+            with self.condition:
+                writes = list(self.pending.values())
+                self.pending.clear()
+                self.first_scheduled = None
+                self.deadline = None
+            for write in writes:
+                try:
+                    write()
+                except (OSError, sqlite3.Error) as e:
+                    print(f"Could not save: {e}")
+
+    def flush(self):
+        """Write everything pending now, on the calling thread"""
+        self.write_pending()
+
+    def close(self):
+        """Stop the background thread and write anything still pending"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.flush()
+
+
+class TrackTable:
+    """Interned track paths: a table of folders, and each track as a folder id and a file name
+
+    Folders are stored once however many tracks they hold, and file names are
+    packed as UTF-8 into one buffer, so a track costs a few dozen bytes rather
+    than a full path string. Ids are handed out on first sight and never
+    reused, so playlists can keep them in integer arrays; paths are found again
+    through an open-addressing hash index of track ids.
+    """
+
+    __slots__ = ('folders', 'folder_ids', 'track_folders', 'name_ends', 'name_data', 'slots')
+
+    EMPTY = -1
+
+    def __init__(self):
+        self.folders = []
+        self.folder_ids = {}
+        self.track_folders = array('I')
+        self.name_ends = array('Q')
+        self.name_data = bytearray()
+        self.slots = array('l', [self.EMPTY]) * 1024
+
+    @staticmethod
+    def split(path):
+        """(folder with its trailing separator, file name), which add back up to path"""
+        cut = path.rfind(os.sep)
+        if os.altsep:
+            cut = max(cut, path.rfind(os.altsep))
+        return path[:cut + 1], path[cut + 1:]
+
+    def intern(self, path):
+        """The id of a path, adding it if it is new"""
+        folder_path, name = self.split(path)
+        folder_id = self.folder_ids.get(folder_path)
+        if folder_id is None:
+            folder_id = self.folder_ids[folder_path] = len(self.folders)
+            self.folders.append(folder_path)
+        encoded = name.encode('utf-8', 'surrogatepass')
+        slot = self.find_slot(folder_id, name, encoded)
+        if self.slots[slot] != self.EMPTY:
+            return self.slots[slot]
+
+        track_id = len(self.track_folders)
+        self.track_folders.append(folder_id)
+        self.name_data += encoded
+        self.name_ends.append(len(self.name_data))
+        self.slots[slot] = track_id
+        if len(self.track_folders) * 2 > len(self.slots):
+            self.grow()
+        return track_id
+
+    def find(self, path):
+        """The id of a path, or None if it was never added"""
+        if path is None:
+            return None
+        folder_path, name = self.split(path)
+        folder_id = self.folder_ids.get(folder_path)
+        if folder_id is None:
+            return None
+        track_id = self.slots[self.find_slot(folder_id, name, name.encode('utf-8', 'surrogatepass'))]
+        return None if track_id == self.EMPTY else track_id
+
+    def find_slot(self, folder_id, name, encoded):
+        """The index slot holding this track, or the empty slot it would go in"""
+        mask = len(self.slots) - 1
+        slot = hash((folder_id, name)) & mask
+        while True:
+            track_id = self.slots[slot]
+            if track_id == self.EMPTY or (self.track_folders[track_id] == folder_id and
+                                          self.get_name_bytes(track_id) == encoded):
+                return slot
+            slot = (slot + 1) & mask
+
+    def grow(self):
+        """Double the hash index, keeping it at most half full"""
+        self.slots = array('l', [self.EMPTY]) * (len(self.slots) * 2)
+        # Every track is distinct, so each one only needs an empty slot
+        for track_id in range(len(self.track_folders)):
+            folder_id = self.track_folders[track_id]
+            name = self.get_name(track_id)
+            self.slots[self.find_slot(folder_id, name, None)] = track_id
+
+    def get_name_bytes(self, track_id):
+        start = self.name_ends[track_id - 1] if track_id else 0
+        return self.name_data[start:self.name_ends[track_id]]
+
+    def get_name(self, track_id):
+        """The file name of a track, which is also its display name"""
+        return self.get_name_bytes(track_id).decode('utf-8', 'surrogatepass')
+
+    def get_path(self, track_id):
+        return self.folders[self.track_folders[track_id]] + self.get_name(track_id)
+
+    def __len__(self):
+        return len(self.track_folders)
+
+
+class TrackList:
+    """A playlist held as an array of track table ids, read and written as paths like a list"""
+
+    __slots__ = ('table', 'ids')
+
+    def __init__(self, table, paths=()):
+        self.table = table
+        self.ids = array('I', map(table.intern, paths))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        return self.table.get_path(self.ids[index])
+
+    def __setitem__(self, index, path):
+        self.ids[index] = self.table.intern(path)
+
+    def __iter__(self):
+        return map(self.table.get_path, self.ids)
+
+    def __contains__(self, path):
+        track_id = self.table.find(path)
+        return track_id is not None and track_id in self.ids
+
+    def index(self, path):
+        track_id = self.table.find(path)
+        if track_id is None:
+            raise ValueError(f"{path!r} is not in the playlist")
+        return self.ids.index(track_id)
+
+    def extend(self, paths):
+        self.ids.extend(map(self.table.intern, paths))
+
+    def sort(self):
+        """Sort by path"""
+        self.ids = array('I', sorted(self.ids, key=self.table.get_path))
+
+    def remove_indexes(self, indexes):
+        """Drop the tracks at a set of indexes"""
+        self.ids = array('I', [track_id for index, track_id in enumerate(self.ids) if index not in indexes])
+
+    def get_name(self, index):
+        """The file name of a track, for display"""
+        return self.table.get_name(self.ids[index])
+
+    def copy(self):
+        """A snapshot of the playlist; the track table is only ever added to, so it can be shared"""
+        tracks = TrackList(self.table)
+        tracks.ids = array('I', self.ids)
+        return tracks
+
+
+class PlaylistStore:
+    """SQLite-backed named playlists and play-next queue, where every change is a small, atomic transaction
+
+    Paths are stored once in a shared track table; playlists and the queue
+    hold integer track ids, so a track in several playlists costs a few bytes
+    per playlist and changing one playlist never rewrites the others. Writes
+    may come from the persistence thread, so the connection is shared under
+    a lock. If the database can't be opened, playlists are kept in memory for
+    the session and error holds the reason.
+    """
+
+    DEFAULT_NAME = "Library"
+
+    def __init__(self, db_path, legacy_json_path=None):
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.conn = None
+        self.error = None
+        try:
+            self.open(db_path)
+            self.migrate_single_playlist()
+            if legacy_json_path and self.get_state('migrated') is None:
+                self.migrate_json(legacy_json_path)
+            # Creates the default playlist on first run, so a database that can't be written fails here too
+            self.get_active()
+        except sqlite3.Error as e:
+            print(f"Could not open playlists: {e}")
+            self.error = e
+            if self.conn is not None:
+                self.conn.close()
+            self.open(':memory:')
+
+    def open(self, db_path):
+        """Connect and create any tables that don't exist yet"""
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS tracks (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS playlists ("
+                "id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, "
+                "current_index INTEGER NOT NULL DEFAULT 0, folder TEXT)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "playlist_id INTEGER NOT NULL, position INTEGER NOT NULL, track_id INTEGER NOT NULL, "
+                "PRIMARY KEY (playlist_id, position)) WITHOUT ROWID"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS queue (position INTEGER PRIMARY KEY, track_id INTEGER NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+    def migrate_single_playlist(self):
+        """Move the one playlist saved by older versions into the default named playlist"""
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'playlist'"
+        ).fetchone()
+        if not exists:
+            return
+        paths = [row[0] for row in self.conn.execute("SELECT path FROM playlist ORDER BY position")]
+        playlist_id = self.get_active()
+        self.replace(playlist_id, paths, self.get_state('current_index', 0))
+        with self.conn:
+            self.conn.execute("DROP TABLE playlist")
+            self.conn.execute("DELETE FROM state WHERE key = 'current_index'")
+            self.conn.execute("UPDATE state SET key = ? WHERE key = 'shuffle'", (f"shuffle:{playlist_id}",))
+
+    def migrate_json(self, json_path):
+        """Import the playlist saved by older versions in ~/.audion_playlist.json"""
+        try:
+            if os.path.exists(json_path):
+                with open(json_path, 'r') as f:
+                    playlist_data = json.load(f)
+                self.replace(self.get_active(), playlist_data.get('playlist', []), playlist_data.get('current_index', 0))
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"Could not import old playlist: {e}")
+        self.set_state('migrated', True)
+
+    def list_playlists(self):
+        """Every playlist as (id, name, track count), by name"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT p.id, p.name, (SELECT COUNT(*) FROM entries e WHERE e.playlist_id = p.id) "
+                "FROM playlists p ORDER BY p.name COLLATE NOCASE"
+            ).fetchall()
+
+    def get_active(self):
+        """The id of the playlist in use, creating the default playlist on first run"""
+        with self.lock:
+            playlist_id = self.get_state('active_playlist')
+            if playlist_id is not None and self.get_playlist(playlist_id) is not None:
+                return playlist_id
+            row = self.conn.execute("SELECT id FROM playlists ORDER BY id LIMIT 1").fetchone()
+            playlist_id = row[0] if row else self.create(self.DEFAULT_NAME)
+            self.set_active(playlist_id)
+            return playlist_id
+
+    def set_active(self, playlist_id):
+        with self.lock:
+            self.set_state('active_playlist', playlist_id)
+
+    def get_playlist(self, playlist_id):
+        """(name, folder) of a playlist, or None if there is no such playlist"""
+        with self.lock:
+            return self.conn.execute("SELECT name, folder FROM playlists WHERE id = ?", (playlist_id,)).fetchone()
+
+    def find(self, name):
+        """The id of the playlist with this name, or None"""
+        with self.lock:
+            row = self.conn.execute("SELECT id FROM playlists WHERE name = ?", (name,)).fetchone()
+            return row[0] if row else None
+
+    def find_folder(self, folder):
+        """The id of the playlist loaded from this folder, or None"""
+        with self.lock:
+            row = self.conn.execute("SELECT id FROM playlists WHERE folder = ? ORDER BY id LIMIT 1", (folder,)).fetchone()
+            return row[0] if row else None
+
+    def create(self, name, folder=None):
+        """Add an empty playlist and return its id"""
+        with self.lock, self.conn:
+            return self.conn.execute("INSERT INTO playlists (name, folder) VALUES (?, ?)", (name, folder)).lastrowid
+
+    def rename(self, playlist_id, name):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE playlists SET name = ? WHERE id = ?", (name, playlist_id))
+
+    def set_folder(self, playlist_id, folder):
+        """Remember the folder a playlist was loaded from"""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE playlists SET folder = ? WHERE id = ?", (folder, playlist_id))
+
+    def delete(self, playlist_id):
+        """Remove a playlist, and the tracks no longer used by any playlist or the queue"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM entries WHERE playlist_id = ?", (playlist_id,))
+            self.conn.execute("DELETE FROM playlists WHERE id = ?", (playlist_id,))
+            self.conn.execute("DELETE FROM state WHERE key = ?", (f"shuffle:{playlist_id}",))
+            self.conn.execute(
+                "DELETE FROM tracks WHERE id NOT IN (SELECT track_id FROM entries UNION SELECT track_id FROM queue)"
+            )
+
+    def load(self, playlist_id):
+        """Return a playlist's paths and current index"""
+        with self.lock:
+            paths = [row[0] for row in self.conn.execute(
+                "SELECT t.path FROM entries e JOIN tracks t ON t.id = e.track_id "
+                "WHERE e.playlist_id = ? ORDER BY e.position", (playlist_id,)
+            )]
+            row = self.conn.execute("SELECT current_index FROM playlists WHERE id = ?", (playlist_id,)).fetchone()
+            return paths, row[0] if row else 0
+
+    def insert_entries(self, table, rows):
+        """Insert rows of (key columns..., path) into entries or queue, storing each new path once"""
+        rows = list(rows)
+        self.conn.executemany("INSERT OR IGNORE INTO tracks (path) VALUES (?)", ((row[-1],) for row in rows))
+        keys = ('playlist_id', 'position') if table == 'entries' else ('position',)
+        self.conn.executemany(
+            f"INSERT INTO {table} ({', '.join(keys)}, track_id) "
+            f"SELECT {', '.join('?' * len(keys))}, id FROM tracks WHERE path = ?", rows
+        )
+
+    def replace(self, playlist_id, paths, current_index):
+        """Replace one playlist in one transaction"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM entries WHERE playlist_id = ?", (playlist_id,))
+            self.insert_entries('entries', ((playlist_id, position, path) for position, path in enumerate(paths)))
+            self.conn.execute("UPDATE playlists SET current_index = ? WHERE id = ?", (current_index, playlist_id))
+
+    def append(self, playlist_id, paths):
+        """Add tracks to the end of a playlist"""
+        with self.lock, self.conn:
+            start = self.conn.execute(
+                "SELECT COALESCE(MAX(position) + 1, 0) FROM entries WHERE playlist_id = ?", (playlist_id,)
+            ).fetchone()[0]
+            self.insert_entries('entries', ((playlist_id, position, path) for position, path in enumerate(paths, start)))
+
+    def set_current_index(self, playlist_id, index):
+        """Remember a playlist's current track"""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE playlists SET current_index = ? WHERE id = ?", (index, playlist_id))
+
+    def load_queue(self):
+        """The paths queued to play next, in order"""
+        with self.lock:
+            return [row[0] for row in self.conn.execute(
+                "SELECT t.path FROM queue q JOIN tracks t ON t.id = q.track_id ORDER BY q.position"
+            )]
+
+    def replace_queue(self, paths):
+        """Replace the play-next queue in one transaction"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM queue")
+            self.insert_entries('queue', enumerate(paths))
+
+    def get_state(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+            return json.loads(row[0]) if row else default
+
+    def set_state(self, key, value):
+        with self.lock, self.conn:
+            self._set_state(key, value)
+
+    def _set_state(self, key, value):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, json.dumps(value))
+        )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class LibraryScanner:
+    """Recursively scan a folder for audio files on a pool of worker threads"""
+
+    def __init__(self, folder_path, max_workers=4):
+        self.folder_path = folder_path
+        self.results = queue.Queue()
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.folders_scanned = 0
+
+    def start(self):
+        """Start scanning from the root folder"""
+        self.submit(self.folder_path)
+
+    def cancel(self):
+        """Stop scanning; folders already queued are skipped"""
+        self.cancelled.set()
+
+    def submit(self, folder_path):
+        """Queue a folder for scanning on the worker pool"""
+        with self.lock:
+            self.pending += 1
+        self.executor.submit(self.scan_folder, folder_path)
+
+    def scan_folder(self, folder_path):
+        """Scan one folder, queueing subfolders and reporting its audio files"""
+        audio_files = []
+        try:
+            if not self.cancelled.is_set():
+                with os.scandir(folder_path) as entries:
+                    for entry in entries:
+                        if self.cancelled.is_set():
+                            break
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                self.submit(entry.path)
+                            elif entry.is_file() and entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                                audio_files.append(entry.path)
+                        except OSError:
+                            pass
+        except OSError as e:
+            print(f"Could not scan {folder_path}: {e}")
+        finally:
+            if audio_files:
+                audio_files.sort()
+                self.results.put(audio_files)
+
+            with self.lock:
+                self.pending -= 1
+                self.folders_scanned += 1
+                done = self.pending == 0
+
+            if done:
+                self.executor.shutdown(wait=False)
+                self.finished.set()
+
+    def get_batch(self, max_items=2000):
+        """Collect scanned files without blocking, up to roughly max_items"""
+        batch = []
+        while len(batch) < max_items:
+            try:
+                batch.extend(self.results.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def is_done(self):
+        """True once every folder has been scanned and all results collected"""
+        return self.finished.is_set() and self.results.empty()
+
+
+def resolve_playlist_entry(location, base_folder):
+    """Absolute path of a playlist entry, or None for entries that aren't local files"""
+    if location.lower().startswith('file://'):
+        location = unquote(urlsplit(location).path)
+        if os.name == 'nt' and re.match(r'/[A-Za-z]:', location):
+            location = location[1:]
+    elif re.match(r'[A-Za-z][A-Za-z0-9+.-]+://', location):
+        return None
+    return os.path.normpath(os.path.join(base_folder, os.path.expanduser(location)))
+
+
+def split_playlist_title(title):
+    """(artist, title) from a playlist's "Artist - Title" display title"""
+    if not title:
+        return None, None
+    artist, separator, name = title.partition(' - ')
+    if not separator:
+        return None, title
+    return artist, name
+
+
+def parse_m3u(lines, base_folder):
+    """Yield (path, duration or None, title or None) for each entry of an M3U or M3U8 playlist
+
+    lines can be an open file, so long playlists are read a line at a time.
+    """
+    duration = title = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            if line[:8].upper() == '#EXTINF:':
+                # #EXTINF:<seconds>[ attributes],<title>, where -1 seconds means unknown
+                info, _, title = line[8:].partition(',')
+                try:
+                    duration = float(info.split()[0])
+                except (IndexError, ValueError):
+                    duration = None
+                if duration is not None and duration <= 0:
+                    duration = None
+                title = title.strip() or None
+            continue
+        path = resolve_playlist_entry(line, base_folder)
+        if path is not None:
+            yield path, duration, title
+        duration = title = None
+
+
+def parse_pls(lines, base_folder):
+    """Yield (path, duration or None, title or None) for each entry of a PLS playlist, in order
+
+    An entry is yielded as soon as a later one starts, so lines can be an open file.
+    """
+    entries = {}
+    for line in lines:
+        key, separator, value = line.strip().partition('=')
+        match = PLS_KEY_PATTERN.fullmatch(key.strip())
+        if not separator or not match:
+            continue
+        field, number = match.group(1).lower(), int(match.group(2))
+        for done in sorted(done for done in entries if done < number):
+            entry = make_pls_entry(entries.pop(done), base_folder)
+            if entry is not None:
+                yield entry
+        entries.setdefault(number, {})[field] = value.strip()
+    for number in sorted(entries):
+        entry = make_pls_entry(entries[number], base_folder)
+        if entry is not None:
+            yield entry
+
+
+def make_pls_entry(fields, base_folder):
+    """(path, duration, title) from one PLS entry's File, Title and Length, or None"""
+    path = resolve_playlist_entry(fields['file'], base_folder) if fields.get('file') else None
+    if path is None:
+        return None
+    try:
+        duration = float(fields.get('length', -1))
+    except ValueError:
+        duration = -1
+    return path, duration if duration > 0 else None, fields.get('title') or None
+
+
+def read_playlist_file(file_path):
+    """Stream (path, duration, title) entries from an M3U, M3U8 or PLS file"""
+    base_folder = os.path.dirname(os.path.abspath(file_path))
+    parse = parse_pls if file_path.lower().endswith('.pls') else parse_m3u
+    # Undecodable bytes come through as surrogates, matching how Python decodes file names
+    with open(file_path, encoding='utf-8-sig', errors='surrogateescape') as f:
+        yield from parse(f, base_folder)
+
+
+def write_playlist_file(file_path, tracks):
+    """Save (path, duration or None, title or None) tracks as PLS, or as extended M3U for any other extension
+
+    Tracks under the playlist's folder are written relative to it, so the
+    folder can be moved as a whole; others keep their absolute path.
+    """
+    base_folder = os.path.join(os.path.dirname(os.path.abspath(file_path)), '')
+    is_pls = file_path.lower().endswith('.pls')
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8', errors='surrogateescape') as f:
+        f.write("[playlist]\n" if is_pls else "#EXTM3U\n")
+        number = 0
+        for number, (path, duration, title) in enumerate(tracks, 1):
+            if path.startswith(base_folder):
+                path = path[len(base_folder):]
+            length = round(duration) if duration else -1
+            if is_pls:
+                f.write(f"File{number}={path}\n")
+                if title:
+                    f.write(f"Title{number}={title}\n")
+                f.write(f"Length{number}={length}\n")
+            else:
+                f.write(f"#EXTINF:{length},{title or os.path.splitext(os.path.basename(path))[0]}\n{path}\n")
+        if is_pls:
+            f.write(f"NumberOfEntries={number}\nVersion=2\n")
+    os.replace(temp_path, file_path)
+    return number
+
+
+class PlaylistImporter:
+    """Read an M3U, M3U8 or PLS file on a background thread, handing its tracks over in batches
+
+    Works like LibraryScanner. Durations and titles from the file are stored in
+    the metadata cache for files it doesn't know yet, so the tracks can be
+    shown and played before the background analysis has probed them.
+    """
+
+    def __init__(self, file_path, metadata_cache, batch_size=2000):
+        self.file_path = file_path
+        self.metadata_cache = metadata_cache
+        self.batch_size = batch_size
+        self.results = queue.Queue()
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.tracks_read = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        batch = []
+        try:
+            for track in read_playlist_file(self.file_path):
+                if self.cancelled.is_set():
+                    return
+                batch.append(track)
+                if len(batch) >= self.batch_size:
+                    self.add_batch(batch)
+                    batch = []
+            if batch:
+                self.add_batch(batch)
+        except OSError as e:
+            print(f"Could not read playlist {self.file_path}: {e}")
+            self.error = e
+        finally:
+            self.finished.set()
+
+    def add_batch(self, tracks):
+        self.seed_metadata(tracks)
+        self.tracks_read += len(tracks)
+        self.results.put([path for path, _, _ in tracks])
+
+    def seed_metadata(self, tracks):
+        """Cache the playlist's durations and titles for files the metadata cache has no entry for"""
+        timed = [track for track in tracks if track[1]]
+        if not timed:
+            return
+        known = self.metadata_cache.peek_many([path for path, _, _ in timed])
+        entries = {}
+        for path, duration, title in timed:
+            if path in known:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            artist, title = split_playlist_title(title)
+            entries[path] = {
+                'size': stat.st_size, 'mtime': stat.st_mtime, 'duration': duration,
+                'title': title, 'artist': artist, 'album': None, 'track_number': None,
+            }
+        if entries:
+            self.metadata_cache.put_many(entries)
+
+    def get_batch(self, max_items=2000):
+        """Collect imported tracks without blocking, up to roughly max_items"""
+        batch = []
+        while len(batch) < max_items:
+            try:
+                batch.extend(self.results.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def is_done(self):
+        """True once the whole file has been read and all results collected"""
+        return self.finished.is_set() and self.results.empty()
+
+
+class ShuffleOrder:
+    """Shuffled play order from a precomputed Fisher–Yates permutation with an O(1) cursor
+
+    Each pass through the playlist (an epoch) uses a permutation derived from
+    the seed and epoch number, so the order is rebuilt exactly after a restart
+    and history can be stepped back across passes. Tracks added to the end of
+    the playlist are spread through the rest of the current pass; growth
+    records where, so that is rebuilt too.
+    """
+
+    def __init__(self, size, seed=None, epoch=0, cursor=-1, base_size=None, growth=()):
+        self.size = size
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.epoch = epoch
+        self.cursor = cursor  # Position of the current track in this epoch's order
+        # Size at the start of this epoch, and [cursor, new size] for each time it grew since
+        self.base_size = size if base_size is None else base_size
+        self.growth = [list(step) for step in growth]
+        self.order = self.build(epoch, self.base_size)
+        previous_size = self.base_size
+        for step_cursor, step_size in self.growth:
+            self.order = self.splice(self.order, step_cursor, previous_size, step_size)
+            previous_size = step_size
+        self.next_order = None
+
+    def build(self, epoch, size=None):
+        """Permutation for one pass through the playlist"""
+        order = array('l', range(self.size if size is None else size))
+        # random.shuffle is an in-place Fisher–Yates shuffle
+        random.Random(f"{self.seed}:{epoch}").shuffle(order)
+        return order
+
+    def splice(self, order, cursor, old_size, size):
+        """order with the tracks from old_size up to size inserted at random places after cursor"""
+        rng = random.Random(f"{self.seed}:{self.epoch}:{old_size}")
+        new_indexes = list(range(old_size, size))
+        rng.shuffle(new_indexes)
+        # The next few tracks may already be queued or read ahead, so they keep their places
+        start = min(cursor + 1 + PREFETCH_TRACKS, len(order))
+        slots = sorted(rng.randrange(start, len(order) + 1) for _ in new_indexes)
+        spliced = array('l')
+        previous = 0
+        for slot, index in zip(slots, new_indexes):
+            spliced.extend(order[previous:slot])
+            spliced.append(index)
+            previous = slot
+        spliced.extend(order[previous:])
+        return spliced
+
+    def extend(self, size):
+        """Make room for tracks appended to the playlist, keeping the order played and queued so far"""
+        self.order = self.splice(self.order, self.cursor, self.size, size)
+        self.growth.append([self.cursor, size])
+        self.size = size
+        self.next_order = None
+
+    def start_epoch(self, epoch, order):
+        self.epoch = epoch
+        self.order = order
+        self.base_size = self.size
+        self.growth = []
+
+    def order_for(self, epoch):
+        if epoch == self.epoch:
+            return self.order
+        if self.next_order is None or self.next_order[0] != epoch:
+            self.next_order = (epoch, self.build(epoch))
+        return self.next_order[1]
+
+    def following(self, epoch, cursor):
+        if cursor + 1 < self.size:
+            return epoch, cursor + 1
+        return epoch + 1, 0
+
+    def peek(self, count, current):
+        """The next count tracks, without moving the cursor"""
+        indexes = []
+        epoch, cursor = self.epoch, self.cursor
+        while len(indexes) < count and self.size:
+            epoch, cursor = self.following(epoch, cursor)
+            if epoch > self.epoch + 1:
+                break
+            index = self.order_for(epoch)[cursor]
+            # Don't replay the current track straight after a reshuffle
+            if index == current and self.size > 1:
+                continue
+            indexes.append(index)
+        return indexes
+
+    def advance(self, current):
+        """Move the cursor to the next track and return it"""
+        while True:
+            epoch, cursor = self.following(self.epoch, self.cursor)
+            if epoch != self.epoch:
+                self.start_epoch(epoch, self.order_for(epoch))
+                self.next_order = None
+            self.cursor = cursor
+            index = self.order[cursor]
+            if index != current or self.size == 1:
+                return index
+
+    def retreat(self, current):
+        """Step back to the previously played track, or None at the start of history"""
+        # After jumping to a track by hand, the cursor still points at the
+        # track that was playing before the jump
+        if self.cursor >= 0 and self.order[self.cursor] != current:
+            return self.order[self.cursor]
+        
+        while True:
+            if self.cursor > 0:
+                self.cursor -= 1
+            elif self.epoch > 0:
+                self.next_order = (self.epoch, self.order)
+                self.start_epoch(self.epoch - 1, self.build(self.epoch - 1))
+                self.cursor = self.size - 1
+            else:
+                return None
+            # Skip the copy of the current track that advance() passed over
+            index = self.order[self.cursor]
+            if index != current or self.size == 1:
+                return index
+
+    def get_state(self):
+        return {'size': self.size, 'seed': self.seed, 'epoch': self.epoch, 'cursor': self.cursor,
+                'base_size': self.base_size, 'growth': [list(step) for step in self.growth]}
+
+
+class TrackPrefetcher:
+    """Read upcoming tracks into memory on a background thread, evicting the least recently used"""
+
+    def __init__(self, memory_budget=PREFETCH_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self.cache = OrderedDict()
+        self.cache_size = 0
+        self.wanted = []
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def prefetch(self, paths):
+        """Replace the read-ahead list with these paths, nearest first"""
+        with self.condition:
+            # Keep upcoming tracks that are already cached away from eviction
+            for file_path in reversed(paths):
+                if file_path in self.cache:
+                    self.cache.move_to_end(file_path)
+            self.wanted = [file_path for file_path in paths if file_path not in self.cache]
+            self.condition.notify()
+
+    def get(self, file_path):
+        """Return an in-memory file object for a prefetched track, or None"""
+        with self.condition:
+            data = self.cache.get(file_path)
+            if data is None:
+                return None
+            self.cache.move_to_end(file_path)
+        return io.BytesIO(data)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.wanted and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                file_path = self.wanted.pop(0)
+
+            data = self.read_file(file_path)
+            if data is not None:
+                with self.condition:
+                    self.store(file_path, data)
+
+    def read_file(self, file_path):
+        try:
+            size = os.path.getsize(file_path)
+            with open(file_path, 'rb') as f:
+                if size > self.memory_budget // 2:
+                    # Too big to keep, but reading it still warms the OS page cache
+                    while f.read(1024 * 1024):
+                        pass
+                    return None
+                return f.read()
+        except OSError as e:
+            print(f"Could not prefetch {file_path}: {e}")
+            return None
+
+    def store(self, file_path, data):
+        if file_path in self.cache:
+            return
+        self.cache[file_path] = data
+        self.cache_size += len(data)
+        while self.cache_size > self.memory_budget and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.cache_size -= len(evicted)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class PathValidator:
+    """Check on a background thread which files in a playlist still exist"""
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.missing = queue.Queue()
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        for file_path in self.paths:
+            if self.cancelled.is_set():
+                break
+            if not os.path.exists(file_path):
+                self.missing.put(file_path)
+        self.finished.set()
+
+    def get_missing(self):
+        """Collect the paths of missing files found so far"""
+        paths = []
+        while True:
+            try:
+                paths.append(self.missing.get_nowait())
+            except queue.Empty:
+                return paths
+
+    def is_done(self):
+        return self.finished.is_set() and self.missing.empty()
+
+
+class TrackAnalyzer:
+    """Fingerprint tracks, measure their loudness and save waveforms in a pool of worker processes
+
+    Results are stored in the metadata cache, and tracks whose cached values
+    still match the file's size and mtime are skipped, so a library is only
+    analyzed once. Waveforms asked for by the player come first, then
+    fingerprints; loudness is only measured (by decoding the whole track,
+    which also saves its waveform) for tracks without ReplayGain tags, once
+    nothing else is waiting. The pool is started on the first track that
+    needs work.
+    """
+
+    WAVEFORM = 0
+    FINGERPRINT = 1
+    LOUDNESS = 2
+
+    def __init__(self, metadata_cache, peaks_folder=None, max_workers=None):
+        self.metadata_cache = metadata_cache
+        self.peaks_folder = peaks_folder
+        self.max_workers = max_workers or max(1, min(4, (os.cpu_count() or 2) - 1))
+        self.pending = queue.PriorityQueue()
+        self.order = count()
+        self.submitted = set()
+        self.waveforms_requested = set()
+        self.waveforms_done = set()
+        self.executor = None
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, paths):
+        """Queue tracks to be analyzed if they haven't been already"""
+        new_paths = [path for path in dict.fromkeys(paths) if path not in self.submitted]
+        self.submitted.update(new_paths)
+        self.enqueue(self.FINGERPRINT, new_paths, FINGERPRINT_BATCH_SIZE)
+
+    def request_waveform(self, file_path):
+        """Decode a track to save its waveform, ahead of any other work"""
+        if file_path not in self.waveforms_requested and not self.closed.is_set():
+            self.waveforms_requested.add(file_path)
+            self.enqueue(self.WAVEFORM, [file_path], 1)
+
+    def is_waveform_pending(self, file_path):
+        return file_path in self.waveforms_requested and file_path not in self.waveforms_done
+
+    def get_peaks_path(self, fingerprint):
+        """Where the waveform of the audio with this fingerprint is saved, or None if waveforms aren't kept"""
+        if not self.peaks_folder or not fingerprint:
+            return None
+        return os.path.join(self.peaks_folder, f"{fingerprint}.peaks")
+
+    def enqueue(self, task, paths, batch_size):
+        if self.closed.is_set():
+            return
+        for start in range(0, len(paths), batch_size):
+            self.pending.put((task, next(self.order), paths[start:start + batch_size]))
+
+    def run(self):
+        while True:
+            task, _, batch = self.pending.get()
+            if batch is None or self.closed.is_set():
+                break
+            try:
+                if task == self.FINGERPRINT:
+                    self.fingerprint(batch)
+                else:
+                    self.analyze(batch)
+                if task == self.WAVEFORM:
+                    self.waveforms_done.update(batch)
+            except Exception as e:
+                # Raised when the pool is shut down or a worker dies
+                if self.closed.is_set():
+                    break
+                print(f"Could not analyze tracks: {e}")
+                # A dead worker breaks the whole pool, so the next batch starts a new one
+                self.discard_executor()
+                if task == self.WAVEFORM:
+                    self.waveforms_done.update(batch)
+                else:
+                    # Let these tracks be submitted again later
+                    self.submitted.difference_update(batch)
+
+    def discard_executor(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def get_executor(self):
+        if self.executor is None:
+            # Forking a process that runs Tk and threads isn't safe, so start clean workers
+            self.executor = ProcessPoolExecutor(
+                self.max_workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_background_worker
+            )
+        return self.executor
+
+    def fingerprint(self, paths):
+        """Probe and fingerprint the tracks that need it, then queue the ones without a gain"""
+        stale, unmeasured = self.get_stale(paths)
+        if stale:
+            results = self.get_executor().map(analyze_track, stale, chunksize=8)
+            entries = {path: entry for path, entry in results if entry is not None}
+            if entries and not self.closed.is_set():
+                self.metadata_cache.put_many(entries)
+            unmeasured.extend(path for path, entry in entries.items() if entry.get('gain_source') is None)
+        self.enqueue(self.LOUDNESS, unmeasured, LOUDNESS_BATCH_SIZE)
+
+    def analyze(self, paths):
+        """Work out the gain of tracks that have none and save missing waveforms
+
+        Gains are kept only if the file hasn't changed in the meantime.
+        """
+        cached = self.metadata_cache.peek_many(paths)
+        peaks_paths = []
+        measure = []
+        for path in paths:
+            entry = cached.get(path) or {}
+            peaks_path = self.get_peaks_path(entry.get('fingerprint'))
+            peaks_paths.append(None if peaks_path is None or os.path.exists(peaks_path) else peaks_path)
+            measure.append(entry.get('gain_source') is None)
+        results = list(self.get_executor().map(analyze_audio, paths, peaks_paths, measure))
+
+        cached = self.metadata_cache.peek_many(paths)
+        entries = {}
+        for path, values in results:
+            entry = cached.get(path)
+            if values is None or entry is None or values['gain_source'] is None:
+                continue
+            if entry['size'] == values['size'] and entry['mtime'] == values['mtime']:
+                entries[path] = dict(entry, gain=values['gain'], gain_source=values['gain_source'])
+        if entries and not self.closed.is_set():
+            self.metadata_cache.put_many(entries)
+
+    def get_stale(self, paths):
+        """(paths without an up to date fingerprint, paths with one but no gain yet)"""
+        cached = self.metadata_cache.peek_many(paths)
+        stale = []
+        unmeasured = []
+        for path in paths:
+            entry = cached.get(path)
+            if entry is not None and entry.get('fingerprint'):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                    if entry.get('gain_source') is None:
+                        unmeasured.append(path)
+                    continue
+            stale.append(path)
+        return stale, unmeasured
+
+    def close(self):
+        self.closed.set()
+        self.pending.put((-1, -1, None))
+        self.discard_executor()
+
+
+class TrackRelinker:
+    """Find where missing tracks were moved to, by their fingerprints, on a background thread
+
+    A track is looked up first among the other cached files with the same
+    fingerprint, then by searching the nearest folders that still exist and
+    the given extra folders. Files are only hashed if their size could match.
+    """
+
+    def __init__(self, paths, metadata_cache, search_folders=()):
+        self.paths = list(paths)
+        self.metadata_cache = metadata_cache
+        self.search_folders = [folder for folder in search_folders if folder]
+        self.relinked = {}
+        self.taken = set()
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def is_done(self):
+        return self.finished.is_set()
+
+    def run(self):
+        try:
+            wanted = {}
+            for path in self.paths:
+                entry = self.metadata_cache.peek(path)
+                if entry is None or not entry.get('fingerprint'):
+                    continue
+                new_path = self.find_cached(path, entry['fingerprint'])
+                if new_path is not None:
+                    self.relinked[path] = new_path
+                    self.taken.add(new_path)
+                else:
+                    wanted.setdefault(entry['fingerprint'], []).append(path)
+            if wanted:
+                self.search(wanted)
+        finally:
+            self.finished.set()
+
+    def find_cached(self, path, fingerprint):
+        """Another cached file with this fingerprint that still exists"""
+        for candidate in self.metadata_cache.find_fingerprint(fingerprint):
+            if candidate != path and candidate not in self.taken and os.path.exists(candidate):
+                return candidate
+        return None
+
+    def search(self, wanted):
+        """Hash files of a matching size under nearby folders until every fingerprint is found"""
+        lengths = {fingerprint_length(fingerprint) for fingerprint in wanted}
+        extensions = {os.path.splitext(path)[1].lower() for paths in wanted.values() for path in paths}
+        seen = set()
+        checked = 0
+        for folder in self.get_search_roots(wanted):
+            if folder in seen:
+                continue
+            for dirpath, dirnames, filenames in os.walk(folder):
+                dirnames[:] = [name for name in dirnames if os.path.join(dirpath, name) not in seen]
+                seen.add(dirpath)
+                for name in filenames:
+                    if self.cancelled.is_set() or not wanted or checked >= RELINK_MAX_FILES:
+                        return
+                    checked += 1
+                    if os.path.splitext(name)[1].lower() not in extensions:
+                        continue
+                    file_path = os.path.join(dirpath, name)
+                    try:
+                        # The audio is never longer than the file
+                        if os.path.getsize(file_path) < min(lengths):
+                            continue
+                        fingerprint = compute_fingerprint(file_path)
+                    except OSError:
+                        continue
+                    paths = wanted.get(fingerprint)
+                    if paths and file_path not in self.taken:
+                        self.relinked[paths.pop()] = file_path
+                        self.taken.add(file_path)
+                        if not paths:
+                            del wanted[fingerprint]
+
+    def get_search_roots(self, wanted):
+        """The nearest existing folder above each missing track, then the extra folders"""
+        roots = []
+        for paths in wanted.values():
+            for path in paths:
+                folder = os.path.dirname(path)
+                while folder and not os.path.isdir(folder):
+                    parent = os.path.dirname(folder)
+                    if parent == folder:
+                        break
+                    folder = parent
+                if os.path.isdir(folder) and os.path.dirname(folder) != folder:
+                    roots.append(folder)
+        roots.extend(self.search_folders)
+        return list(dict.fromkeys(roots))
+
+
+class LibraryWatcher:
+    """Watch a folder tree on a background thread for audio files being added, removed or renamed
+
+    Uses inotify where available. Elsewhere it polls, but each poll only stats
+    the known folders and lists again just those whose mtime changed. Changes
+    are collected with get_changes() as tuples:
+      ('added', path) | ('removed', path) | ('moved', old_path, new_path)
+      ('removed_folder', path) | ('moved_folder', old_path, new_path)
+    """
+
+    # inotify event flags, from <sys/inotify.h>
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, folder_path, poll_interval=WATCH_POLL_INTERVAL):
+        self.folder_path = folder_path
+        self.poll_interval = poll_interval
+        self.changes = queue.Queue()
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.libc = None
+        self.watches = {}
+        self.folders = {}
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def get_changes(self):
+        """Collect the changes seen so far"""
+        changes = []
+        while True:
+            try:
+                changes.append(self.changes.get_nowait())
+            except queue.Empty:
+                return changes
+
+    def run(self):
+        fd = None
+        try:
+            fd = self.open_inotify()
+            if fd is not None:
+                self.add_watches(fd, self.folder_path)
+                self.watch_inotify(fd)
+                return
+        except OSError as e:
+            # For example when the inotify watch limit is reached
+            print(f"Could not watch {self.folder_path} with inotify, polling instead: {e}")
+        finally:
+            if fd is not None:
+                os.close(fd)
+        self.watch_polling()
+
+    def report(self, change):
+        if not self.cancelled.is_set():
+            self.changes.put(change)
+
+    def open_inotify(self):
+        """An inotify file descriptor, or None on platforms without inotify"""
+        if not sys.platform.startswith('linux'):
+            return None
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            return None
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.libc = libc
+        return fd
+
+    def add_watches(self, fd, folder_path, report_files=False):
+        """Watch a folder and its subfolders, optionally reporting the audio files in them as added"""
+        import ctypes
+        folders = [folder_path]
+        while folders and not self.cancelled.is_set():
+            path = folders.pop()
+            wd = self.libc.inotify_add_watch(fd, os.fsencode(path), self.WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, "inotify watch limit reached")
+                continue
+            self.watches[wd] = path
+            # Listing after adding the watch means nothing created meanwhile is missed
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            folders.append(entry.path)
+                        elif report_files and entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                            self.report(('added', entry.path))
+            except OSError:
+                pass
+
+    def remove_watches(self, fd, folder_path):
+        """Stop watching a folder that left the tree, and everything under it"""
+        prefix = os.path.join(folder_path, '')
+        for wd, path in list(self.watches.items()):
+            if path == folder_path or path.startswith(prefix):
+                self.libc.inotify_rm_watch(fd, wd)
+                del self.watches[wd]
+
+    def rename_watches(self, old_path, new_path):
+        """Watches follow a moved folder, so only the paths they map to change"""
+        prefix = os.path.join(old_path, '')
+        for wd, path in self.watches.items():
+            if path == old_path:
+                self.watches[wd] = new_path
+            elif path.startswith(prefix):
+                self.watches[wd] = os.path.join(new_path, path[len(prefix):])
+
+    def watch_inotify(self, fd):
+        while not self.cancelled.is_set():
+            ready, _, _ = select.select([fd], [], [], 0.5)
+            if not ready:
+                continue
+            try:
+                data = os.read(fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            self.handle_events(fd, data)
+
+    def handle_events(self, fd, data):
+        """Turn a buffer of inotify events into changes, pairing the two halves of renames"""
+        moved_from = {}
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+
+            if mask & self.IN_Q_OVERFLOW:
+                print(f"Too many changes in {self.folder_path} at once; some were missed")
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            folder_path = self.watches.get(wd)
+            if folder_path is None or not name:
+                continue
+
+            path = os.path.join(folder_path, os.fsdecode(name))
+            is_dir = bool(mask & self.IN_ISDIR)
+            is_audio = not is_dir and path.lower().endswith(AUDIO_EXTENSIONS)
+            if mask & self.IN_MOVED_FROM:
+                moved_from[cookie] = (path, is_dir)
+            elif mask & self.IN_MOVED_TO:
+                source = moved_from.pop(cookie, None)
+                if source is None:
+                    # Moved in from outside the tree
+                    if is_dir:
+                        self.add_watches(fd, path, report_files=True)
+                    elif is_audio:
+                        self.report(('added', path))
+                elif is_dir:
+                    self.rename_watches(source[0], path)
+                    self.report(('moved_folder', source[0], path))
+                elif source[0].lower().endswith(AUDIO_EXTENSIONS):
+                    self.report(('moved', source[0], path) if is_audio else ('removed', source[0]))
+                elif is_audio:
+                    self.report(('added', path))
+            elif mask & self.IN_CREATE:
+                # Files are reported once written (IN_CLOSE_WRITE); folders right away
+                if is_dir:
+                    self.add_watches(fd, path, report_files=True)
+            elif mask & self.IN_CLOSE_WRITE:
+                if is_audio:
+                    self.report(('added', path))
+            elif mask & self.IN_DELETE:
+                if is_dir:
+                    self.report(('removed_folder', path))
+                elif is_audio:
+                    self.report(('removed', path))
+
+        # Moved out of the tree
+        for path, is_dir in moved_from.values():
+            if is_dir:
+                self.remove_watches(fd, path)
+                self.report(('removed_folder', path))
+            elif path.lower().endswith(AUDIO_EXTENSIONS):
+                self.report(('removed', path))
+
+    def watch_polling(self):
+        self.scan_folders(self.folder_path)
+        while not self.cancelled.wait(self.poll_interval):
+            self.poll_folders()
+
+    def list_folder(self, folder_path):
+        """Audio files and subfolders of a folder, as {name: (inode, is_dir)}"""
+        listing = {}
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        listing[entry.name] = (entry.inode(), True)
+                    elif entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                        listing[entry.name] = (entry.inode(), False)
+                except OSError:
+                    pass
+        return listing
+
+    def scan_folders(self, folder_path, report_files=False):
+        """Remember the listing and mtime of a folder and its subfolders"""
+        folders = [folder_path]
+        while folders and not self.cancelled.is_set():
+            path = folders.pop()
+            try:
+                # Take the mtime first, so a change made while listing shows up next poll
+                mtime = os.stat(path).st_mtime
+                listing = self.list_folder(path)
+            except OSError:
+                continue
+            self.folders[path] = (mtime, listing)
+            for name, (inode, is_dir) in listing.items():
+                if is_dir:
+                    folders.append(os.path.join(path, name))
+                elif report_files:
+                    self.report(('added', os.path.join(path, name)))
+
+    def poll_folders(self):
+        """List again the folders whose mtime changed, pairing removals and additions into renames"""
+        removed = {}
+        added = {}
+        for folder_path, (mtime, listing) in list(self.folders.items()):
+            try:
+                current_mtime = os.stat(folder_path).st_mtime
+                if current_mtime == mtime:
+                    continue
+                current_listing = self.list_folder(folder_path)
+            except OSError:
+                # Gone; its parent's listing reports that
+                continue
+            self.folders[folder_path] = (current_mtime, current_listing)
+            for name in listing.keys() - current_listing.keys():
+                inode, is_dir = listing[name]
+                removed[inode, is_dir] = os.path.join(folder_path, name)
+            for name in current_listing.keys() - listing.keys():
+                added[current_listing[name]] = os.path.join(folder_path, name)
+
+        for (inode, is_dir), path in added.items():
+            source = removed.pop((inode, is_dir), None)
+            if is_dir and source:
+                self.rename_folders(source, path)
+                self.report(('moved_folder', source, path))
+            elif is_dir:
+                self.scan_folders(path, report_files=True)
+            elif source:
+                self.report(('moved', source, path))
+            else:
+                self.report(('added', path))
+
+        for (inode, is_dir), path in removed.items():
+            if is_dir:
+                self.forget_folders(path)
+                self.report(('removed_folder', path))
+            else:
+                self.report(('removed', path))
+
+    def rename_folders(self, old_path, new_path):
+        prefix = os.path.join(old_path, '')
+        for path in list(self.folders):
+            if path == old_path:
+                self.folders[new_path] = self.folders.pop(path)
+            elif path.startswith(prefix):
+                self.folders[os.path.join(new_path, path[len(prefix):])] = self.folders.pop(path)
+
+    def forget_folders(self, folder_path):
+        prefix = os.path.join(folder_path, '')
+        for path in list(self.folders):
+            if path == folder_path or path.startswith(prefix):
+                del self.folders[path]
+
+
+class SearchIndex:
+    """Inverted word index over file names, folders and cached tags, for filtering the playlist
+
+    Tracks are indexed under their stable track table ids, so reordering the
+    playlist only remaps ids to positions instead of re-indexing. Query terms
+    match word prefixes. The words of new tracks can be worked out elsewhere
+    with build_postings (see SearchIndexer) and merged in batches.
+    """
+
+    NOT_INDEXED, INDEXED, TAGGED, QUEUED = range(4)
+
+    def __init__(self, tracks):
+        self.tracks = tracks
+        self.indexed = bytearray()
+        self.words = {}
+        self.vocabulary = []
+        self.vocabulary_dirty = False
+        self.term_cache = {}
+        # Tags read while their track was queued, applied once it is merged
+        self.late_tags = {}
+        self.positions = None
+        self.more_positions = None
+        self.ids_in_order = None
+        self.absent_ids = None
+
+    def add(self, playlist, get_tags=None):
+        """Index a TrackList's tracks not seen before; get_tags(paths) returns {path: metadata entry}"""
+        new_ids = self.take_new_ids(playlist)
+        if new_ids:
+            self.merge(self.build_postings(self.tracks, new_ids, get_tags))
+
+    def take_new_ids(self, playlist):
+        """Ids of a TrackList's tracks not indexed yet, marked as queued so they are only taken once"""
+        indexed = self.indexed
+        if len(indexed) < len(self.tracks):
+            indexed.extend(bytes(len(self.tracks) - len(indexed)))
+        new_ids = [track_id for track_id in dict.fromkeys(playlist.ids) if not indexed[track_id]]
+        for track_id in new_ids:
+            indexed[track_id] = self.QUEUED
+        return new_ids
+
+    @classmethod
+    def build_postings(cls, tracks, track_ids, get_tags=None):
+        """(track ids, their states, {word: ids}) for merge; only reads the track table, so any thread can call it"""
+        paths = list(map(tracks.get_path, track_ids))
+        tags = get_tags(paths) if get_tags else {}
+        states = bytearray(len(track_ids))
+        words = {}
+        for position, (track_id, path) in enumerate(zip(track_ids, paths)):
+            entry = tags.get(path)
+            states[position] = cls.TAGGED if entry and entry.get('title') else cls.INDEXED
+            for word in set(SEARCH_WORD_PATTERN.findall(cls.get_text(path, entry).lower())):
+                postings = words.get(word)
+                if postings is None:
+                    postings = words[word] = array('l')
+                postings.append(track_id)
+        return track_ids, states, words
+
+    def merge(self, batch):
+        """Add a batch of tracks indexed by build_postings"""
+        track_ids, states, words = batch
+        for word, track_ids_with_word in words.items():
+            postings = self.words.get(word)
+            if postings is None:
+                self.words[word] = track_ids_with_word
+                self.vocabulary_dirty = True
+            else:
+                postings.extend(track_ids_with_word)
+        for track_id, state in zip(track_ids, states):
+            self.indexed[track_id] = state
+        self.term_cache.clear()
+        late_tags, self.late_tags = self.late_tags, {}
+        for path, entry in late_tags.items():
+            self.update_tags(path, entry)
+
+    def update_tags(self, path, entry):
+        """Add the words of tags that were read after the track was indexed"""
+        track_id = self.tracks.find(path)
+        if track_id is None or track_id >= len(self.indexed):
+            return
+        if self.indexed[track_id] == self.QUEUED:
+            self.late_tags[path] = entry
+            return
+        if self.indexed[track_id] != self.INDEXED or not entry or not entry.get('title'):
+            return
+        self.indexed[track_id] = self.TAGGED
+        self.index_words(track_id, self.get_text(path, entry))
+
+    @staticmethod
+    def get_text(path, entry):
+        """Searchable text: file name, album and artist folders, and tags if known"""
+        folder, filename = os.path.split(path)
+        parts = [os.path.splitext(filename)[0], os.path.basename(folder), os.path.basename(os.path.dirname(folder))]
+        if entry:
+            parts.extend(entry.get(field) or '' for field in ('title', 'artist', 'album'))
+        return ' '.join(parts)
+
+    def index_words(self, track_id, text):
+        for word in set(SEARCH_WORD_PATTERN.findall(text.lower())):
+            postings = self.words.get(word)
+            if postings is None:
+                postings = self.words[word] = array('l')
+                self.vocabulary_dirty = True
+            postings.append(track_id)
+        self.term_cache.clear()
+
+    def invalidate_positions(self):
+        """The playlist was reordered or changed; positions are remapped on the next search"""
+        self.positions = None
+        self.more_positions = None
+        self.ids_in_order = None
+        self.absent_ids = None
+
+    def prepare(self, playlist):
+        """Do the work the next search would otherwise start with, e.g. while the UI is idle"""
+        if self.vocabulary_dirty:
+            self.vocabulary = sorted(self.words)
+            self.vocabulary_dirty = False
+        if self.positions is None:
+            self.sync_positions(playlist)
+
+    def search(self, query, playlist):
+        """SearchMatches for the tracks matching every term of query, or None if it is empty"""
+        terms = set(SEARCH_WORD_PATTERN.findall(query.lower()))
+        if not terms:
+            return None
+
+        # Longer terms usually match fewer tracks, so intersect those first
+        matches = None
+        for term in sorted(terms, key=len, reverse=True):
+            track_ids = self.match_term(term)
+            matches = track_ids if matches is None else matches & track_ids
+            if not matches:
+                return SearchMatches(0, iter(()))
+
+        if self.positions is None:
+            self.sync_positions(playlist)
+        present = len(matches) - len(matches & self.absent_ids) if self.absent_ids else len(matches)
+        # Tracks in the playlist more than once get a row for every copy
+        more_positions = [index for track_id, indexes in self.more_positions.items() if track_id in matches
+                          for index in indexes]
+        count = present + len(more_positions)
+        if count * 8 > len(self.ids_in_order):
+            # Most tracks match: walk the playlist in order as rows are needed, rather
+            # than sorting every match up front
+            return SearchMatches(count, compress(range(len(self.ids_in_order)),
+                                                 map(matches.__contains__, self.ids_in_order)))
+        positions = sorted(map(self.positions.__getitem__, matches))
+        # Tracks that are no longer in the playlist sort first with position -1
+        positions = positions[len(positions) - present:]
+        if more_positions:
+            positions = sorted(positions + more_positions)
+        return SearchMatches(count, iter(positions))
+
+    def match_term(self, term):
+        """Ids of the tracks with a word starting with term"""
+        track_ids = self.term_cache.get(term)
+        if track_ids is not None:
+            return track_ids
+
+        if self.vocabulary_dirty:
+            self.vocabulary = sorted(self.words)
+            self.vocabulary_dirty = False
+        track_ids = set()
+        for position in range(bisect.bisect_left(self.vocabulary, term), len(self.vocabulary)):
+            word = self.vocabulary[position]
+            if not word.startswith(term):
+                break
+            track_ids.update(self.words[word])
+
+        # Typing refines a query one character at a time, so keep recent terms
+        if len(self.term_cache) >= 64:
+            self.term_cache.clear()
+        self.term_cache[term] = track_ids
+        return track_ids
+
+    def sync_positions(self, playlist):
+        """Map ids to positions in the playlist (-1 if not in it) and back
+
+        A track in the playlist more than once has its first position in
+        positions, and the others in more_positions.
+        """
+        ids_in_order = array('l', playlist.ids)
+        positions = array('l', [-1]) * len(self.tracks)
+        more_positions = {}
+        for index, track_id in enumerate(ids_in_order):
+            if positions[track_id] < 0:
+                positions[track_id] = index
+            else:
+                more_positions.setdefault(track_id, []).append(index)
+        self.positions = positions
+        self.more_positions = more_positions
+        self.ids_in_order = ids_in_order
+        self.absent_ids = set(compress(range(len(positions)), map((-1).__eq__, positions)))
+
+
+class SearchIndexer:
+    """Work out the search words of new tracks on a background thread, in batches for SearchIndex.merge"""
+
+    def __init__(self, tracks, get_tags=None, batch_size=SEARCH_INDEX_BATCH_SIZE):
+        self.tracks = tracks
+        self.get_tags = get_tags
+        self.batch_size = batch_size
+        self.requests = queue.Queue()
+        self.batches = queue.Queue()
+        # Tracks submitted and not collected yet; only used by the submitting thread
+        self.pending = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, track_ids):
+        self.pending += len(track_ids)
+        self.requests.put(track_ids)
+
+    def run(self):
+        while True:
+            track_ids = self.requests.get()
+            if track_ids is None:
+                break
+            for start in range(0, len(track_ids), self.batch_size):
+                self.batches.put(SearchIndex.build_postings(
+                    self.tracks, track_ids[start:start + self.batch_size], self.get_tags
+                ))
+
+    def get_batches(self):
+        """Collect the batches indexed so far"""
+        batches = []
+        while True:
+            try:
+                batches.append(self.batches.get_nowait())
+            except queue.Empty:
+                break
+        self.pending -= sum(len(batch[0]) for batch in batches)
+        return batches
+
+    def is_done(self):
+        return self.pending == 0
+
+    def close(self):
+        self.requests.put(None)
+
+
+class SearchMatches:
+    """Playlist indexes matching a search, in order, produced as rows are asked for"""
+
+    def __init__(self, count, indexes):
+        self.count = count
+        self.indexes = indexes
+        self.found = []
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, row):
+        if row >= len(self.found):
+            self.found.extend(islice(self.indexes, max(256, row + 1 - len(self.found))))
+        return self.found[row]
+
+    def row_of(self, index):
+        """The row showing a playlist index, or -1 if it doesn't match or hasn't been reached yet"""
+        row = bisect.bisect_left(self.found, index)
+        if row < len(self.found) and self.found[row] == index:
+            return row
+        return -1
+
+
+class DuplicateMatches(SearchMatches):
+    """Playlist indexes of duplicate tracks, with each group of copies kept together"""
+
+    def __init__(self, groups):
+        indexes = [index for group in groups for index in group]
+        super().__init__(len(indexes), iter(()))
+        self.found = indexes
+        self.rows = {index: row for row, index in enumerate(indexes)}
+
+    def row_of(self, index):
+        return self.rows.get(index, -1)
+
+
+class VirtualListbox(tk.Listbox):
+    """Listbox that only renders the rows in view, asking get_text(index) for each row"""
+
+    def __init__(self, master, get_text, **kwargs):
+        super().__init__(master, **kwargs)
+        self.get_text = get_text
+        self.count = 0
+        self.top = 0
+        self.rows = int(kwargs.get('height', 10))
+        self.selected = -1
+        self.scrollbar = None
+        
+        # Matches Tk's own row height: linespace + 1 + 2 * selectborderwidth
+        font = tkfont.Font(font=self.cget('font'))
+        self.line_height = (font.metrics('linespace') + 1 +
+                            2 * self.winfo_pixels(str(self.cget('selectborderwidth'))))
+        self.inset = (self.winfo_pixels(str(self.cget('borderwidth'))) +
+                      self.winfo_pixels(str(self.cget('highlightthickness'))))
+        
+        self.bind('<Configure>', self.on_resize)
+        self.bind('<<ListboxSelect>>', self.on_select)
+        self.bind('<MouseWheel>', self.on_mousewheel)
+        self.bind('<Button-4>', lambda e: self.scroll_rows(-3))
+        self.bind('<Button-5>', lambda e: self.scroll_rows(3))
+        self.bind('<Up>', lambda e: self.move_selection(-1))
+        self.bind('<Down>', lambda e: self.move_selection(1))
+        self.bind('<Prior>', lambda e: self.move_selection(-self.rows))
+        self.bind('<Next>', lambda e: self.move_selection(self.rows))
+
+    def set_scrollbar(self, scrollbar):
+        """Drive a scrollbar from the virtual scroll position"""
+        self.scrollbar = scrollbar
+        scrollbar.config(command=self.yview)
+        self.update_scrollbar()
+
+    def set_count(self, count):
+        """Set the number of items and redraw the visible rows"""
+        self.count = count
+        if self.selected >= count:
+            self.selected = -1
+        self.clamp_top()
+        self.render()
+
+    def render(self):
+        """Redraw every visible row"""
+        self.delete(0, tk.END)
+        end = min(self.count, self.top + self.rows)
+        if end > self.top:
+            self.insert(tk.END, *[self.get_text(i) for i in range(self.top, end)])
+        if self.top <= self.selected < end:
+            self.selection_set(self.selected - self.top)
+        self.update_scrollbar()
+
+    def refresh_row(self, index):
+        """Redraw a single row if it is in view"""
+        if not (self.top <= index < min(self.count, self.top + self.rows)):
+            return
+        row = index - self.top
+        self.delete(row)
+        self.insert(row, self.get_text(index))
+        if index == self.selected:
+            self.selection_set(row)
+
+    def select_index(self, index):
+        """Select an item by its index in the full list"""
+        if self.top <= self.selected < self.top + self.rows:
+            self.selection_clear(self.selected - self.top)
+        self.selected = index
+        if self.top <= index < self.top + self.rows:
+            self.selection_set(index - self.top)
+
+    def selected_index(self):
+        """Return the index of the selected item, or -1"""
+        return self.selected
+
+    def index_at(self, y):
+        """Index in the full list of the item nearest a y coordinate, or -1"""
+        row = self.nearest(y)
+        return self.top + row if 0 <= row < self.count - self.top else -1
+
+    def see_index(self, index):
+        """Scroll so that an item is in view"""
+        if index < self.top:
+            self.top = index
+        elif index >= self.top + self.rows:
+            self.top = index - self.rows + 1
+        else:
+            return
+        self.clamp_top()
+        self.render()
+
+    def yview(self, *args):
+        """Scrollbar protocol, applied to the virtual list instead of the widget"""
+        if not args:
+            if not self.count:
+                return (0.0, 1.0)
+            return (self.top / self.count, min(1.0, (self.top + self.rows) / self.count))
+        if args[0] == 'moveto':
+            self.top = int(float(args[1]) * self.count)
+        elif args[0] == 'scroll':
+            amount = int(args[1])
+            self.top += amount * self.rows if args[2] == 'pages' else amount
+        self.clamp_top()
+        self.render()
+
+    def scroll_rows(self, amount):
+        self.yview('scroll', amount, 'units')
+        return "break"
+
+    def clamp_top(self):
+        self.top = max(0, min(self.top, self.count - self.rows))
+
+    def update_scrollbar(self):
+        if self.scrollbar:
+            self.scrollbar.set(*self.yview())
+
+    def on_resize(self, event):
+        """Recompute how many rows fit in the widget"""
+        rows = max(1, (event.height - 2 * self.inset) // self.line_height)
+        if rows != self.rows:
+            self.rows = rows
+            self.clamp_top()
+            self.render()
+
+    def on_select(self, event):
+        selection = self.curselection()
+        if selection:
+            self.selected = self.top + selection[0]
+
+    def on_mousewheel(self, event):
+        # Windows reports multiples of 120, macOS reports small deltas
+        delta = event.delta // 120 if abs(event.delta) >= 120 else event.delta
+        return self.scroll_rows(-3 * delta)
+
+    def move_selection(self, amount):
+        """Move the selection with the keyboard, scrolling as needed"""
+        if not self.count:
+            return "break"
+        index = max(0, min(self.count - 1, self.selected + amount))
+        self.see_index(index)
+        self.select_index(index)
+        self.event_generate('<<ListboxSelect>>')
+        return "break"
+
+
+class WaveformView(tk.Canvas):
+    """Canvas showing a track's waveform, with a line at the playback position
+
+    The waveform is drawn once per track and size; moving the position only
+    moves the line. Clicking calls on_seek with a fraction of the track.
+    """
+
+    def __init__(self, master, colors, on_seek, **kwargs):
+        super().__init__(master, highlightthickness=0, **kwargs)
+        self.colors = colors
+        self.on_seek = on_seek
+        self.peaks = None
+        self.fraction = 0.0
+        self.cursor = None
+        self.bind('<Configure>', lambda event: self.draw())
+        self.bind('<Button-1>', self.on_click)
+
+    def set_peaks(self, peaks):
+        """Show a PeaksFile, or nothing for None"""
+        if self.peaks is not None:
+            self.peaks.close()
+        self.peaks = peaks
+        self.fraction = 0.0
+        self.draw()
+
+    def set_position(self, fraction):
+        self.fraction = fraction
+        if self.cursor is not None:
+            x = round(fraction * self.winfo_width())
+            self.coords(self.cursor, x, 0, x, self.winfo_height())
+
+    def draw(self):
+        self.delete('all')
+        self.cursor = None
+        if self.peaks is None:
+            return
+        width = self.winfo_width()
+        height = self.winfo_height()
+        count = len(self.peaks.peaks)
+        if width <= 1 or count == 0:
+            return
+
+        # One line per pixel column, from the loudest bucket it covers
+        middle = height / 2
+        scale = middle / 255
+        for x in range(width):
+            start = x * count // width
+            end = max(start + 1, (x + 1) * count // width)
+            peak = max(self.peaks.peaks[start:end]) * scale
+            rms = max(self.peaks.rms[start:end]) * scale
+            self.create_line(x, middle - peak, x, middle + peak + 1, fill=self.colors['text_tertiary'])
+            self.create_line(x, middle - rms, x, middle + rms + 1, fill=self.colors['text_secondary'])
+        self.cursor = self.create_line(0, 0, 0, height, fill=self.colors['accent'], width=2)
+        self.set_position(self.fraction)
+
+    def on_click(self, event):
+        if self.peaks is not None and self.winfo_width() > 1:
+            self.on_seek(max(0.0, min(1.0, event.x / self.winfo_width())))
+
+
+class SpliceReader(io.RawIOBase):
+    """Read-only file made of an optional header followed by another file from an offset"""
+
+    def __init__(self, source, offset, header=b''):
+        super().__init__()
+        self.source = source
+        self.offset = offset
+        self.header = header
+        source.seek(0, io.SEEK_END)
+        self.size = len(header) + source.tell() - offset
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = 0
+        if self.position < len(self.header):
+            chunk = self.header[self.position:self.position + len(buffer)]
+            buffer[:len(chunk)] = chunk
+            count = len(chunk)
+        if count < len(buffer) and self.position + count >= len(self.header):
+            self.source.seek(self.offset + self.position + count - len(self.header))
+            chunk = self.source.read(len(buffer) - count)
+            buffer[count:count + len(chunk)] = chunk
+            count += len(chunk)
+        self.position += count
+        return count
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self.position
+        elif whence == io.SEEK_END:
+            position += self.size
+        self.position = max(0, position)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.source.close()
+        super().close()
+
+
+class PlaybackClock:
+    """Track position from time.monotonic(): a base position plus the time since playback resumed"""
+
+    def __init__(self):
+        self.base = 0.0
+        self.started_at = None
+
+    def start(self, position=0.0):
+        """Start running from a position"""
+        self.base = position
+        self.started_at = time.monotonic()
+
+    def pause(self):
+        if self.started_at is not None:
+            self.base = self.position()
+            self.started_at = None
+
+    def resume(self):
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+
+    def reset(self):
+        """Stop at the start of the track"""
+        self.base = 0.0
+        self.started_at = None
+
+    def set(self, position):
+        """Jump to a position, keeping the clock running or paused"""
+        self.base = position
+        if self.started_at is not None:
+            self.started_at = time.monotonic()
+
+    def position(self):
+        if self.started_at is None:
+            return self.base
+        return self.base + time.monotonic() - self.started_at
+
+
+class MusicOutput:
+    """Plays through pygame.mixer.music, which streams and decodes one track at a time"""
+
+    # Seeking can start a new stream at an indexed frame; crossfading isn't possible
+    streaming = True
+    crossfade = 0
+
+    def __init__(self):
+        self.end_event = None
+
+    def init(self, volume):
+        """Set up the end-of-track event once the mixer is open"""
+        self.end_event = pygame.USEREVENT + 1
+        pygame.mixer.music.set_endevent(self.end_event)
+        pygame.mixer.music.set_volume(volume)
+
+    def load(self, file_path, source, duration=0):
+        """Load a track; source is a path, or a file object and its extension"""
+        pygame.mixer.music.load(*source)
+
+    def queue(self, file_path, source, duration=0):
+        """Play a track straight after the current one"""
+        pygame.mixer.music.queue(*source)
+
+    def play(self, start=0.0):
+        pygame.mixer.music.play(start=start)
+
+    def pause(self):
+        pygame.mixer.music.pause()
+
+    def unpause(self):
+        pygame.mixer.music.unpause()
+
+    def stop(self):
+        pygame.mixer.music.stop()
+
+    def set_volume(self, volume):
+        pygame.mixer.music.set_volume(volume)
+
+    def poll(self):
+        """True if the track ended, or the mixer moved on to the queued track"""
+        ended = False
+        for event in pygame.event.get():
+            if event.type == self.end_event:
+                ended = True
+        return ended
+
+    def clear_end_events(self):
+        pygame.event.clear(self.end_event)
+
+    def get_time_until_transition(self):
+        """The end event signals transitions, so there is nothing to wake up early for"""
+        return None
+
+    def close(self):
+        pygame.mixer.music.stop()
+
+
+class BufferedOutput:
+    """Plays tracks decoded into memory on two mixer channels, so one can fade into the next
+
+    The queued track is decoded on a background thread if its decoded size
+    fits the memory budget. A track that wasn't decoded ahead (the first one,
+    or one picked by hand) streams through pygame.mixer.music instead, so
+    loading never decodes a whole file on the caller's thread; the next track
+    then fades in over it or follows it when it ends. With no crossfade a
+    decoded queued track follows on the same channel without a gap.
+    """
+
+    streaming = False
+
+    def __init__(self, crossfade=0, memory_budget=DECODE_AHEAD_MEMORY_BUDGET):
+        self.crossfade = crossfade
+        self.memory_budget = memory_budget
+        self.volume = 0.5
+        self.channels = []
+        self.channel = None
+        self.sound = None  # None while the current track streams through pygame.mixer.music
+        self.file_path = None
+        self.duration = 0
+        self.clock = PlaybackClock()
+        self.queued = None
+        self.queued_sound = None
+        self.queued_on_channel = False
+        self.decoding = None
+        self.spare = None
+        self.decoder = ThreadPoolExecutor(max_workers=1)
+
+    def init(self, volume):
+        """Reserve the two channels tracks alternate between"""
+        self.volume = volume
+        pygame.mixer.set_reserved(2)
+        self.channels = [pygame.mixer.Channel(0), pygame.mixer.Channel(1)]
+        self.channel = self.channels[0]
+
+    def decode(self, source):
+        """Decode a whole track into a Sound"""
+        sound = pygame.mixer.Sound(source[0])
+        sound.set_volume(self.volume)
+        return sound
+
+    def get_frame_size(self):
+        """Bytes per sample frame of the mixer's output"""
+        frequency, sample_format, channels = pygame.mixer.get_init()
+        return channels * (abs(sample_format) // 8)
+
+    def get_bytes_per_second(self):
+        return pygame.mixer.get_init()[0] * self.get_frame_size()
+
+    def load(self, file_path, source, duration=0):
+        """Use the track decoded ahead if it is this one, otherwise stream it"""
+        if self.spare is not None and self.spare[0] == file_path:
+            self.sound = self.spare[1]
+        else:
+            pygame.mixer.music.load(*source)
+            pygame.mixer.music.set_volume(self.volume)
+            self.sound = None
+        self.spare = None
+        self.file_path = file_path
+        self.duration = duration
+
+    def get_length(self):
+        """Length of the current track in seconds, or 0 if unknown"""
+        return self.sound.get_length() if self.sound is not None else self.duration
+
+    def stop_all(self):
+        # Stopping a channel also drops the sound queued on it
+        for channel in self.channels:
+            channel.stop()
+        pygame.mixer.music.stop()
+
+    def queue(self, file_path, source, duration=0):
+        """Start decoding the track that plays after the current one"""
+        self.cancel_queued()
+        self.queued = (file_path, source, duration)
+        if duration * self.get_bytes_per_second() <= self.memory_budget:
+            self.decoding = self.decoder.submit(self.decode, source)
+
+    def cancel_queued(self):
+        """Forget the queued track, keeping it decoded in case it is loaded next"""
+        if self.queued_on_channel and self.channel.get_queue() is not None:
+            # A channel's queued sound can't be removed, only replaced by a silent one
+            self.channel.queue(pygame.mixer.Sound(buffer=bytes(self.get_frame_size())))
+        if self.decoding is not None:
+            self.decoding.cancel()
+        if self.queued is not None and self.queued_sound is not None:
+            self.spare = (self.queued[0], self.queued_sound)
+        self.queued = None
+        self.queued_sound = None
+        self.queued_on_channel = False
+        self.decoding = None
+
+    def play(self, start=0.0):
+        """Play the loaded track from a position in seconds"""
+        self.stop_all()
+        self.queued_on_channel = False
+        if self.sound is None:
+            pygame.mixer.music.play(start=start)
+            self.clock.start(start)
+            return
+        sound = self.sound
+        if start > 0:
+            # Copy out the rest of the track from the first whole frame at
+            # start, reading the samples in place rather than through get_raw
+            offset = int(start * pygame.mixer.get_init()[0]) * self.get_frame_size()
+            with memoryview(self.sound) as samples, samples.cast('B') as data:
+                sound = pygame.mixer.Sound(buffer=data[offset:])
+            sound.set_volume(self.volume)
+        self.channel.play(sound)
+        self.clock.start(start)
+
+    def pause(self):
+        for channel in self.channels:
+            channel.pause()
+        pygame.mixer.music.pause()
+        self.clock.pause()
+
+    def unpause(self):
+        for channel in self.channels:
+            channel.unpause()
+        pygame.mixer.music.unpause()
+        self.clock.resume()
+
+    def stop(self):
+        self.stop_all()
+        self.clock.reset()
+        self.cancel_queued()
+
+    def set_volume(self, volume):
+        """Set the current track's volume; a track fading out keeps its own"""
+        self.volume = volume
+        if self.sound is not None:
+            self.sound.set_volume(volume)
+        else:
+            pygame.mixer.music.set_volume(volume)
+        if self.channel is not None and self.channel.get_sound() is not None:
+            self.channel.get_sound().set_volume(volume)
+
+    def poll(self):
+        """True if the track ended, or playback moved on to the queued track"""
+        if self.channel is None or self.clock.started_at is None:
+            return False
+
+        if self.queued is not None:
+            if self.queued_sound is None and self.decoding is not None and self.decoding.done():
+                try:
+                    self.queued_sound = self.decoding.result()
+                except Exception as e:
+                    print(f"Could not decode next track: {e}")
+                self.decoding = None
+
+            if self.queued_sound is not None and not self.crossfade and self.sound is not None:
+                if not self.queued_on_channel:
+                    self.channel.queue(self.queued_sound)
+                    self.queued_on_channel = True
+                elif self.channel.get_queue() is None:
+                    self.take_queued()
+                    self.clock.start()
+                    return True
+            elif self.crossfade and self.get_length() > 0 and (self.queued_sound is not None or self.decoding is None):
+                # Decoded, or too big to decode and ready to stream
+                remaining = self.get_length() - self.clock.position()
+                if remaining <= self.crossfade:
+                    self.start_queued(max(0.0, remaining))
+                    return True
+
+        if not (self.channel.get_busy() if self.sound is not None else pygame.mixer.music.get_busy()):
+            if self.queued is not None:
+                self.start_queued(0)
+            return True
+        return False
+
+    def get_time_until_transition(self):
+        """Seconds until poll should run to start the crossfade, or None if not crossfading"""
+        if self.queued is None or not self.crossfade or self.get_length() <= 0:
+            return None
+        return self.get_length() - self.clock.position() - self.crossfade
+
+    def take_queued(self):
+        """Make the queued track the current one"""
+        file_path, source, duration = self.queued
+        sound = self.queued_sound
+        if sound is None and self.decoding is not None and self.decoding.done():
+            try:
+                sound = self.decoding.result()
+            except Exception as e:
+                print(f"Could not decode next track: {e}")
+        elif self.decoding is not None:
+            self.decoding.cancel()
+        self.queued = None
+        self.queued_sound = None
+        self.queued_on_channel = False
+        self.decoding = None
+        if sound is None:
+            # Too big to decode ahead, or not decoded yet, so it streams
+            self.load(file_path, source, duration)
+        else:
+            self.sound = sound
+            self.file_path = file_path
+            self.duration = duration
+
+    def start_queued(self, fade):
+        """Start the queued track, fading across if fade is given
+
+        A decoded track starts on the other channel. One that streams takes
+        the place of any track streaming now, so it can only fade in over a
+        decoded one.
+        """
+        old_channel = self.channel
+        old_sound = self.sound
+        fade_ms = int(fade * 1000)
+        self.take_queued()
+        if self.sound is None:
+            if old_sound is None:
+                # Loading the new stream already stopped the old one
+                fade_ms = 0
+            elif fade_ms:
+                old_channel.fadeout(fade_ms)
+            else:
+                old_channel.stop()
+            pygame.mixer.music.play(fade_ms=fade_ms)
+        else:
+            self.channel = self.channels[1] if old_channel is self.channels[0] else self.channels[0]
+            if old_sound is None and fade_ms:
+                pygame.mixer.music.fadeout(fade_ms)
+            elif old_sound is None:
+                pygame.mixer.music.stop()
+            elif fade_ms:
+                old_channel.fadeout(fade_ms)
+            else:
+                old_channel.stop()
+            self.channel.play(self.sound, fade_ms=fade_ms)
+        self.clock.start()
+
+    def clear_end_events(self):
+        pass
+
+    def close(self):
+        self.stop()
+        self.decoder.shutdown(wait=False, cancel_futures=True)
+
+
+class PlaybackListener:
+    """Receives updates from a PlaybackEngine; front ends override what they need"""
+
+    def on_track_changed(self, old_index):
+        """A different track is now loaded"""
+
+    def on_playback_state_changed(self):
+        """Playback started, paused or stopped"""
+
+    def on_playlist_changed(self):
+        """Tracks were added, removed or reordered"""
+
+    def on_status(self, text, level):
+        """A status message; level is one of the theme color names"""
+
+
+class PlaybackEngine:
+    """Playlist, play modes and mixer control, independent of any UI"""
+
+    def __init__(self, listener=None, output=None):
+        self.listener = listener or PlaybackListener()
+        self.output = output or MusicOutput()
+        self.audio_ready = False
+
+        # Variables
+        self.track_table = TrackTable()
+        self.playlist = TrackList(self.track_table)
+        self.current_index = -1
+        self.current_file = None
+        self.is_playing = False
+        self.is_paused = False
+        self.volume = 0.5
+        self.replaygain = True
+        self.track_gain = 1.0
+        self.shuffle_mode = False
+        self.repeat_mode = False
+        self.gapless_mode = False
+        self.next_index = None
+        self.queued_index = None
+        self.shuffle_order = None
+        # Tracks picked to play next, and where the playlist order resumes once they have played
+        self.play_queue = []
+        self.play_queue_index = None
+        self.resume_index = None
+        self.song_length = 0
+        self.clock = PlaybackClock()
+
+        self.playlist_file = os.path.expanduser("~/.audion_playlist.json")
+        self.playlist_store = PlaylistStore(os.path.expanduser("~/.audion_playlist.db"), self.playlist_file)
+        self.playlist_id = self.playlist_store.get_active()
+        # Appends to the saved playlist each get their own key, so none replaces another
+        self.append_keys = count()
+
+        # Settings carried over from the last run
+        self.persistence = PersistenceService(os.path.expanduser("~/.audion_config.json"))
+        self.volume = self.persistence.get('volume', self.volume)
+        self.shuffle_mode = self.persistence.get('shuffle', self.shuffle_mode)
+        self.repeat_mode = self.persistence.get('repeat', self.repeat_mode)
+        self.gapless_mode = self.persistence.get('gapless', self.gapless_mode)
+
+        self.metadata_cache = MetadataCache(os.path.expanduser("~/.audion_metadata.db"))
+        self.prefetcher = TrackPrefetcher()
+        self.analyzer = TrackAnalyzer(self.metadata_cache, os.path.expanduser("~/.audion_peaks"))
+
+    def init_audio(self):
+        """Import pygame and open the mixer; called once the UI is up, or on first use"""
+        if self.audio_ready:
+            return
+        import_pygame()
+
+        # Initialize pygame mixer only (not the full pygame which includes video).
+        # The event queue that delivers the end-of-track event needs the display
+        # module, but no pygame window is ever opened.
+        pygame.mixer.init()
+        pygame.display.init()
+        self.output.init(self.volume)
+        self.audio_ready = True
+
+    def close(self):
+        """Stop playback and release resources"""
+        if self.is_playing or self.is_paused:
+            self.save_resume_position()
+        if self.audio_ready:
+            self.output.close()
+        self.prefetcher.close()
+        self.analyzer.close()
+        # Write what is still pending before the playlist database closes
+        self.persistence.close()
+        self.metadata_cache.close()
+        self.playlist_store.close()
+
+    def get_song_length(self, file_path):
+        """Get the length of the audio file in seconds"""
+        entry = self.metadata_cache.get(file_path)
+        if entry and entry['duration']:
+            return entry['duration']
+        return 0
+
+    def get_track_title(self, file_path):
+        """Get a display title from cached tags, falling back to the file name"""
+        return self.format_title(self.metadata_cache.get(file_path)) or os.path.basename(file_path)
+
+    @staticmethod
+    def format_title(entry):
+        """"Artist - Title" from a metadata entry, or None if it has no title"""
+        if entry and entry['title']:
+            if entry['artist']:
+                return f"{entry['artist']} - {entry['title']}"
+            return entry['title']
+        return None
+
+    def export_playlist(self, file_path):
+        """Save the playlist as an M3U, M3U8 or PLS file with the durations and titles already cached
+
+        Returns the number of tracks written.
+        """
+        cached = self.metadata_cache.peek_many(self.playlist)
+        return write_playlist_file(file_path, (
+            (path, entry.get('duration'), self.format_title(entry)) if entry else (path, None, None)
+            for path, entry in zip(self.playlist, map(cached.get, self.playlist))
+        ))
+
+    def get_status(self):
+        """Snapshot of the playback state"""
+        if self.is_playing:
+            state = 'playing'
+        elif self.is_paused:
+            state = 'paused'
+        else:
+            state = 'stopped'
+        return {
+            'state': state,
+            'index': self.current_index,
+            'file': self.current_file,
+            'title': self.get_track_title(self.current_file) if self.current_file else None,
+            'position': round(self.get_playback_position(), 2) if self.current_file else 0,
+            'length': round(self.song_length, 2),
+            'tracks': len(self.playlist),
+            'playlist': self.get_playlist_name(),
+            'queue': len(self.play_queue),
+            'volume': round(self.volume * 100),
+            'shuffle': self.shuffle_mode,
+            'repeat': self.repeat_mode,
+            'gapless': self.gapless_mode,
+            'crossfade': self.output.crossfade,
+            'replaygain': self.replaygain,
+        }
+
+    def set_playlist(self, paths, current_index=-1):
+        """Replace the playlist; playback of the current track is not touched"""
+        self.playlist = TrackList(self.track_table, paths)
+        self.current_index = current_index
+        self.next_index = None
+        self.resume_index = None
+        self.reset_shuffle_order()
+        self.save_playlist()
+        self.analyzer.submit(paths)
+        self.listener.on_playlist_changed()
+
+    def append_tracks(self, paths):
+        """Add tracks to the end of the playlist"""
+        self.playlist.extend(paths)
+        self.append_to_saved_playlist(paths)
+        self.analyzer.submit(paths)
+        if self.current_index >= 0 and self.queued_index is None:
+            self.refresh_queued_track()
+        self.listener.on_playlist_changed()
+
+    def remove_tracks(self, indexes):
+        """Remove tracks by index, keeping the current track selected
+
+        If the current track itself is removed, it stops and the track that
+        followed it (or the last one) is loaded in its place, ready to play.
+        """
+        current_removed = self.current_index in indexes
+        removed_before = sum(1 for index in indexes if index < self.current_index)
+        self.playlist.remove_indexes(indexes)
+        self.current_index -= removed_before
+        self.resume_index = None
+        self.play_queue_index = None
+        self.reset_shuffle_order()
+        if current_removed:
+            self.stop()
+            self.current_file = None
+            self.song_length = 0
+            self.current_index = min(self.current_index, len(self.playlist) - 1)
+        self.refresh_queued_track()
+        self.save_playlist()
+        self.listener.on_playlist_changed()
+        if current_removed and self.playlist:
+            self.load_song(self.current_index)
+
+    def apply_library_changes(self, changes):
+        """Update the playlist and metadata cache for files added, removed or renamed on disk
+
+        changes are LibraryWatcher tuples. Returns (added, removed) track counts.
+        """
+        added = {}
+        removed = set()
+        removed_folders = []
+        renamed = {}
+        renamed_folders = []
+        for change in changes:
+            kind, path = change[0], change[1]
+            if kind == 'added':
+                removed.discard(path)
+                added[path] = True
+            elif kind == 'removed':
+                self.metadata_cache.remove(path)
+                if added.pop(path, None) is None:
+                    removed.add(path)
+            elif kind == 'moved':
+                new_path = change[2]
+                self.metadata_cache.rename(path, new_path)
+                if added.pop(path, None) is not None:
+                    added[new_path] = True
+                else:
+                    # Follow a track renamed more than once
+                    original = next((old for old, new in renamed.items() if new == path), path)
+                    renamed[original] = new_path
+            elif kind == 'removed_folder':
+                self.metadata_cache.remove(path, folder=True)
+                prefix = os.path.join(path, '')
+                added = {file_path: True for file_path in added if not file_path.startswith(prefix)}
+                removed_folders.append(prefix)
+            elif kind == 'moved_folder':
+                self.metadata_cache.rename(path, change[2], folder=True)
+                old_prefix = os.path.join(path, '')
+                new_prefix = os.path.join(change[2], '')
+                added = {(new_prefix + file_path[len(old_prefix):] if file_path.startswith(old_prefix) else file_path): True
+                         for file_path in added}
+                renamed_folders.append((old_prefix, new_prefix))
+
+        # One pass over the playlist for every removal and rename
+        removed_prefixes = tuple(removed_folders)
+        renamed_prefixes = tuple(old_prefix for old_prefix, new_prefix in renamed_folders)
+        removed_indexes = set()
+        changed = False
+        for index, file_path in enumerate(self.playlist):
+            if file_path in removed or (removed_prefixes and file_path.startswith(removed_prefixes)):
+                removed_indexes.add(index)
+                continue
+            new_path = renamed.get(file_path)
+            if new_path is None and renamed_prefixes and file_path.startswith(renamed_prefixes):
+                for old_prefix, new_prefix in renamed_folders:
+                    if file_path.startswith(old_prefix):
+                        file_path = new_path = new_prefix + file_path[len(old_prefix):]
+            if new_path is not None:
+                self.playlist[index] = new_path
+                if index == self.current_index:
+                    self.current_file = new_path
+                changed = True
+
+        if removed_indexes:
+            self.remove_tracks(removed_indexes)
+        elif changed:
+            self.save_playlist()
+            self.listener.on_playlist_changed()
+
+        known = set(self.playlist)
+        new_paths = sorted(file_path for file_path in added if file_path not in known)
+        if new_paths:
+            self.append_tracks(new_paths)
+        return len(new_paths), len(removed_indexes)
+
+    def relink_tracks(self, relinked):
+        """Point tracks at the files they were moved to; relinked maps old paths to new ones"""
+        for old_path, new_path in relinked.items():
+            # Keep the moved file's own entry if it was already cached
+            if self.metadata_cache.peek(new_path) is None:
+                self.metadata_cache.rename(old_path, new_path)
+            else:
+                self.metadata_cache.remove(old_path)
+
+        changed = 0
+        reload_current = False
+        for index, file_path in enumerate(self.playlist):
+            new_path = relinked.get(file_path)
+            if new_path is not None:
+                self.playlist[index] = new_path
+                if index == self.current_index:
+                    self.current_file = new_path
+                    # The mixer may hold nothing, or the file from before the move
+                    reload_current = not (self.is_playing or self.is_paused)
+                changed += 1
+        if changed:
+            self.refresh_queued_track()
+            self.save_playlist()
+            self.listener.on_playlist_changed()
+            if reload_current:
+                self.load_song(self.current_index)
+        return changed
+
+    def get_waveform(self, file_path):
+        """The track's waveform as a PeaksFile, or None while it is being worked out"""
+        entry = self.metadata_cache.get(file_path)
+        if entry is None:
+            return None
+        if not entry.get('fingerprint'):
+            # Only three small reads, so this doesn't wait for the analyzer
+            try:
+                entry['fingerprint'] = compute_fingerprint(file_path)
+            except OSError:
+                return None
+            self.metadata_cache.put(file_path, entry)
+        peaks_path = self.analyzer.get_peaks_path(entry['fingerprint'])
+        try:
+            return PeaksFile(peaks_path)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Could not read waveform: {e}")
+        self.analyzer.request_waveform(file_path)
+        return None
+
+    def find_duplicates(self):
+        """Groups of playlist indexes whose tracks have the same audio, and how many aren't fingerprinted yet"""
+        cached = self.metadata_cache.peek_many(self.playlist)
+        groups = {}
+        unknown = 0
+        for index, file_path in enumerate(self.playlist):
+            entry = cached.get(file_path)
+            if entry and entry.get('fingerprint'):
+                groups.setdefault(entry['fingerprint'], []).append(index)
+            else:
+                unknown += 1
+        return [group for group in groups.values() if len(group) > 1], unknown
+
+    def sort_playlist(self):
+        """Sort the playlist alphabetically, keeping the current track selected"""
+        self.playlist.sort()
+        if self.current_file in self.playlist:
+            self.current_index = self.playlist.index(self.current_file)
+        self.resume_index = None
+        self.reset_shuffle_order()
+        self.refresh_queued_track()
+        self.save_playlist()
+        self.listener.on_playlist_changed()
+
+    @profiled('load_and_play')
+    def load_and_play(self, index):
+        if 0 <= index < len(self.playlist):
+            file_path = self.playlist[index]
+            try:
+                # Stop current playback (this also drops any queued track)
+                self.init_audio()
+                self.output.stop()
+                self.queued_index = None
+
+                # Load new file, from memory if it was prefetched
+                self.load_music(file_path)
+                self.set_current_track(index)
+
+                # Auto-play
+                self.output.play()
+                self.clock.start()
+                self.clear_end_events()
+                self.is_playing = True
+                self.is_paused = False
+                self.queue_next_track()
+                self.listener.on_playback_state_changed()
+                self.listener.on_status(f"Playing ({index + 1}/{len(self.playlist)})", 'success')
+
+            except Exception as e:
+                self.is_playing = False
+                self.listener.on_playback_state_changed()
+                self.listener.on_status(f"Error: {str(e)}", 'error')
+
+    def load_song(self, index):
+        """Load a song but don't play it automatically (for restoring saved state)"""
+        if 0 <= index < len(self.playlist):
+            file_path = self.playlist[index]
+            try:
+                # Stop current playback
+                self.init_audio()
+                self.output.stop()
+                self.queued_index = None
+
+                # Load new file, from memory if it was prefetched
+                self.load_music(file_path)
+                self.set_current_track(index)
+
+                # Don't auto-play, just set status as ready
+                self.clock.reset()
+                self.clear_end_events()
+                self.is_playing = False
+                self.is_paused = False
+                self.listener.on_playback_state_changed()
+                self.listener.on_status(f"Ready to play ({index + 1}/{len(self.playlist)})", 'accent')
+
+            except Exception as e:
+                self.listener.on_status(f"Error loading song: {str(e)}", 'error')
+
+    def load_music(self, file_path):
+        """Load a track into the mixer, preferring a prefetched in-memory copy"""
+        self.output.load(file_path, self.get_music_source(file_path), self.get_song_length(file_path))
+
+    def get_music_source(self, file_path):
+        """Arguments for pygame's load/queue: an in-memory file if prefetched, else the path"""
+        data = self.prefetcher.get(file_path)
+        if data is None:
+            return (file_path,)
+        # pygame needs the extension to pick a decoder for file objects
+        return (data, os.path.splitext(file_path)[1].lstrip('.'))
+
+    def set_current_track(self, index):
+        """Point the playlist state at a track the mixer has loaded"""
+        file_path = self.playlist[index]
+
+        # Get song length
+        self.song_length = self.get_song_length(file_path)
+
+        self.current_file = file_path
+        self.update_track_gain()
+        old_index = self.current_index
+        self.current_index = index
+        self.next_index = None
+        if index != self.play_queue_index:
+            # Picked by hand, so the playlist order carries on from here
+            self.resume_index = None
+        self.play_queue_index = None
+
+        self.listener.on_track_changed(old_index)
+        self.save_current_index()
+        self.prefetch_upcoming_tracks()
+
+    def queue_next_track(self):
+        """In gapless or crossfade mode, hand the next track to the mixer before this one ends"""
+        self.queued_index = None
+        if not (self.gapless_mode or self.output.crossfade) or not self.is_playing:
+            return
+
+        next_index = self.peek_next_index()
+        if next_index < 0:
+            return
+
+        try:
+            file_path = self.playlist[next_index]
+            self.output.queue(file_path, self.get_music_source(file_path), self.get_song_length(file_path))
+            self.queued_index = next_index
+        except Exception as e:
+            print(f"Could not queue next track: {e}")
+
+    def refresh_queued_track(self):
+        """Re-resolve the next track after the playlist or play modes change"""
+        self.next_index = None
+        self.queue_next_track()
+        self.prefetch_upcoming_tracks()
+
+    def prefetch_upcoming_tracks(self):
+        """Start reading the tracks play_next will choose into memory"""
+        paths = [self.playlist[index] for index in self.predict_next_indexes(PREFETCH_TRACKS)]
+        self.prefetcher.prefetch(paths)
+
+    def advance_to_queued_track(self):
+        """The mixer has moved on to the queued track by itself"""
+        index = self.queued_index
+        self.queued_index = None
+
+        # A mode change may have ended the playlist after the track was queued
+        if self.peek_next_index() != index:
+            self.play_next()
+            return
+
+        # Carry over however far the clock ran past the end of the previous track,
+        # which is at most one poll interval unless the cached duration was wrong
+        overshoot = 0.0
+        if self.song_length > 0:
+            overshoot = min(max(0.0, self.clock.position() - self.song_length),
+                            PROGRESS_INTERVAL_MINIMIZED / 1000)
+        self.consume_next_index()
+        self.set_current_track(index)
+        self.clock.start(overshoot)
+        self.queue_next_track()
+        self.listener.on_playback_state_changed()
+        self.listener.on_status(f"Playing ({index + 1}/{len(self.playlist)})", 'success')
+
+    def play(self):
+        if self.current_file:
+            if self.is_paused:
+                self.output.unpause()
+                self.clock.resume()
+                self.is_paused = False
+            else:
+                # Reload in case a seek left a partial stream in the mixer
+                self.load_music(self.current_file)
+                self.output.play()
+                self.clock.start()
+                self.clear_end_events()
+
+            self.is_playing = True
+            if self.queued_index is None:
+                self.queue_next_track()
+            self.listener.on_playback_state_changed()
+            self.listener.on_status(f"Playing ({self.current_index + 1}/{len(self.playlist)})", 'success')
+
+    def pause(self):
+        if self.is_playing:
+            self.output.pause()
+            self.clock.pause()
+            self.is_paused = True
+            self.is_playing = False
+            self.save_resume_position()
+            self.listener.on_playback_state_changed()
+            self.listener.on_status("Paused", 'warning')
+
+    def stop(self):
+        if self.audio_ready:
+            self.output.stop()
+        self.clock.reset()
+        self.queued_index = None
+        self.clear_end_events()
+        self.is_playing = False
+        self.is_paused = False
+        self.save_resume_position()
+        self.listener.on_playback_state_changed()
+        self.listener.on_status("Stopped", 'text_secondary')
+
+    def seek(self, seek_time):
+        """Jump to a position in the current track, in seconds"""
+        if self.current_file and self.song_length > 0:
+            try:
+                # Start a stream at the nearest indexed frame if the file has a
+                # seek index, so the decoder doesn't scan up to the position.
+                # Decoded tracks can start anywhere already.
+                stream = self.open_at_time(seek_time) if self.output.streaming else None
+                if stream is not None:
+                    reader, seek_time = stream
+                    self.output.load(self.current_file, (reader, os.path.splitext(self.current_file)[1].lstrip('.')))
+                    self.output.play()
+                    # Loading dropped any queued track
+                    self.queued_index = None
+                else:
+                    self.output.play(start=seek_time)
+                self.clear_end_events()
+
+                if self.is_playing:
+                    self.clock.start(seek_time)
+                    if self.queued_index is None:
+                        self.queue_next_track()
+                else:
+                    # Stay paused at the new position, even if we were stopped
+                    self.output.pause()
+                    self.clock.reset()
+                    self.clock.set(seek_time)
+                    self.is_paused = True
+                self.save_resume_position()
+            except Exception as e:
+                # Some formats don't support seeking well
+                print(f"Seek error: {e}")
+
+    def open_at_time(self, seek_time):
+        """A stream of the current track starting near seek_time, or None to let pygame seek"""
+        seek_index = self.metadata_cache.get_seek_index(self.current_file)
+        if not seek_index:
+            return None
+        source = self.prefetcher.get(self.current_file) or open(self.current_file, 'rb')
+        stream = open_at_time(source, seek_index, seek_time, self.song_length)
+        if stream is None:
+            source.close()
+        return stream
+
+    def set_volume(self, volume):
+        """Set the volume from 0.0 to 1.0"""
+        self.volume = volume
+        self.persistence.set('volume', volume)
+        self.apply_volume()
+
+    def apply_volume(self):
+        """Set the mixer volume: the chosen volume, adjusted by the track's gain"""
+        if self.audio_ready:
+            # The mixer can't go louder than full volume, so positive gains are capped there
+            self.output.set_volume(min(1.0, self.volume * self.track_gain))
+
+    def update_track_gain(self):
+        """Look up the current track's ReplayGain, from its tags or the loudness analysis"""
+        gain = None
+        if self.replaygain and self.current_file:
+            entry = self.metadata_cache.peek(self.current_file)
+            gain = entry.get('gain') if entry else None
+        self.track_gain = 10 ** (gain / 20) if gain is not None else 1.0
+        self.apply_volume()
+
+    def set_replaygain(self, enabled):
+        self.replaygain = enabled
+        self.update_track_gain()
+
+    def set_crossfade(self, seconds):
+        """Set how many seconds each track fades into the next; needs the buffered mixer"""
+        if self.output.streaming:
+            raise ValueError("crossfade needs the buffered mixer (--mixer buffered)")
+        self.output.crossfade = max(0.0, seconds)
+        self.refresh_queued_track()
+
+    def set_shuffle(self, enabled):
+        self.shuffle_mode = enabled
+        self.persistence.set('shuffle', enabled)
+        self.refresh_queued_track()
+
+    def set_repeat(self, enabled):
+        self.repeat_mode = enabled
+        self.persistence.set('repeat', enabled)
+        self.refresh_queued_track()
+
+    def set_gapless(self, enabled):
+        self.gapless_mode = enabled
+        self.persistence.set('gapless', enabled)
+        self.refresh_queued_track()
+
+    def peek_next_index(self):
+        """Resolve which track play_next will move to, or -1 at the end of the playlist"""
+        if self.next_index is None:
+            self.next_index = self.choose_next_index()
+        return self.next_index
+
+    def choose_next_index(self):
+        indexes = self.predict_next_indexes(1)
+        return indexes[0] if indexes else -1
+
+    def predict_next_indexes(self, count):
+        """Upcoming tracks in the order play_next will choose them: the queue, then the playlist order"""
+        indexes = self.get_queued_indexes(count)
+        if not self.playlist or len(indexes) >= count:
+            return indexes
+
+        order_index = self.get_order_index()
+        if self.shuffle_mode:
+            return indexes + self.get_shuffle_order().peek(count - len(indexes), order_index)
+
+        following = order_index
+        for _ in range(min(count - len(indexes), len(self.playlist))):
+            following += 1
+            if following >= len(self.playlist):
+                if not self.repeat_mode:
+                    break
+                following = 0
+            indexes.append(following)
+        return indexes
+
+    def get_order_index(self):
+        """The playlist position the playlist order continues from"""
+        return self.current_index if self.resume_index is None else self.resume_index
+
+    def get_queued_indexes(self, count):
+        """Playlist indexes of up to count queued tracks; tracks not in this playlist are passed over"""
+        indexes = []
+        for file_path in self.play_queue:
+            if len(indexes) >= count:
+                break
+            try:
+                indexes.append(self.playlist.index(file_path))
+            except ValueError:
+                pass
+        return indexes
+
+    def get_shuffle_order(self):
+        """The shuffle order for the current playlist; appended tracks extend it
+
+        Changes that move tracks reset it themselves, with reset_shuffle_order.
+        """
+        if self.shuffle_order is not None and 0 < self.shuffle_order.size < len(self.playlist):
+            self.shuffle_order.extend(len(self.playlist))
+            self.save_shuffle_state()
+        elif self.shuffle_order is None or self.shuffle_order.size != len(self.playlist):
+            self.shuffle_order = ShuffleOrder(len(self.playlist))
+            self.save_shuffle_state()
+        return self.shuffle_order
+
+    def reset_shuffle_order(self):
+        """Start a new shuffle order after tracks were moved or removed, as the old one's positions no longer match"""
+        self.shuffle_order = ShuffleOrder(len(self.playlist))
+        self.save_shuffle_state()
+
+    def consume_next_index(self):
+        """Take the track peek_next_index resolved, moving the queue or shuffle cursor past it"""
+        next_index = self.peek_next_index()
+        if next_index < 0:
+            return next_index
+
+        if self.get_queued_indexes(1):
+            # Drop it from the queue, with any tracks passed over before it
+            del self.play_queue[:self.play_queue.index(self.playlist[next_index]) + 1]
+            self.save_play_queue()
+            if self.resume_index is None:
+                self.resume_index = self.current_index
+            self.play_queue_index = next_index
+        else:
+            if self.shuffle_mode:
+                self.get_shuffle_order().advance(self.get_order_index())
+                self.save_shuffle_state()
+            self.resume_index = None
+        return next_index
+
+    def add_to_queue(self, indexes, play_next=False):
+        """Queue playlist tracks to play after the current one, ahead of the playlist order"""
+        paths = [self.playlist[index] for index in indexes]
+        if play_next:
+            self.play_queue[:0] = paths
+        else:
+            self.play_queue.extend(paths)
+        self.save_play_queue()
+        self.refresh_queued_track()
+        self.listener.on_playlist_changed()
+
+    def clear_queue(self):
+        self.play_queue = []
+        self.save_play_queue()
+        self.refresh_queued_track()
+        self.listener.on_playlist_changed()
+
+    def get_playlist_name(self):
+        playlist = self.playlist_store.get_playlist(self.playlist_id)
+        return playlist[0] if playlist else None
+
+    def get_playlist_folder(self):
+        """The folder the current playlist was loaded from, or None"""
+        playlist = self.playlist_store.get_playlist(self.playlist_id)
+        return playlist[1] if playlist else None
+
+    def set_playlist_folder(self, folder):
+        try:
+            self.playlist_store.set_folder(self.playlist_id, folder)
+        except sqlite3.Error as e:
+            print(f"Could not save playlist folder: {e}")
+
+    def open_playlist(self, name, folder=None, clear=False):
+        """Switch to the playlist with this name, or the one for folder if given, creating it if there is none
+
+        With clear, the playlist is emptied before switching to it, for
+        contents about to be loaded afresh.
+        """
+        self.persistence.flush()
+        playlist_id = self.playlist_store.find_folder(folder) if folder else self.playlist_store.find(name)
+        if playlist_id is None:
+            if folder and self.playlist_store.find(name) is not None:
+                # Another folder of the same name has the short name already
+                name = folder
+            playlist_id = self.playlist_store.create(name, folder)
+        elif clear:
+            self.playlist_store.replace(playlist_id, [], 0)
+        if clear or playlist_id != self.playlist_id:
+            self.switch_playlist(playlist_id)
+        return playlist_id
+
+    def list_playlists(self):
+        """Every saved playlist as (id, name, track count)"""
+        return self.playlist_store.list_playlists()
+
+    def create_playlist(self, name, folder=None):
+        """Add an empty playlist and switch to it"""
+        try:
+            playlist_id = self.playlist_store.create(name, folder)
+        except sqlite3.IntegrityError:
+            raise ValueError(f"a playlist named {name!r} already exists")
+        self.switch_playlist(playlist_id)
+        return playlist_id
+
+    def delete_playlist(self, playlist_id):
+        """Delete a saved playlist, switching to another one if it is in use"""
+        others = [other for other, _, _ in self.list_playlists() if other != playlist_id]
+        # Pending writes to the playlist would bring its tracks back
+        self.persistence.flush()
+        try:
+            self.playlist_store.delete(playlist_id)
+        except sqlite3.Error as e:
+            print(f"Could not delete playlist: {e}")
+            return
+        if playlist_id == self.playlist_id:
+            self.switch_playlist(others[0] if others else self.playlist_store.create(PlaylistStore.DEFAULT_NAME))
+
+    def switch_playlist(self, playlist_id):
+        """Make another saved playlist the current one; the playing track carries on"""
+        if self.playlist_store.get_playlist(playlist_id) is None:
+            raise ValueError(f"no playlist with id {playlist_id}")
+        self.persistence.flush()
+        paths, saved_index = self.playlist_store.load(playlist_id)
+        self.playlist_id = playlist_id
+        self.playlist_store.set_active(playlist_id)
+        self.playlist = TrackList(self.track_table, paths)
+        self.next_index = None
+        self.resume_index = None
+        self.shuffle_order = None
+        shuffle_state = self.playlist_store.get_state(f"shuffle:{playlist_id}")
+        if shuffle_state and shuffle_state.get('size') == len(paths):
+            self.shuffle_order = ShuffleOrder(**shuffle_state)
+        self.analyzer.submit(paths)
+
+        if self.current_file and (self.is_playing or self.is_paused):
+            self.current_index = paths.index(self.current_file) if self.current_file in paths else -1
+            self.refresh_queued_track()
+            self.listener.on_playlist_changed()
+            return
+
+        self.current_index = -1
+        self.listener.on_playlist_changed()
+        if paths:
+            self.load_song(max(0, min(saved_index, len(paths) - 1)))
+
+    def play_next(self):
+        if not self.playlist:
+            return
+
+        next_index = self.consume_next_index()
+        if next_index < 0:
+            self.stop()
+            self.listener.on_status("End of playlist", 'text_secondary')
+            return
+
+        self.load_and_play(next_index)
+
+    def play_previous(self):
+        if not self.playlist:
+            return
 
-class Audion:
-    def __init__(self, root):
+        if self.shuffle_mode:
+            # Walk back through the shuffle history, or restart the track at its start
+            prev_index = self.get_shuffle_order().retreat(self.current_index)
+            self.save_shuffle_state()
+            if prev_index is None:
+                prev_index = self.current_index
+            self.load_and_play(prev_index)
+            return
+
+        prev_index = self.current_index - 1
+        if prev_index < 0:
+            if self.repeat_mode:
+                prev_index = len(self.playlist) - 1
+            else:
+                prev_index = 0
+
+        self.load_and_play(prev_index)
+
+    def get_playback_position(self):
+        """Current position in the track in seconds"""
+        position = self.clock.position()
+        if self.song_length > 0:
+            # The clock may run a little past the end before the end event is handled
+            return min(position, self.song_length)
+        return position
+
+    def get_time_remaining(self):
+        """Seconds until the current track should end, or None if unknown"""
+        if self.song_length > 0:
+            return self.song_length - self.get_playback_position()
+        return None
+
+    def get_time_until_transition(self):
+        """Seconds until poll needs to run to move on to the next track, or None if unknown"""
+        until_crossfade = self.output.get_time_until_transition()
+        if until_crossfade is not None:
+            return until_crossfade
+        return self.get_time_remaining()
+
+    @profiled('engine.poll')
+    def poll(self):
+        """Handle the mixer's end-of-track event; call regularly while playing"""
+        if not self.audio_ready:
+            return
+
+        ended = self.output.poll()
+        if ended and self.is_playing:
+            if self.queued_index is not None:
+                self.advance_to_queued_track()
+            else:
+                self.play_next()
+
+    def clear_end_events(self):
+        """Drop end events caused by stopping or restarting playback ourselves"""
+        if self.audio_ready:
+            self.output.clear_end_events()
+
+    @profiled('save_playlist')
+    def save_playlist(self):
+        """Save the whole playlist, after it has been replaced or reordered
+
+        The playlist is written in the background from a snapshot, so
+        several saves in a row only write the last one.
+        """
+        self.persistence.schedule(
+            ('playlist', self.playlist_id),
+            functools.partial(self.playlist_store.replace, self.playlist_id, self.playlist.copy(), self.current_index)
+        )
+
+    def append_to_saved_playlist(self, paths):
+        """Save tracks added to the end of the playlist"""
+        self.persistence.schedule(
+            ('append', self.playlist_id, next(self.append_keys)),
+            functools.partial(self.playlist_store.append, self.playlist_id, list(paths))
+        )
+
+    def save_shuffle_state(self):
+        """Save the shuffle seed and cursor so the order survives a restart"""
+        self.persistence.schedule(
+            ('shuffle', self.playlist_id),
+            functools.partial(self.playlist_store.set_state, f"shuffle:{self.playlist_id}", self.shuffle_order.get_state())
+        )
+
+    def save_current_index(self):
+        """Save just the current track position"""
+        self.persistence.schedule(
+            ('index', self.playlist_id),
+            functools.partial(self.playlist_store.set_current_index, self.playlist_id, self.current_index)
+        )
+
+    def save_play_queue(self):
+        self.persistence.schedule('queue', functools.partial(self.playlist_store.replace_queue, list(self.play_queue)))
+
+    def save_resume_position(self):
+        """Remember the current track and how far into it playback got, to carry on there next time"""
+        self.persistence.set('resume', {'file': self.current_file, 'position': round(self.get_playback_position(), 3)})
+
+    def load_saved_playlist(self):
+        """Restore the saved playlist, checking only that the current track still exists
+
+        Returns the indexes found missing along the way, or None if nothing was restored.
+        If none of the tracks exist, they are all kept, with the current one not loaded,
+        so they can still be relinked.
+        """
+        if self.playlist_store.error is not None:
+            self.listener.on_status(f"Playlists won't be saved: {self.playlist_store.error}", 'error')
+        self.persistence.flush()
+        self.play_queue = self.playlist_store.load_queue()
+        saved_playlist, saved_index = self.playlist_store.load(self.playlist_id)
+        if not saved_playlist:
+            return None
+
+        # Skip ahead to the first track that still exists
+        start = max(0, min(saved_index, len(saved_playlist) - 1))
+        current_index = -1
+        missing = set()
+        for offset in range(len(saved_playlist)):
+            index = (start + offset) % len(saved_playlist)
+            if os.path.exists(saved_playlist[index]):
+                current_index = index
+                break
+            missing.add(index)
+
+        self.playlist = TrackList(self.track_table, saved_playlist)
+        shuffle_state = self.playlist_store.get_state(f"shuffle:{self.playlist_id}")
+        if shuffle_state and shuffle_state.get('size') == len(saved_playlist):
+            self.shuffle_order = ShuffleOrder(**shuffle_state)
+
+        if current_index < 0:
+            # Most likely the library folder was moved or renamed, so keep the
+            # saved position and leave it to relinking to find the files
+            self.current_index = start
+            self.current_file = None
+            self.listener.on_playlist_changed()
+            self.listener.on_status(f"None of the {len(saved_playlist)} saved tracks were found", 'warning')
+            return missing
+
+        self.current_index = current_index
+        self.analyzer.submit(saved_playlist)
+        self.listener.on_playlist_changed()
+
+        # Load the current song so it is ready to play, where it was left off
+        self.load_song(self.current_index)
+        resume = self.persistence.get('resume')
+        if resume and resume.get('file') == self.current_file and resume.get('position'):
+            self.seek(resume['position'])
+            self.listener.on_playback_state_changed()
+        return missing
+
+
+class Audion(PlaybackListener):
+    def __init__(self, root, output=None, paths=(), instance_server=None, replaygain=True):
         self.root = root
         self.root.title("Audion Music Player")
         self.root.geometry("700x550")
@@ -24,34 +4336,109 @@ class Audion:
         # Set window icon
         self.set_window_icon()
         
+        # Only the background for now; the styles are set up with the controls
+        self.setup_colors()
+        
+        self.output = output
+        self.replaygain = replaygain
+        self.startup_paths = list(paths)
+        self.instance_server = instance_server
+        self.engine = None
+        
+        # Paint the empty window first; the engine and the controls are
+        # built once it is on screen, then the mixer and the saved playlist
+        self.startup_times = {}
+        self.root.after_idle(lambda: self.root.after(0, self.build_player))
+        
+        # Release resources cleanly when the window is closed
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def build_player(self):
+        """Start the playback engine and build the controls once the window is on screen"""
+        self.record_startup_time('window')
+        
         # Configure modern styling
         self.setup_modern_theme()
         
-        # Initialize pygame mixer only (not the full pygame which includes video)
-        pygame.mixer.init()
+        # Playback engine, which reports back through the PlaybackListener methods
+        self.engine = PlaybackEngine(self, self.output)
+        self.engine.replaygain = self.replaygain
         
         # Variables
-        self.playlist = []
-        self.current_index = -1
-        self.current_file = None
-        self.is_playing = False
-        self.is_paused = False
-        self.volume = 0.5
-        self.shuffle_mode = False
-        self.repeat_mode = False
-        self.song_length = 0
-        self.current_position = 0
         self.seeking = False
+        self.progress_job = None
+        self.displayed_second = None
+        self.window_visible = True
+        self.scanner = None
+        self.importer = None
+        self.validator = None
+        self.relinker = None
+        self.missing_paths = set()
+        self.search_index = SearchIndex(self.engine.track_table)
+        self.search_indexer = SearchIndexer(self.engine.track_table, self.engine.metadata_cache.peek_many)
+        self.search_index_job = None
+        self.search_matches = None
+        self.watcher = None
+        self.watch_enabled = False
+        self.watched_folder = None
+        self.playlist_menu = None
         
-        # Config file for settings
-        self.config_file = os.path.expanduser("~/.audion_config.json")
-        self.playlist_file = os.path.expanduser("~/.audion_playlist.json")
-        self.last_directory = self.load_last_directory()
+        self.last_directory = self.engine.persistence.get('last_directory')
         
         self.setup_ui()
-        self.load_saved_playlist()
-        self.check_music_end()
         
+        # Refresh progress less often while the window is minimized
+        self.root.bind('<Map>', self.on_window_map)
+        self.root.bind('<Unmap>', self.on_window_unmap)
+        
+        # Paint the controls before opening the mixer and loading the playlist
+        self.record_startup_time('ui')
+        self.root.after_idle(lambda: self.root.after(0, self.finish_startup))
+
+    def finish_startup(self):
+        """Open the mixer and restore the playlist once the controls are on screen"""
+        try:
+            self.engine.init_audio()
+        except Exception as e:
+            self.on_status(f"Could not open audio device: {e}", 'error')
+        self.load_saved_playlist()
+        if self.startup_paths:
+            self.open_paths(self.startup_paths)
+        if self.instance_server:
+            self.root.after(INSTANCE_POLL_INTERVAL, self.poll_instance)
+        self.record_startup_time('ready')
+    
+    def poll_instance(self):
+        """Open what later launches have handed over, bringing the window to the front"""
+        commands = self.instance_server.get_commands()
+        paths = [argument for command, argument in commands if command == 'open' and argument]
+        if paths:
+            self.open_paths(paths)
+        if commands:
+            self.root.deiconify()
+            self.root.lift()
+            self.root.focus_force()
+        self.root.after(INSTANCE_POLL_INTERVAL, self.poll_instance)
+
+    def record_startup_time(self, stage):
+        """Note how long startup took to reach a stage, warning if it ran over budget"""
+        elapsed = time.perf_counter() - STARTUP_STARTED
+        self.startup_times[stage] = elapsed
+        profiler.record(f"startup.{stage}", elapsed)
+        budget = STARTUP_BUDGETS[stage]
+        if elapsed > budget:
+            print(f"Startup reached {stage} in {elapsed * 1000:.0f} ms, over its {budget * 1000:.0f} ms budget")
+
+    def on_close(self):
+        """Shut down the player and close the window"""
+        if self.instance_server:
+            self.instance_server.close()
+        if self.engine is not None:
+            self.stop_watching()
+            self.search_indexer.close()
+            self.engine.close()
+        self.root.destroy()
+
     def set_window_icon(self):
         """Set the window icon from assets folder"""
         try:
@@ -63,8 +4450,8 @@ class Audion:
             # Silently fail if icon can't be loaded
             pass
         
-    def setup_modern_theme(self):
-        """Configure modern, sleek UI theme"""
+    def setup_colors(self):
+        """Pick the color palette and paint the window background"""
         # Modern neutral color palette (inspired by macOS/Windows 11)
         self.colors = {
             'bg_primary': '#f6f6f6',      # Light gray background
@@ -85,6 +4472,8 @@ class Audion:
         # Set light neutral background for main window
         self.root.configure(bg=self.colors['bg_primary'])
         
+    def setup_modern_theme(self):
+        """Configure modern, sleek UI theme"""
         # Configure ttk style
         self.style = ttk.Style()
         
@@ -246,6 +4635,16 @@ class Audion:
         self.progress_slider.pack(fill=tk.X, pady=(0, 5))
         self.progress_slider.bind("<ButtonRelease-1>", self.on_progress_release)
         
+        # Waveform of the current track, once it has been worked out
+        self.waveform = WaveformView(
+            progress_card,
+            self.colors,
+            self.on_waveform_click,
+            height=36,
+            bg=self.colors['bg_secondary']
+        )
+        self.waveform.pack(fill=tk.X, before=self.progress_slider, pady=(0, 5))
+        
         # File/Folder buttons with modern styling
         file_button_frame = ttk.Frame(main_container, style='Modern.TFrame')
         file_button_frame.pack(fill=tk.X, pady=(0, 20))
@@ -267,7 +4666,31 @@ class Audion:
             command=self.open_folder,
             style='Modern.TButton'
         )
-        self.open_folder_button.pack(side=tk.LEFT)
+        self.open_folder_button.pack(side=tk.LEFT, padx=(0, 10))
+        
+        self.import_button = ttk.Button(
+            buttons_container,
+            text="📋 Import Playlist",
+            command=self.import_playlist,
+            style='Modern.TButton'
+        )
+        self.import_button.pack(side=tk.LEFT, padx=(0, 10))
+        
+        export_button = ttk.Button(
+            buttons_container,
+            text="💾 Export Playlist",
+            command=self.export_playlist,
+            style='Modern.TButton'
+        )
+        export_button.pack(side=tk.LEFT, padx=(0, 10))
+        
+        self.duplicates_button = ttk.Button(
+            buttons_container,
+            text="🧬 Duplicates",
+            command=self.toggle_duplicates,
+            style='Modern.TButton'
+        )
+        self.duplicates_button.pack(side=tk.LEFT)
         
         # Navigation control buttons with modern design
         nav_card = ttk.Frame(main_container, style='Card.TFrame', padding=20)
@@ -280,7 +4703,7 @@ class Audion:
         self.prev_button = ttk.Button(
             nav_container,
             text="⏮ Previous",
-            command=self.play_previous,
+            command=self.engine.play_previous,
             style='Secondary.TButton',
             state=tk.DISABLED
         )
@@ -289,7 +4712,7 @@ class Audion:
         self.play_button = ttk.Button(
             nav_container,
             text="▶ Play",
-            command=self.play,
+            command=self.engine.play,
             style='Modern.TButton',
             state=tk.DISABLED
         )
@@ -298,7 +4721,7 @@ class Audion:
         self.pause_button = ttk.Button(
             nav_container,
             text="⏸ Pause",
-            command=self.pause,
+            command=self.engine.pause,
             style='Secondary.TButton',
             state=tk.DISABLED
         )
@@ -307,7 +4730,7 @@ class Audion:
         self.stop_button = ttk.Button(
             nav_container,
             text="⏹ Stop",
-            command=self.stop,
+            command=self.engine.stop,
             style='Secondary.TButton',
             state=tk.DISABLED
         )
@@ -316,7 +4739,7 @@ class Audion:
         self.next_button = ttk.Button(
             nav_container,
             text="⏭ Next",
-            command=self.play_next,
+            command=self.engine.play_next,
             style='Secondary.TButton',
             state=tk.DISABLED
         )
@@ -340,7 +4763,24 @@ class Audion:
             command=self.toggle_repeat,
             style='Secondary.TButton'
         )
-        self.repeat_button.pack(side=tk.LEFT)
+        self.repeat_button.pack(side=tk.LEFT, padx=(0, 10))
+        
+        self.gapless_button = ttk.Button(
+            mode_frame,
+            text="🔗 Gapless: OFF",
+            command=self.toggle_gapless,
+            style='Secondary.TButton'
+        )
+        self.gapless_button.pack(side=tk.LEFT, padx=(0, 10))
+        self.update_mode_buttons()
+        
+        self.watch_button = ttk.Button(
+            mode_frame,
+            text="👁 Watch: OFF",
+            command=self.toggle_watch,
+            style='Secondary.TButton'
+        )
+        self.watch_button.pack(side=tk.LEFT)
         
         # Volume control with modern design
         volume_card = ttk.Frame(main_container, style='Card.TFrame', padding=15)
@@ -363,7 +4803,7 @@ class Audion:
             style='Modern.Horizontal.TScale',
             command=self.set_volume
         )
-        self.volume_slider.set(50)
+        self.volume_slider.set(self.engine.volume * 100)
         self.volume_slider.pack(fill=tk.X)
         
         # Modern Playlist display - moved below buttons for better visibility
@@ -381,7 +4821,59 @@ class Audion:
             bg=self.colors['bg_secondary'],
             fg=self.colors['text_primary']
         )
-        playlist_header.pack(anchor=tk.W)
+        playlist_header.pack(side=tk.LEFT)
+        
+        # Saved playlists, switched without touching the others on disk
+        self.playlist_ids = []
+        self.playlist_picker = ttk.Combobox(playlist_header_frame, state='readonly', width=20)
+        self.playlist_picker.pack(side=tk.LEFT, padx=(15, 5))
+        self.playlist_picker.bind('<<ComboboxSelected>>', self.on_playlist_selected)
+        
+        new_playlist_button = ttk.Button(
+            playlist_header_frame,
+            text="＋",
+            command=self.new_playlist,
+            style='Secondary.TButton',
+            width=3
+        )
+        new_playlist_button.pack(side=tk.LEFT, padx=(0, 5))
+        
+        delete_playlist_button = ttk.Button(
+            playlist_header_frame,
+            text="🗑",
+            command=self.delete_playlist,
+            style='Secondary.TButton',
+            width=3
+        )
+        delete_playlist_button.pack(side=tk.LEFT)
+        
+        # Search box that filters the list as you type
+        self.search_var = tk.StringVar()
+        search_entry = tk.Entry(
+            playlist_header_frame,
+            textvariable=self.search_var,
+            font=("SF Pro Display", 11),
+            width=24,
+            bg=self.colors['bg_tertiary'],
+            fg=self.colors['text_primary'],
+            insertbackground=self.colors['text_primary'],
+            relief='flat',
+            highlightthickness=1,
+            highlightcolor=self.colors['accent'],
+            highlightbackground=self.colors['border']
+        )
+        search_entry.pack(side=tk.RIGHT, ipady=3)
+        search_entry.bind('<Escape>', lambda e: self.search_var.set(""))
+        self.search_var.trace_add('write', self.on_search_changed)
+        
+        search_icon = tk.Label(
+            playlist_header_frame,
+            text="🔍",
+            font=("SF Pro Display", 12),
+            bg=self.colors['bg_secondary'],
+            fg=self.colors['text_secondary']
+        )
+        search_icon.pack(side=tk.RIGHT, padx=(0, 5))
         
         # Playlist container with distinct background
         playlist_container = tk.Frame(
@@ -392,9 +4884,11 @@ class Audion:
         )
         playlist_container.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         
-        # Create listbox with contrasting background for visibility
-        self.playlist_box = tk.Listbox(
+        # Create listbox with contrasting background for visibility.
+        # Only the visible rows are rendered, so large playlists stay fast.
+        self.playlist_box = VirtualListbox(
             playlist_container,
+            self.get_playlist_row_text,
             font=("SF Pro Display", 12),
             selectmode=tk.SINGLE,
             height=12,
@@ -411,12 +4905,12 @@ class Audion:
         )
         self.playlist_box.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=8, pady=8)
         self.playlist_box.bind('<Double-Button-1>', self.on_playlist_double_click)
+        self.playlist_box.bind('<Button-3>', self.on_playlist_right_click)
         
         # Modern scrollbar
         scrollbar = ttk.Scrollbar(playlist_container, orient=tk.VERTICAL)
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y, padx=(0, 8), pady=8)
-        scrollbar.config(command=self.playlist_box.yview)
-        self.playlist_box.config(yscrollcommand=scrollbar.set)
+        self.playlist_box.set_scrollbar(scrollbar)
         
         # Modern status bar
         status_card = ttk.Frame(main_container, style='Card.TFrame', padding=10)
@@ -443,16 +4937,6 @@ class Audion:
         )
         self.status_label.pack(side=tk.LEFT)
         
-    def get_song_length(self, file_path):
-        """Get the length of the audio file in seconds"""
-        try:
-            audio = MutagenFile(file_path)
-            if audio and audio.info:
-                return audio.info.length
-        except:
-            pass
-        return 0
-    
     def format_time(self, seconds):
         """Format seconds to MM:SS"""
         if seconds < 0:
@@ -463,55 +4947,41 @@ class Audion:
     
     def on_progress_release(self, event):
         """Called when user releases the progress bar - seek to that position"""
-        if self.current_file and self.song_length > 0:
-            seek_time = self.progress_var.get()
-            
-            try:
-                # Restart the song from the desired position
-                pygame.mixer.music.play(start=seek_time)
-                self.current_position = seek_time
-                
-                # If we were paused, pause again after seeking
-                if self.is_paused:
-                    pygame.mixer.music.pause()
-                elif not self.is_playing:
-                    pygame.mixer.music.pause()
-            except Exception as e:
-                # Some formats don't support seeking well
-                print(f"Seek error: {e}")
-        
+        self.engine.seek(self.progress_var.get())
+        self.displayed_second = None
         self.seeking = False
+        self.schedule_progress_update()
+    
+    def on_waveform_click(self, fraction):
+        """Seek to the point clicked on the waveform"""
+        song_length = self.engine.song_length
+        if song_length > 0:
+            self.engine.seek(fraction * song_length)
+            self.progress_var.set(fraction * song_length)
+            self.waveform.set_position(fraction)
+            self.displayed_second = None
+    
+    def show_waveform(self, file_path):
+        """Draw the current track's waveform, checking back while it is being worked out"""
+        if file_path != self.engine.current_file:
+            return
+        peaks = self.engine.get_waveform(file_path)
+        if peaks is not None:
+            self.waveform.set_peaks(peaks)
+        elif self.engine.analyzer.is_waveform_pending(file_path):
+            self.root.after(500, self.show_waveform, file_path)
     
     def on_progress_drag(self, value):
         """Update time label while dragging"""
-        if self.song_length > 0:
+        song_length = self.engine.song_length
+        if song_length > 0:
             current_time = float(value)
-            remaining_time = self.song_length - current_time
+            remaining_time = song_length - current_time
             self.time_elapsed_label.config(text=self.format_time(current_time))
             self.time_remaining_label.config(text=self.format_time(remaining_time))
+            self.waveform.set_position(current_time / song_length)
             self.seeking = True
     
-    def update_progress(self):
-        """Update the progress bar and time labels"""
-        if self.is_playing and not self.seeking and self.song_length > 0:
-            # Get current position
-            pos = pygame.mixer.music.get_pos() / 1000.0  # Convert ms to seconds
-            
-            # pygame.mixer.music.get_pos() returns time since start of current play
-            # We need to track the actual position
-            if pos >= 0:
-                self.current_position = pos
-                
-                # Update progress bar
-                progress_percent = (self.current_position / self.song_length) * 100
-                if progress_percent <= 100:
-                    self.progress_slider.set(progress_percent)
-                
-                # Update time labels
-                self.current_time_label.config(text=self.format_time(self.current_position))
-                remaining = self.song_length - self.current_position
-                self.total_time_label.config(text=self.format_time(self.song_length))
-    
     def open_file(self):
         initial_dir = self.last_directory if self.last_directory and os.path.exists(self.last_directory) else os.path.expanduser("~")
         
@@ -519,7 +4989,7 @@ class Audion:
             title="Select Audio File",
             initialdir=initial_dir,
             filetypes=[
-                ("Audio Files", "*.mp3 *.wav *.ogg *.flac"),
+                ("Audio Files", " ".join(f"*{ext}" for ext in AUDIO_EXTENSIONS)),
                 ("MP3 Files", "*.mp3"),
                 ("WAV Files", "*.wav"),
                 ("OGG Files", "*.ogg"),
@@ -532,369 +5002,1157 @@ class Audion:
             # Save the directory for next time
             self.last_directory = os.path.dirname(file_path)
             self.save_last_directory()
+            self.play_files([file_path])
+    
+    def play_files(self, file_paths):
+        """Add files to the current playlist, rather than replacing it, and play the first"""
+        new_paths = [file_path for file_path in dict.fromkeys(file_paths) if file_path not in self.engine.playlist]
+        if new_paths:
+            self.engine.append_tracks(new_paths)
+        self.engine.load_and_play(self.engine.playlist.index(file_paths[0]))
+    
+    def open_folder(self):
+        initial_dir = self.last_directory if self.last_directory and os.path.exists(self.last_directory) else os.path.expanduser("~")
+        
+        folder_path = filedialog.askdirectory(title="Select Music Folder", initialdir=initial_dir)
+        
+        if folder_path:
+            # Save the directory for next time
+            self.last_directory = folder_path
+            self.save_last_directory()
+            self.load_folder(folder_path)
+    
+    def load_folder(self, folder_path):
+        """Fill the folder's own playlist with the tracks found by a background scan"""
+        self.discard_scan()
+        self.discard_import()
+        self.discard_validation()
+        self.stop_watching()
+        folder_path = os.path.abspath(folder_path)
+        self.watched_folder = folder_path
+        self.engine.stop()
+        self.engine.open_playlist(os.path.basename(folder_path) or folder_path, folder_path, clear=True)
+        self.save_watch_state()
+        self.update_playlist_picker()
+        
+        self.scanner = LibraryScanner(folder_path)
+        self.scanner.start()
+        self.open_folder_button.config(text="✖ Cancel Scan", command=self.cancel_scan)
+        self.status_label.config(text="Scanning folder...", fg=self.colors['accent'])
+        self.root.after(100, self.poll_scan, self.scanner)
+    
+    def cancel_scan(self):
+        """Cancel a running folder scan, keeping the tracks found so far"""
+        if self.scanner:
+            self.scanner.cancel()
+    
+    def discard_scan(self):
+        """Cancel a running folder scan and drop its remaining results"""
+        if self.scanner:
+            self.scanner.cancel()
+            self.scanner = None
+            self.open_folder_button.config(text="📁 Open Folder", command=self.open_folder)
+    
+    def poll_scan(self, scanner):
+        """Move scanned tracks into the playlist in batches"""
+        if scanner is not self.scanner:
+            # The scan was discarded or replaced
+            return
+        
+        batch = scanner.get_batch()
+        if batch:
+            start = len(self.engine.playlist)
+            self.engine.append_tracks(batch)
             
-            self.playlist = [file_path]
-            self.current_index = 0
-            self.update_playlist_display()
-            self.load_and_play(0)
+            # Start playing as soon as the first track is found
+            if self.engine.current_index < 0:
+                self.engine.load_and_play(start)
+        
+        if not scanner.is_done():
+            if not scanner.cancelled.is_set():
+                self.status_label.config(
+                    text=f"Scanning... {len(self.engine.playlist)} tracks in {scanner.folders_scanned} folders",
+                    fg=self.colors['accent']
+                )
+            self.root.after(100, self.poll_scan, scanner)
+            return
+        
+        self.finish_scan()
+    
+    def finish_scan(self):
+        """Sort the scanned playlist and save it"""
+        cancelled = self.scanner.cancelled.is_set()
+        self.scanner = None
+        self.open_folder_button.config(text="📁 Open Folder", command=self.open_folder)
+        
+        if not cancelled:
+            self.start_watching()
+        
+        track_count = len(self.engine.playlist)
+        if track_count:
+            self.engine.sort_playlist()
+            if cancelled:
+                self.status_label.config(text=f"Scan cancelled - loaded {track_count} tracks", fg=self.colors['warning'])
+            else:
+                self.status_label.config(text=f"Loaded {track_count} tracks", fg=self.colors['success'])
+        elif cancelled:
+            self.status_label.config(text="Scan cancelled", fg=self.colors['warning'])
+        else:
+            self.status_label.config(text="No audio files found", fg=self.colors['error'])
+    
+    def import_playlist(self):
+        initial_dir = self.last_directory if self.last_directory and os.path.exists(self.last_directory) else os.path.expanduser("~")
+        
+        file_path = filedialog.askopenfilename(
+            title="Import Playlist",
+            initialdir=initial_dir,
+            filetypes=[
+                ("Playlists", " ".join(f"*{ext}" for ext in PLAYLIST_EXTENSIONS)),
+                ("All Files", "*.*")
+            ]
+        )
+        
+        if file_path:
+            self.last_directory = os.path.dirname(file_path)
+            self.save_last_directory()
+            self.load_playlist_file(file_path)
+    
+    def load_playlist_file(self, file_path):
+        """Read a playlist file into a playlist of its own, named after it, in the background"""
+        self.discard_scan()
+        self.discard_import()
+        self.discard_validation()
+        self.stop_watching()
+        self.watched_folder = None
+        self.engine.stop()
+        self.engine.open_playlist(os.path.splitext(os.path.basename(file_path))[0], clear=True)
+        self.save_watch_state()
+        self.update_playlist_picker()
+        
+        self.importer = PlaylistImporter(file_path, self.engine.metadata_cache)
+        self.importer.start()
+        self.import_button.config(text="✖ Cancel Import", command=self.cancel_import)
+        self.status_label.config(text="Importing playlist...", fg=self.colors['accent'])
+        self.root.after(100, self.poll_import, self.importer)
+    
+    def open_paths(self, paths):
+        """Open files, folders and playlist files named on the command line or sent by a later launch
+
+        A folder or playlist file gets its own playlist; audio files are added
+        to the current playlist and the first one is played.
+        """
+        folders = [path for path in paths if os.path.isdir(path)]
+        playlist_files = [path for path in paths if os.path.isfile(path) and path.lower().endswith(PLAYLIST_EXTENSIONS)]
+        audio_files = [path for path in paths if os.path.isfile(path) and path.lower().endswith(AUDIO_EXTENSIONS)]
+        if folders:
+            self.load_folder(folders[0])
+        elif playlist_files:
+            self.load_playlist_file(playlist_files[0])
+        if audio_files:
+            self.play_files(audio_files)
+        
+        ignored = len(paths) - len(audio_files) - (1 if folders or playlist_files else 0)
+        if ignored:
+            self.status_label.config(
+                text=f"Skipped {ignored} of the paths given (one folder or playlist file at a time, and only audio files)",
+                fg=self.colors['warning']
+            )
+    
+    def cancel_import(self):
+        """Cancel a running import, keeping the tracks read so far"""
+        if self.importer:
+            self.importer.cancel()
+    
+    def discard_import(self):
+        """Cancel a running import and drop its remaining results"""
+        if self.importer:
+            self.importer.cancel()
+            self.importer = None
+            self.import_button.config(text="📋 Import Playlist", command=self.import_playlist)
+    
+    def poll_import(self, importer):
+        """Move imported tracks into the playlist in batches"""
+        if importer is not self.importer:
+            return
+        
+        batch = importer.get_batch()
+        if batch:
+            start = len(self.engine.playlist)
+            self.engine.append_tracks(batch)
+            if self.engine.current_index < 0:
+                self.engine.load_and_play(start)
+        
+        if not importer.is_done():
+            if not importer.cancelled.is_set():
+                self.status_label.config(
+                    text=f"Importing... {len(self.engine.playlist)} tracks",
+                    fg=self.colors['accent']
+                )
+            self.root.after(100, self.poll_import, importer)
+            return
+        
+        self.importer = None
+        self.import_button.config(text="📋 Import Playlist", command=self.import_playlist)
+        track_count = len(self.engine.playlist)
+        if importer.error is not None:
+            self.status_label.config(text=f"Could not read playlist: {importer.error}", fg=self.colors['error'])
+        elif importer.cancelled.is_set():
+            self.status_label.config(text=f"Import cancelled - loaded {track_count} tracks", fg=self.colors['warning'])
+        else:
+            self.status_label.config(text=f"Imported {track_count} tracks", fg=self.colors['success'])
     
-    def open_folder(self):
+    def export_playlist(self):
         initial_dir = self.last_directory if self.last_directory and os.path.exists(self.last_directory) else os.path.expanduser("~")
         
-        folder_path = filedialog.askdirectory(title="Select Music Folder", initialdir=initial_dir)
+        file_path = filedialog.asksaveasfilename(
+            title="Export Playlist",
+            initialdir=initial_dir,
+            initialfile=f"{self.engine.get_playlist_name()}.m3u8",
+            defaultextension=".m3u8",
+            filetypes=[
+                ("M3U8 Playlist", "*.m3u8"),
+                ("M3U Playlist", "*.m3u"),
+                ("PLS Playlist", "*.pls")
+            ]
+        )
         
-        if folder_path:
-            # Save the directory for next time
-            self.last_directory = folder_path
-            self.save_last_directory()
-            
-            # Get all audio files from the folder
-            audio_extensions = ('.mp3', '.wav', '.ogg', '.flac')
-            audio_files = []
-            
-            for file in os.listdir(folder_path):
-                if file.lower().endswith(audio_extensions):
-                    audio_files.append(os.path.join(folder_path, file))
-            
-            if audio_files:
-                audio_files.sort()  # Sort alphabetically
-                self.playlist = audio_files
-                self.current_index = 0
-                self.save_playlist()
-                self.update_playlist_display()
-                # Force refresh the listbox display
-                self.root.update_idletasks()
-                self.load_and_play(0)
-                self.status_label.config(text=f"Loaded {len(audio_files)} tracks", fg=self.colors['success'])
-            else:
-                self.status_label.config(text="No audio files found", fg=self.colors['error'])
+        if file_path:
+            try:
+                track_count = self.engine.export_playlist(file_path)
+            except OSError as e:
+                self.status_label.config(text=f"Could not export playlist: {e}", fg=self.colors['error'])
+                return
+            self.status_label.config(
+                text=f"Exported {track_count} tracks to {os.path.basename(file_path)}",
+                fg=self.colors['success']
+            )
     
+    @profiled('update_playlist_display')
     def update_playlist_display(self):
-        # Clear and repopulate the listbox
-        self.playlist_box.delete(0, tk.END)
-        
-        if not self.playlist:
-            return
-            
-        for i, file_path in enumerate(self.playlist):
-            filename = os.path.basename(file_path)
-            prefix = "▶ " if i == self.current_index else "   "
-            self.playlist_box.insert(tk.END, f"{prefix}{filename}")
+        """Redraw the playlist after it has been replaced, resized or filtered"""
+        if self.search_matches is not None:
+            self.playlist_box.set_count(len(self.search_matches))
+        else:
+            self.playlist_box.set_count(len(self.engine.playlist))
         
         # Update selection and scroll to current song
-        if self.current_index >= 0 and self.current_index < len(self.playlist):
-            self.playlist_box.selection_clear(0, tk.END)
-            self.playlist_box.selection_set(self.current_index)
-            self.playlist_box.see(self.current_index)
-            
-        # Force GUI update
-        self.playlist_box.update_idletasks()
-        self.root.update_idletasks()
+        current_row = self.get_playlist_row(self.engine.current_index)
+        self.playlist_box.select_index(current_row)
+        if current_row >= 0:
+            self.playlist_box.see_index(current_row)
     
-    def on_playlist_double_click(self, event):
-        selection = self.playlist_box.curselection()
-        if selection:
-            index = selection[0]
-            self.load_and_play(index)
-            
-    def load_and_play(self, index):
-        if 0 <= index < len(self.playlist):
-            file_path = self.playlist[index]
-            try:
-                # Stop current playback
-                pygame.mixer.music.stop()
-                
-                # Get song length
-                self.song_length = self.get_song_length(file_path)
-                self.current_position = 0
-                
-                # Update progress bar and time
-                self.progress_slider.config(to=self.song_length if self.song_length > 0 else 100)
-                self.progress_var.set(0)
-                self.time_elapsed_label.config(text="0:00")
-                self.time_remaining_label.config(text=self.format_time(self.song_length))
-                
-                # Load new file
-                pygame.mixer.music.load(file_path)
-                self.current_file = file_path
-                self.current_index = index
-                
-                # Update UI
-                filename = os.path.basename(file_path)
-                self.file_label.config(text=filename, fg=self.colors['text_primary'])
-                
-                # Enable buttons
-                self.play_button.config(state=tk.NORMAL)
-                self.pause_button.config(state=tk.NORMAL)
-                self.stop_button.config(state=tk.NORMAL)
-                self.prev_button.config(state=tk.NORMAL)
-                self.next_button.config(state=tk.NORMAL)
-                
-                # Update playlist display
-                self.update_playlist_display()
-                
-                # Auto-play
-                pygame.mixer.music.play()
-                self.is_playing = True
-                self.is_paused = False
-                self.status_label.config(text=f"Playing ({index + 1}/{len(self.playlist)})", fg=self.colors['success'])
-                
-            except Exception as e:
-                self.status_label.config(text=f"Error: {str(e)}", fg=self.colors['error'])
+    def update_current_track_marker(self, old_index):
+        """Move the ▶ marker, redrawing only the two rows that change"""
+        current_row = self.get_playlist_row(self.engine.current_index)
+        self.playlist_box.refresh_row(self.get_playlist_row(old_index))
+        self.playlist_box.refresh_row(current_row)
+        self.playlist_box.select_index(current_row)
+        if current_row >= 0:
+            self.playlist_box.see_index(current_row)
     
-    def load_song(self, index):
-        """Load a song but don't play it automatically (for restoring saved state)"""
-        if 0 <= index < len(self.playlist):
-            file_path = self.playlist[index]
-            try:
-                # Stop current playback
-                pygame.mixer.music.stop()
-                
-                # Get song length
-                self.song_length = self.get_song_length(file_path)
-                self.current_position = 0
-                
-                # Update progress bar and time
-                self.progress_slider.config(to=self.song_length if self.song_length > 0 else 100)
-                self.progress_var.set(0)
-                self.time_elapsed_label.config(text="0:00")
-                self.time_remaining_label.config(text=self.format_time(self.song_length))
-                
-                # Load new file
-                pygame.mixer.music.load(file_path)
-                self.current_file = file_path
-                self.current_index = index
-                
-                # Update UI
-                filename = os.path.basename(file_path)
-                self.file_label.config(text=filename, fg=self.colors['text_primary'])
-                
-                # Enable buttons
-                self.play_button.config(state=tk.NORMAL)
-                self.pause_button.config(state=tk.NORMAL)
-                self.stop_button.config(state=tk.NORMAL)
-                self.prev_button.config(state=tk.NORMAL)
-                self.next_button.config(state=tk.NORMAL)
-                
-                # Update playlist display
-                self.update_playlist_display()
-                
-                # Don't auto-play, just set status as ready
-                self.is_playing = False
-                self.is_paused = False
-                self.status_label.config(text=f"Ready to play ({index + 1}/{len(self.playlist)})", fg=self.colors['accent'])
-                
-            except Exception as e:
-                self.status_label.config(text=f"Error loading song: {str(e)}", fg=self.colors['error'])
-            
-    def play(self):
-        if self.current_file:
-            if self.is_paused:
-                pygame.mixer.music.unpause()
-                self.is_paused = False
-            else:
-                pygame.mixer.music.play()
-            
-            self.is_playing = True
-            self.status_label.config(text=f"Playing ({self.current_index + 1}/{len(self.playlist)})", fg=self.colors['success'])
-            
-    def pause(self):
-        if self.is_playing:
-            pygame.mixer.music.pause()
-            self.is_paused = True
-            self.is_playing = False
-            self.status_label.config(text="Paused", fg=self.colors['warning'])
-            
-    def stop(self):
-        pygame.mixer.music.stop()
-        self.is_playing = False
-        self.is_paused = False
-        self.status_label.config(text="Stopped", fg=self.colors['text_secondary'])
+    def get_playlist_index(self, row):
+        """Playlist index of a row in the list, which may be filtered by a search"""
+        if self.search_matches is not None:
+            return self.search_matches[row]
+        return row
     
-    def play_next(self):
-        if not self.playlist:
+    def get_playlist_row(self, index):
+        """Row showing a playlist index, or -1 if it is filtered out"""
+        if index < 0 or index >= len(self.engine.playlist):
+            return -1
+        if self.search_matches is not None:
+            return self.search_matches.row_of(index)
+        return index
+    
+    def on_search_changed(self, *args):
+        """Filter the playlist with the search text"""
+        self.apply_search()
+        self.update_playlist_display()
+        if self.search_matches is not None:
+            self.status_label.config(
+                text=f"{len(self.search_matches)} of {len(self.engine.playlist)} tracks match",
+                fg=self.colors['accent']
+            )
+    
+    def apply_search(self):
+        """Look up the tracks matching the search text; None shows the whole playlist"""
+        self.search_matches = self.search_index.search(self.search_var.get(), self.engine.playlist)
+    
+    def toggle_duplicates(self):
+        """Show only tracks with the same audio as another track, or go back to the whole playlist"""
+        if isinstance(self.search_matches, DuplicateMatches):
+            self.apply_search()
+            self.update_playlist_display()
+            self.status_label.config(text=f"{len(self.engine.playlist)} tracks", fg=self.colors['accent'])
             return
         
-        if self.shuffle_mode:
-            # Pick a random track (but not the current one if possible)
-            if len(self.playlist) > 1:
-                next_index = random.choice([i for i in range(len(self.playlist)) if i != self.current_index])
-            else:
-                next_index = 0
+        groups, unknown = self.engine.find_duplicates()
+        pending = f" ({unknown} tracks still being fingerprinted)" if unknown else ""
+        if not groups:
+            self.status_label.config(text=f"No duplicates found{pending}", fg=self.colors['success'])
+            return
+        self.search_matches = DuplicateMatches(groups)
+        self.update_playlist_display()
+        self.status_label.config(
+            text=f"{len(self.search_matches)} copies of {len(groups)} tracks{pending}",
+            fg=self.colors['warning']
+        )
+    
+    def get_playlist_row_text(self, row):
+        """Text for one playlist row"""
+        index = self.get_playlist_index(row)
+        playlist = self.engine.playlist
+        if self.missing_paths and playlist[index] in self.missing_paths:
+            prefix = "✖ "
+        elif index == self.engine.current_index:
+            prefix = "▶ "
+        elif self.engine.play_queue and playlist[index] in self.engine.play_queue:
+            prefix = "⏭ "
         else:
-            next_index = self.current_index + 1
-            if next_index >= len(self.playlist):
-                if self.repeat_mode:
-                    next_index = 0
-                else:
-                    self.stop()
-                    self.status_label.config(text="End of playlist", fg=self.colors['text_secondary'])
-                    return
-        
-        self.load_and_play(next_index)
+            prefix = "   "
+        return f"{prefix}{playlist.get_name(index)}"
     
-    def play_previous(self):
-        if not self.playlist:
+    def on_playlist_double_click(self, event):
+        row = self.playlist_box.selected_index()
+        if row >= 0:
+            self.engine.load_and_play(self.get_playlist_index(row))
+    
+    def on_playlist_right_click(self, event):
+        """Select the row under the pointer and offer to queue it"""
+        row = self.playlist_box.index_at(event.y)
+        if row < 0:
+            return
+        self.playlist_box.select_index(row)
+        if self.playlist_menu is None:
+            # Right-click menu for queueing tracks, built the first time it is needed
+            self.playlist_menu = tk.Menu(self.root, tearoff=0)
+            self.playlist_menu.add_command(label="Play Next", command=lambda: self.queue_selected_track(play_next=True))
+            self.playlist_menu.add_command(label="Add to Queue", command=self.queue_selected_track)
+            self.playlist_menu.add_separator()
+            self.playlist_menu.add_command(label="Clear Queue", command=self.engine.clear_queue)
+        self.playlist_menu.tk_popup(event.x_root, event.y_root)
+    
+    def queue_selected_track(self, play_next=False):
+        row = self.playlist_box.selected_index()
+        if row < 0:
+            return
+        index = self.get_playlist_index(row)
+        self.engine.add_to_queue([index], play_next)
+        queued = "next" if play_next else f"in {len(self.engine.play_queue)} tracks"
+        self.status_label.config(
+            text=f"Queued {self.engine.playlist.get_name(index)} to play {queued}",
+            fg=self.colors['accent']
+        )
+    
+    def update_playlist_picker(self):
+        """List the saved playlists, with the current one chosen"""
+        playlists = self.engine.list_playlists()
+        self.playlist_ids = [playlist_id for playlist_id, _, _ in playlists]
+        self.playlist_picker.config(values=[name for _, name, _ in playlists])
+        if self.engine.playlist_id in self.playlist_ids:
+            self.playlist_picker.current(self.playlist_ids.index(self.engine.playlist_id))
+    
+    def on_playlist_selected(self, event):
+        playlist_id = self.playlist_ids[self.playlist_picker.current()]
+        if playlist_id != self.engine.playlist_id:
+            self.switch_playlist(lambda: self.engine.switch_playlist(playlist_id))
+    
+    def switch_playlist(self, switch):
+        """Stop work tied to the current playlist, call switch, and pick up the new playlist's folder"""
+        self.discard_scan()
+        self.discard_import()
+        self.discard_validation()
+        self.stop_watching()
+        switch()
+        self.watched_folder = self.engine.get_playlist_folder()
+        self.start_watching()
+        self.update_playlist_picker()
+        self.status_label.config(
+            text=f"{self.engine.get_playlist_name()}: {len(self.engine.playlist)} tracks",
+            fg=self.colors['accent']
+        )
+    
+    def new_playlist(self):
+        name = simpledialog.askstring("New Playlist", "Playlist name:", parent=self.root)
+        if not name or not name.strip():
+            return
+        try:
+            self.switch_playlist(lambda: self.engine.create_playlist(name.strip()))
+        except ValueError as e:
+            self.status_label.config(text=f"Could not create playlist: {e}", fg=self.colors['error'])
+    
+    def delete_playlist(self):
+        name = self.engine.get_playlist_name()
+        if not messagebox.askyesno("Delete Playlist", f"Delete the playlist \"{name}\"? The music files are kept.", parent=self.root):
             return
+        self.switch_playlist(lambda: self.engine.delete_playlist(self.engine.playlist_id))
+    
+    def on_track_changed(self, old_index):
+        """Show the track the engine has just loaded"""
+        song_length = self.engine.song_length
         
-        prev_index = self.current_index - 1
-        if prev_index < 0:
-            if self.repeat_mode:
-                prev_index = len(self.playlist) - 1
-            else:
-                prev_index = 0
+        # Update progress bar and time
+        self.progress_slider.config(to=song_length if song_length > 0 else 100)
+        self.progress_var.set(0)
+        self.time_elapsed_label.config(text="0:00")
+        self.time_remaining_label.config(text=self.format_time(song_length))
+        self.displayed_second = None
+        self.waveform.set_peaks(None)
+        self.show_waveform(self.engine.current_file)
         
-        self.load_and_play(prev_index)
+        # Make the tags read for the new track searchable
+        self.search_index.update_tags(self.engine.current_file, self.engine.metadata_cache.peek(self.engine.current_file))
+        
+        # Update UI
+        title = self.engine.get_track_title(self.engine.current_file)
+        self.file_label.config(text=title, fg=self.colors['text_primary'])
+        
+        # Enable buttons
+        self.play_button.config(state=tk.NORMAL)
+        self.pause_button.config(state=tk.NORMAL)
+        self.stop_button.config(state=tk.NORMAL)
+        self.prev_button.config(state=tk.NORMAL)
+        self.next_button.config(state=tk.NORMAL)
+        
+        # Update playlist display
+        self.update_current_track_marker(old_index)
     
-    def toggle_shuffle(self):
-        self.shuffle_mode = not self.shuffle_mode
-        if self.shuffle_mode:
-            self.shuffle_button.config(text="🔀 Shuffle: ON")
-            # Create active style for shuffle
-            self.style.configure('Shuffle.Active.TButton',
-                               background=self.colors['success'],
-                               foreground=self.colors['text_primary'])
-            self.shuffle_button.config(style='Shuffle.Active.TButton')
+    def on_playback_state_changed(self):
+        """Only refresh progress while something is playing"""
+        if self.engine.is_playing:
+            self.displayed_second = None
+            self.schedule_progress_update()
         else:
-            self.shuffle_button.config(text="🔀 Shuffle: OFF", style='Secondary.TButton')
+            self.cancel_progress_update()
+    
+    def on_playlist_changed(self):
+        # Index new tracks in the background; a search shows them as they are merged in
+        new_ids = self.search_index.take_new_ids(self.engine.playlist)
+        if new_ids:
+            self.search_indexer.submit(new_ids)
+        self.search_index.invalidate_positions()
+        if self.search_index_job is None:
+            self.search_index_job = self.root.after(SEARCH_INDEX_POLL_INTERVAL, self.poll_search_indexer)
+        if self.search_matches is not None:
+            self.apply_search()
+        self.update_playlist_display()
+    
+    def poll_search_indexer(self):
+        """Merge newly indexed tracks, then get the index ready for the next keystroke"""
+        self.search_index_job = None
+        batches = self.search_indexer.get_batches()
+        for batch in batches:
+            self.search_index.merge(batch)
+        if batches and self.search_matches is not None and not isinstance(self.search_matches, DuplicateMatches):
+            self.apply_search()
+            self.update_playlist_display()
+        if not self.search_indexer.is_done():
+            self.search_index_job = self.root.after(SEARCH_INDEX_POLL_INTERVAL, self.poll_search_indexer)
+            return
+        self.search_index.prepare(self.engine.playlist)
+    
+    def on_status(self, text, level):
+        self.status_label.config(text=text, fg=self.colors[level])
+    
+    def toggle_shuffle(self):
+        self.engine.set_shuffle(not self.engine.shuffle_mode)
+        self.update_mode_buttons()
     
     def toggle_repeat(self):
-        self.repeat_mode = not self.repeat_mode
-        if self.repeat_mode:
-            self.repeat_button.config(text="🔁 Repeat: ON")
-            # Create active style for repeat
-            self.style.configure('Repeat.Active.TButton',
+        self.engine.set_repeat(not self.engine.repeat_mode)
+        self.update_mode_buttons()
+    
+    def toggle_gapless(self):
+        self.engine.set_gapless(not self.engine.gapless_mode)
+        self.update_mode_buttons()
+    
+    def update_mode_buttons(self):
+        """Show whether shuffle, repeat and gapless playback are on"""
+        for button, label, name, enabled in (
+            (self.shuffle_button, "🔀 Shuffle", 'Shuffle', self.engine.shuffle_mode),
+            (self.repeat_button, "🔁 Repeat", 'Repeat', self.engine.repeat_mode),
+            (self.gapless_button, "🔗 Gapless", 'Gapless', self.engine.gapless_mode),
+        ):
+            if enabled:
+                button.config(text=f"{label}: ON")
+                # Create active style for the mode
+                self.style.configure(f'{name}.Active.TButton',
+                                   background=self.colors['success'],
+                                   foreground=self.colors['text_primary'])
+                button.config(style=f'{name}.Active.TButton')
+            else:
+                button.config(text=f"{label}: OFF", style='Secondary.TButton')
+    
+    def toggle_watch(self):
+        self.watch_enabled = not self.watch_enabled
+        self.update_watch_button()
+        self.save_watch_state()
+        if self.watch_enabled:
+            self.start_watching()
+        else:
+            self.stop_watching()
+    
+    def update_watch_button(self):
+        if self.watch_enabled:
+            self.watch_button.config(text="👁 Watch: ON")
+            # Create active style for folder watching
+            self.style.configure('Watch.Active.TButton',
                                background=self.colors['success'],
                                foreground=self.colors['text_primary'])
-            self.repeat_button.config(style='Repeat.Active.TButton')
+            self.watch_button.config(style='Watch.Active.TButton')
         else:
-            self.repeat_button.config(text="🔁 Repeat: OFF", style='Secondary.TButton')
+            self.watch_button.config(text="👁 Watch: OFF", style='Secondary.TButton')
+    
+    def save_watch_state(self):
+        """Remember the opened folder and whether it is watched, for the next start"""
+        try:
+            self.engine.playlist_store.set_state('watch', {'enabled': self.watch_enabled})
+            self.engine.set_playlist_folder(self.watched_folder)
+        except sqlite3.Error as e:
+            print(f"Could not save watch state: {e}")
+    
+    def start_watching(self):
+        """Follow changes in the opened folder, if watching is on"""
+        self.stop_watching()
+        if not self.watch_enabled or not self.watched_folder or not os.path.isdir(self.watched_folder):
+            return
+        self.watcher = LibraryWatcher(self.watched_folder)
+        self.watcher.start()
+        self.root.after(WATCH_APPLY_INTERVAL, self.poll_watcher, self.watcher)
+    
+    def stop_watching(self):
+        if self.watcher:
+            self.watcher.cancel()
+            self.watcher = None
+    
+    def poll_watcher(self, watcher):
+        """Apply the changes the watcher has seen to the playlist"""
+        if watcher is not self.watcher:
+            return
+        
+        changes = watcher.get_changes()
+        if changes:
+            added, removed = self.engine.apply_library_changes(changes)
+            if added or removed:
+                self.status_label.config(
+                    text=f"Library updated: {added} added, {removed} removed",
+                    fg=self.colors['accent']
+                )
+        self.root.after(WATCH_APPLY_INTERVAL, self.poll_watcher, watcher)
         
     def set_volume(self, value):
-        volume = float(value) / 100
-        pygame.mixer.music.set_volume(volume)
+        self.engine.set_volume(float(value) / 100)
     
-    def check_music_end(self):
-        # Update progress bar and time if playing
-        if self.is_playing and not self.seeking and self.song_length > 0:
-            # Get current position in milliseconds since the song started
-            pos_ms = pygame.mixer.music.get_pos()
-            
-            # get_pos() returns time since music.play() was called
-            # Convert to seconds and add to our tracked position from seeks
-            if pos_ms >= 0:
-                current_time = self.current_position + (pos_ms / 1000.0)
-                
-                # Make sure we don't exceed song length
-                if current_time <= self.song_length:
-                    self.progress_var.set(current_time)
-                    
-                    # Update time labels
-                    remaining = max(0, self.song_length - current_time)
-                    self.time_elapsed_label.config(text=self.format_time(current_time))
-                    self.time_remaining_label.config(text=self.format_time(remaining))
-        
-        # Check if music has ended by checking if it's busy playing
-        if self.is_playing and not pygame.mixer.music.get_busy():
-            # Music ended, play next
-            self.play_next()
+    def schedule_progress_update(self):
+        """Schedule the next progress refresh while a track is playing"""
+        if self.progress_job is not None or not self.engine.is_playing:
+            return
         
-        # Schedule next check
-        self.root.after(100, self.check_music_end)
+        interval = PROGRESS_INTERVAL_VISIBLE if self.window_visible else PROGRESS_INTERVAL_MINIMIZED
         
-    def load_last_directory(self):
-        """Load the last opened directory from config file"""
-        try:
-            if os.path.exists(self.config_file):
-                with open(self.config_file, 'r') as f:
-                    config = json.load(f)
-                    return config.get('last_directory', None)
-        except (json.JSONDecodeError, FileNotFoundError):
-            pass
-        return None
+        # Wake up right at the end of the track (or the start of a crossfade) rather than a full interval later
+        remaining = self.engine.get_time_until_transition()
+        if remaining is not None and remaining > 0:
+            interval = max(10, min(interval, int(remaining * 1000) + 10))
+        
+        self.progress_job = self.root.after(interval, self.update_progress)
     
-    def save_last_directory(self):
-        """Save the last opened directory to config file"""
-        try:
-            config = {}
-            if os.path.exists(self.config_file):
-                try:
-                    with open(self.config_file, 'r') as f:
-                        config = json.load(f)
-                except json.JSONDecodeError:
-                    config = {}
-            
-            config['last_directory'] = self.last_directory
-            
-            with open(self.config_file, 'w') as f:
-                json.dump(config, f, indent=2)
-        except Exception as e:
-            print(f"Could not save config: {e}")
+    def cancel_progress_update(self):
+        """Stop refreshing progress, e.g. while paused or stopped"""
+        if self.progress_job is not None:
+            self.root.after_cancel(self.progress_job)
+            self.progress_job = None
     
-    def save_playlist(self):
-        """Save current playlist to file"""
-        try:
-            playlist_data = {
-                'playlist': self.playlist,
-                'current_index': self.current_index,
-                'last_saved': os.path.getctime(self.playlist[0]) if self.playlist else 0
-            }
-            
-            with open(self.playlist_file, 'w') as f:
-                json.dump(playlist_data, f, indent=2)
-        except Exception as e:
-            print(f"Could not save playlist: {e}")
+    @profiled('progress_tick')
+    def update_progress(self):
+        """Update the progress bar and time labels, and advance when the track ends"""
+        self.progress_job = None
+        
+        # Moves on to the next track if the current one has finished
+        self.engine.poll()
+        
+        if self.engine.is_playing and self.window_visible and not self.seeking:
+            self.show_position()
+        
+        self.schedule_progress_update()
+    
+    def show_position(self):
+        """Move the progress bar and time labels to the playback position"""
+        # Labels only show whole seconds, so skip redundant widget updates
+        song_length = self.engine.song_length
+        if song_length <= 0:
+            return
+        current_time = min(self.engine.get_playback_position(), song_length)
+        second = int(current_time)
+        if second != self.displayed_second:
+            self.displayed_second = second
+            self.progress_var.set(current_time)
+            self.waveform.set_position(current_time / song_length)
+            remaining = max(0, song_length - current_time)
+            self.time_elapsed_label.config(text=self.format_time(current_time))
+            self.time_remaining_label.config(text=self.format_time(remaining))
+    
+    def on_window_map(self, event):
+        if event.widget is self.root:
+            self.window_visible = True
+            self.displayed_second = None
+            # Reschedule so the faster visible rate applies straight away
+            self.cancel_progress_update()
+            self.schedule_progress_update()
+    
+    def on_window_unmap(self, event):
+        if event.widget is self.root:
+            self.window_visible = False
+        
+    def save_last_directory(self):
+        """Remember the last opened directory; the settings file is written in the background"""
+        self.engine.persistence.set('last_directory', self.last_directory)
     
     def load_saved_playlist(self):
-        """Load saved playlist and remove deleted files"""
+        """Show the saved playlist right away and check for deleted files in the background"""
         try:
-            if not os.path.exists(self.playlist_file):
-                return
-                
-            with open(self.playlist_file, 'r') as f:
-                playlist_data = json.load(f)
+            self.update_playlist_picker()
+            watch_state = self.engine.playlist_store.get_state('watch')
+            if watch_state:
+                # Older versions kept the one watched folder here rather than with the playlist
+                self.watched_folder = self.engine.get_playlist_folder() or watch_state.get('folder')
+                self.watch_enabled = watch_state.get('enabled', False)
+                self.update_watch_button()
+                self.start_watching()
             
-            saved_playlist = playlist_data.get('playlist', [])
-            if not saved_playlist:
+            missing = self.engine.load_saved_playlist()
+            if missing is None:
                 return
             
-            # Filter out deleted files
-            existing_files = []
-            for file_path in saved_playlist:
-                if os.path.exists(file_path):
-                    existing_files.append(file_path)
+            # Tracks skipped while looking for the current one are already known to be gone
+            self.missing_paths = {self.engine.playlist[index] for index in missing}
+            self.update_playlist_display()
+            # The track may have been left part way through
+            self.displayed_second = None
+            self.show_position()
+            self.status_label.config(
+                text=f"Loaded {len(self.engine.playlist)} saved tracks (checking files...)",
+                fg=self.colors['accent']
+            )
             
-            if existing_files:
-                self.playlist = existing_files
-                self.current_index = min(playlist_data.get('current_index', 0), len(existing_files) - 1)
-                self.update_playlist_display()
-                
-                # Load the current song so buttons are enabled
-                self.load_song(self.current_index)
-                
-                # Update status
-                removed_count = len(saved_playlist) - len(existing_files)
-                if removed_count > 0:
-                    self.status_label.config(
-                        text=f"Loaded {len(existing_files)} tracks ({removed_count} deleted files removed)",
-                        fg=self.colors['warning']
-                    )
-                else:
-                    self.status_label.config(
-                        text=f"Loaded {len(existing_files)} saved tracks",
-                        fg=self.colors['success']
-                    )
-                
-                # Save updated playlist (without deleted files)
-                self.save_playlist()
+            # Check the rest of the playlist without blocking startup
+            self.validator = PathValidator(self.engine.playlist)
+            self.validator.start()
+            self.root.after(200, self.poll_validation, self.validator)
             
-        except (json.JSONDecodeError, FileNotFoundError, Exception) as e:
+        except Exception as e:
             print(f"Could not load saved playlist: {e}")
+    
+    def discard_validation(self):
+        """Stop checking the saved playlist for deleted files"""
+        if self.validator:
+            self.validator.cancel()
+            self.validator = None
+        if self.relinker:
+            self.relinker.cancel()
+            self.relinker = None
+        self.missing_paths = set()
+    
+    def poll_validation(self, validator):
+        """Mark deleted files as they are found, then remove them from the playlist"""
+        if validator is not self.validator:
+            return
+        
+        # Paths rather than indexes, as the watcher may add or remove tracks meanwhile
+        found = set(validator.get_missing()) - self.missing_paths
+        if found:
+            self.missing_paths |= found
+            self.playlist_box.render()
+        
+        if not validator.is_done():
+            self.root.after(200, self.poll_validation, validator)
+            return
+        
+        self.validator = None
+        if not self.missing_paths:
+            self.finish_validation(0, set())
+            return
+        
+        # Look for missing files that were moved before giving up on them
+        paths = set(self.missing_paths)
+        self.relinker = TrackRelinker(paths, self.engine.metadata_cache, (self.watched_folder, self.last_directory))
+        self.relinker.start()
+        self.status_label.config(text=f"Looking for {len(paths)} moved files...", fg=self.colors['accent'])
+        self.root.after(200, self.poll_relink, self.relinker)
+    
+    def poll_relink(self, relinker):
+        """Once moved files have been looked for, relink the ones found and remove the rest"""
+        if relinker is not self.relinker:
+            return
+        if not relinker.is_done():
+            self.root.after(200, self.poll_relink, relinker)
+            return
+        
+        self.relinker = None
+        relinked = self.engine.relink_tracks(relinker.relinked)
+        # Files the watcher saw come back are no longer missing
+        missing = {path for path in set(relinker.paths) - set(relinker.relinked) if not os.path.exists(path)}
+        removed = {index for index, file_path in enumerate(self.engine.playlist) if file_path in missing}
+        self.finish_validation(relinked, removed)
+    
+    def finish_validation(self, relinked, removed):
+        """Remove the files that are gone for good and report what was found"""
+        self.missing_paths = set()
+        relinked_text = f", {relinked} moved files relinked" if relinked else ""
+        
+        if removed:
+            self.engine.remove_tracks(removed)
+            self.status_label.config(
+                text=f"Loaded {len(self.engine.playlist)} tracks ({len(removed)} deleted files removed{relinked_text})",
+                fg=self.colors['warning']
+            )
+        elif relinked:
+            self.status_label.config(
+                text=f"Loaded {len(self.engine.playlist)} tracks ({relinked} moved files relinked)",
+                fg=self.colors['success']
+            )
+        elif not self.engine.is_playing:
+            self.status_label.config(
+                text=f"Loaded {len(self.engine.playlist)} saved tracks",
+                fg=self.colors['success']
+            )
+
+
+class ControlServer(PlaybackListener):
+    """Headless front end: a line-based command protocol on a Unix domain socket
+
+    Each command is one line and gets one line of JSON back:
+      status | play [index] | pause | stop | next | previous
+      seek <seconds> | volume <0-100> | enqueue <file or folder>
+      shuffle on|off | repeat on|off | gapless on|off
+      replaygain on|off | crossfade <seconds> (buffered mixer only)
+    """
+
+    def __init__(self, socket_path, output=None):
+        self.socket_path = socket_path
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}
+        self.scanners = []
+        self.engine = PlaybackEngine(self, output)
+        self.engine.init_audio()
+        self.server = None
+
+    def on_status(self, text, level):
+        print(text)
+
+    def start(self):
+        """Listen on the socket, replacing a stale one left by a crashed daemon"""
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                probe.close()
+                raise RuntimeError(f"Another Audion is already listening on {self.socket_path}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.socket_path)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.server.listen()
+        self.server.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ, self.accept)
+
+    def serve_forever(self):
+        """Handle clients until interrupted, sleeping while nothing is playing"""
+        try:
+            while True:
+                for key, _ in self.selector.select(self.get_timeout()):
+                    key.data(key.fileobj)
+                self.poll_scanners()
+                self.engine.poll()
+        finally:
+            self.close()
+
+    def get_timeout(self):
+        """How long select may block before playback or a scan needs attention"""
+        if self.scanners:
+            return 0.1
+        if not self.engine.is_playing:
+            return None
+        remaining = self.engine.get_time_until_transition()
+        if remaining is None or remaining <= 0:
+            return PROGRESS_INTERVAL_MINIMIZED / 1000
+        return min(PROGRESS_INTERVAL_MINIMIZED / 1000, remaining + 0.01)
+
+    def accept(self, server):
+        try:
+            client, _ = server.accept()
+        except BlockingIOError:
+            return
+        client.setblocking(False)
+        self.buffers[client] = b""
+        self.selector.register(client, selectors.EVENT_READ, self.read)
+
+    def read(self, client):
+        try:
+            data = client.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.disconnect(client)
+            return
+
+        self.buffers[client] += data
+        while b"\n" in self.buffers.get(client, b""):
+            line, self.buffers[client] = self.buffers[client].split(b"\n", 1)
+            reply = self.handle_command(line.decode('utf-8', 'surrogateescape').strip())
+            try:
+                client.sendall((json.dumps(reply) + "\n").encode('utf-8'))
+            except OSError:
+                self.disconnect(client)
+                return
+
+    def disconnect(self, client):
+        self.selector.unregister(client)
+        self.buffers.pop(client, None)
+        client.close()
+
+    def handle_command(self, line):
+        """Run one command line and return the reply"""
+        command, _, argument = line.partition(" ")
+        argument = argument.strip()
+        engine = self.engine
+        try:
+            if command == 'status':
+                pass
+            elif command == 'play':
+                if argument:
+                    engine.load_and_play(int(argument))
+                elif engine.current_file:
+                    engine.play()
+                else:
+                    engine.load_and_play(0)
+            elif command == 'pause':
+                engine.pause()
+            elif command == 'stop':
+                engine.stop()
+            elif command == 'next':
+                engine.play_next()
+            elif command == 'previous':
+                engine.play_previous()
+            elif command == 'seek':
+                engine.seek(float(argument))
+            elif command == 'volume':
+                engine.set_volume(max(0, min(100, float(argument))) / 100)
+            elif command == 'crossfade':
+                engine.set_crossfade(float(argument))
+            elif command == 'enqueue':
+                self.enqueue(os.path.expanduser(argument))
+            elif command == 'export':
+                if not argument.lower().endswith(PLAYLIST_EXTENSIONS):
+                    raise ValueError(f"export expects a {', '.join(PLAYLIST_EXTENSIONS)} file")
+                engine.export_playlist(os.path.expanduser(argument))
+            elif command == 'queue':
+                if argument == 'clear':
+                    engine.clear_queue()
+                else:
+                    index = int(argument)
+                    if not 0 <= index < len(engine.playlist):
+                        raise ValueError(f"No track at index {index}")
+                    engine.add_to_queue([index])
+            elif command == 'playlist':
+                if not argument:
+                    raise ValueError("playlist expects a name")
+                # Scans still running belong to the playlist being left
+                for scanner in self.scanners:
+                    scanner.cancel()
+                self.scanners = []
+                engine.open_playlist(argument)
+            elif command == 'playlists':
+                # Track counts come from the database, so write pending changes first
+                engine.persistence.flush()
+                return {'ok': True, 'playlists': [
+                    {'name': name, 'tracks': tracks, 'current': playlist_id == engine.playlist_id}
+                    for playlist_id, name, tracks in engine.list_playlists()
+                ]}
+            elif command in ('shuffle', 'repeat', 'gapless', 'replaygain'):
+                if argument not in ('on', 'off'):
+                    raise ValueError(f"{command} expects on or off")
+                getattr(engine, f"set_{command}")(argument == 'on')
+            else:
+                return {'ok': False, 'error': f"Unknown command: {command}"}
+        except (ValueError, OSError) as e:
+            return {'ok': False, 'error': str(e)}
+
+        reply = {'ok': True}
+        reply.update(engine.get_status())
+        return reply
+
+    def enqueue(self, path):
+        """Add a file, every track of a playlist file, or every audio file under a folder, to the end of the playlist"""
+        if os.path.isdir(path):
+            scanner = LibraryScanner(path)
+            scanner.start()
+            self.scanners.append(scanner)
+        elif os.path.isfile(path) and path.lower().endswith(PLAYLIST_EXTENSIONS):
+            importer = PlaylistImporter(path, self.engine.metadata_cache)
+            importer.start()
+            self.scanners.append(importer)
+        elif os.path.isfile(path) and path.lower().endswith(AUDIO_EXTENSIONS):
+            self.engine.append_tracks([os.path.abspath(path)])
+        else:
+            raise ValueError(f"Not an audio file, playlist or folder: {path}")
+
+    def poll_scanners(self):
+        for scanner in list(self.scanners):
+            batch = scanner.get_batch()
+            if batch:
+                self.engine.append_tracks(batch)
+            if scanner.is_done():
+                self.scanners.remove(scanner)
+
+    def close(self):
+        for scanner in self.scanners:
+            scanner.cancel()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+        if self.server is not None and os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.engine.close()
+
+
+def connect_instance(address_path):
+    """Connect to a running instance's socket: a Unix socket, or a localhost port saved in a file"""
+    if hasattr(socket, 'AF_UNIX'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = address_path
+    else:
+        with open(address_path) as f:
+            address = ('127.0.0.1', int(f.read()))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(INSTANCE_TIMEOUT)
+    try:
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def send_to_instance(address_path, commands):
+    """Send command lines to a running instance and return its replies, or None if none is running"""
+    try:
+        sock = connect_instance(address_path)
+    except (OSError, ValueError):
+        return None
+    data = b""
+    with sock:
+        try:
+            sock.sendall("".join(f"{command}\n" for command in commands).encode('utf-8', 'surrogateescape'))
+            sock.shutdown(socket.SHUT_WR)
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        except OSError as e:
+            # The commands may already have been handled, so don't start a second instance
+            print(f"Could not hear back from the running Audion: {e}")
+    return [json.loads(line) for line in data.decode('utf-8').splitlines() if line]
+
+
+class InstanceServer:
+    """Take commands from later launches on a background thread, so they can hand over their files
+
+    Uses the headless line protocol with two commands, open <path> and show.
+    Listens on a Unix socket, or where there are none, on a localhost port
+    saved in a file at the socket's path. The window collects the commands
+    with get_commands.
+    """
+
+    COMMANDS = ('open', 'show')
+
+    def __init__(self, address_path):
+        self.address_path = address_path
+        self.commands = queue.Queue()
+        self.server = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        """Start listening, replacing a stale socket; raises RuntimeError if another window is listening"""
+        if send_to_instance(self.address_path, []) is not None:
+            raise RuntimeError(f"Another Audion is already listening on {self.address_path}")
+        if hasattr(socket, 'AF_UNIX'):
+            if os.path.exists(self.address_path):
+                os.unlink(self.address_path)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(self.address_path)
+            os.chmod(self.address_path, 0o600)
+        else:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.bind(('127.0.0.1', 0))
+            temp_path = f"{self.address_path}.tmp"
+            with open(temp_path, 'w') as f:
+                f.write(str(self.server.getsockname()[1]))
+            os.replace(temp_path, self.address_path)
+        self.server.listen()
+        self.thread.start()
+
+    def run(self):
+        # close() clears self.server, so keep the socket this thread accepts on
+        server = self.server
+        while True:
+            try:
+                client, _ = server.accept()
+            except OSError:
+                # Closed
+                return
+            with client:
+                client.settimeout(INSTANCE_TIMEOUT)
+                try:
+                    self.handle(client)
+                except OSError as e:
+                    print(f"Could not read from a new Audion launch: {e}")
+
+    def handle(self, client):
+        """Queue the commands of one connection, which ends when the client stops sending"""
+        data = b""
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        replies = []
+        for line in data.decode('utf-8', 'surrogateescape').splitlines():
+            command, _, argument = line.strip().partition(" ")
+            if command in self.COMMANDS:
+                self.commands.put((command, argument.strip()))
+                replies.append({'ok': True})
+            elif command:
+                replies.append({'ok': False, 'error': f"Unknown command: {command}"})
+        client.sendall("".join(json.dumps(reply) + "\n" for reply in replies).encode('utf-8'))
+
+    def get_commands(self):
+        """Collect the (command, argument) pairs received so far"""
+        commands = []
+        while True:
+            try:
+                commands.append(self.commands.get_nowait())
+            except queue.Empty:
+                return commands
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            # Wakes up the thread blocked in accept
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
+        self.server = None
+        try:
+            os.unlink(self.address_path)
+        except OSError:
+            pass
+
+
+def run_headless(socket_path, output=None, replaygain=True, paths=()):
+    """Play without a window, controlled through the local socket, after adding paths to the playlist"""
+    if not hasattr(socket, 'AF_UNIX'):
+        print("Headless mode needs Unix domain sockets, which this platform does not support")
+        return
+
+    # There is no display on a headless box; pygame only needs its event queue
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+    # Exit cleanly (removing the socket) when the service is stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    server = ControlServer(socket_path, output)
+    try:
+        server.start()
+    except (RuntimeError, OSError) as e:
+        print(f"Could not start headless mode: {e}")
+        server.engine.close()
+        return
+
+    server.engine.replaygain = replaygain
+    server.engine.load_saved_playlist()
+    for path in paths:
+        try:
+            server.enqueue(path)
+        except ValueError as e:
+            print(e)
+    print(f"Audion listening on {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
 
 
 def main():
+    # Fingerprinting worker processes start from a fresh interpreter, which frozen builds need to support
+    multiprocessing.freeze_support()
+    
+    parser = argparse.ArgumentParser(description="Audion - A simple music player")
+    parser.add_argument('paths', nargs='*', metavar='PATH',
+                        help="audio files, playlist files or a folder to open; if Audion is already "
+                             "running they are handed to it instead of starting another player")
+    parser.add_argument('--headless', action='store_true',
+                        help="run without a window, controlled through a local socket")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH,
+                        help=f"control socket for headless mode (default: {DEFAULT_SOCKET_PATH})")
+    parser.add_argument('--profile', action='store_true',
+                        help="record timings of startup and hot paths and print a summary on exit "
+                             "(also enabled by setting AUDION_PROFILE)")
+    parser.add_argument('--profile-output', metavar='FILE', default=os.environ.get('AUDION_PROFILE_OUTPUT'),
+                        help="also run cProfile and save its statistics to FILE for pstats")
+    parser.add_argument('--mixer', choices=('music', 'buffered'),
+                        help="music streams each track; buffered decodes tracks into memory, "
+                             "which crossfading needs (default: music, or buffered with --crossfade)")
+    parser.add_argument('--crossfade', type=float, default=0, metavar='SECONDS',
+                        help="fade each track into the next over this many seconds")
+    parser.add_argument('--no-replaygain', action='store_true',
+                        help="play every track at the same volume instead of evening out their loudness")
+    args = parser.parse_args()
+    paths = [os.path.abspath(path) for path in args.paths]
+    
+    # Hand the paths to a player that is already running, before paying for a second startup
+    if args.headless:
+        replies = send_to_instance(args.socket, [f"enqueue {path}" for path in paths]) if paths else None
+    else:
+        replies = send_to_instance(INSTANCE_SOCKET_PATH, [f"open {path}" for path in paths] + ["show"])
+    if replies is not None:
+        for reply in replies:
+            if not reply.get('ok'):
+                print(reply.get('error'))
+        return
+    
+    if args.crossfade < 0:
+        parser.error("--crossfade can't be negative")
+    if args.crossfade and args.mixer == 'music':
+        parser.error("--crossfade needs --mixer buffered")
+    if args.mixer == 'buffered' or args.crossfade:
+        output = BufferedOutput(args.crossfade)
+    else:
+        output = MusicOutput()
+    
+    if args.profile or args.profile_output or os.environ.get('AUDION_PROFILE'):
+        profiler.enable(args.profile_output)
+    
+    if args.headless:
+        run_headless(args.socket, output, not args.no_replaygain, paths)
+        return
+    
+    instance_server = InstanceServer(INSTANCE_SOCKET_PATH)
+    try:
+        instance_server.start()
+    except (RuntimeError, OSError) as e:
+        print(f"Could not listen for later launches: {e}")
+        instance_server = None
+    
     root = tk.Tk()
-    app = Audion(root)
+    Audion(root, output, paths, instance_server, not args.no_replaygain)
     root.mainloop()
 
 if __name__ == "__main__":
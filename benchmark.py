@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for playlist-scale operations
+
+Builds synthetic libraries of 1k, 10k and 100k tracks, times scanning,
+rendering, saving, restoring and shuffle playback on each, and writes the
+results as JSON so runs from different commits can be compared.
+"""
+import os
+import json
+import time
+import wave
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import statistics
+import tkinter as tk
+
+# Play through a silent driver and never open a pygame window
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import audion
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+TRACKS_PER_FOLDER = 100
+PLAY_NEXT_CALLS = 100
+
+
+def write_template(path):
+    """Write a very short silent WAV file that every synthetic track links to"""
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(8000)
+        f.writeframes(bytes(800))
+
+
+def build_library(workdir, size):
+    """Create size tracks in artist/album folders, as hard links to one template file"""
+    template = os.path.join(workdir, 'template.wav')
+    write_template(template)
+    library = os.path.join(workdir, 'library')
+    for index in range(size):
+        folder = os.path.join(library, f"artist {index // 1000:03}", f"album {index // TRACKS_PER_FOLDER:04}")
+        if index % TRACKS_PER_FOLDER == 0:
+            os.makedirs(folder)
+        path = os.path.join(folder, f"{index % TRACKS_PER_FOLDER:02} track {index}.wav")
+        try:
+            os.link(template, path)
+        except OSError:
+            # File systems without hard links
+            shutil.copyfile(template, path)
+    return library
+
+
+def summarize(times):
+    """Seconds per run: how many runs, and the best, mean and worst"""
+    return {
+        'runs': len(times),
+        'min': min(times),
+        'mean': statistics.mean(times),
+        'max': max(times),
+    }
+
+
+def timed(function, repeat):
+    """Run function repeat times and summarize how long each run took"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return summarize(times)
+
+
+def pump(root, done):
+    """Process Tk events until done() is true"""
+    while not done():
+        root.update()
+        time.sleep(0.001)
+
+
+def create_app():
+    """The player with a hidden window, or (None, None) if Tk has no display"""
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print(f"No display, running engine-level benchmarks only: {e}")
+        return None, None
+    root.withdraw()
+    app = audion.Audion(root)
+    # Let the deferred parts of startup run
+    pump(root, lambda: 'ready' in app.startup_times)
+    return root, app
+
+
+def open_folder(root, app, engine, library):
+    """Scan the library into the playlist the way the Open Folder button does"""
+    if app is not None:
+        audion.filedialog.askdirectory = lambda **kwargs: library
+        app.open_folder()
+        pump(root, lambda: app.scanner is None)
+        return
+
+    engine.stop()
+    engine.set_playlist([])
+    scanner = audion.LibraryScanner(library)
+    scanner.start()
+    while True:
+        done = scanner.is_done()
+        batch = scanner.get_batch()
+        if batch:
+            engine.append_tracks(batch)
+        elif done:
+            break
+        else:
+            time.sleep(0.001)
+    engine.sort_playlist()
+
+
+def load_saved_playlist(root, app, engine):
+    """Restore the saved playlist, including the background check for deleted files"""
+    if app is not None:
+        app.load_saved_playlist()
+        pump(root, lambda: app.validator is None)
+        return
+    engine.load_saved_playlist()
+
+
+def save_playlist(engine):
+    """Save the playlist and wait for the background write, so the time includes the disk write"""
+    engine.save_playlist()
+    engine.persistence.flush()
+
+
+def play_next_shuffle(engine):
+    """Time successive shuffle play_next calls, each loading a new track"""
+    engine.set_shuffle(True)
+    engine.load_and_play(0)
+    times = []
+    for _ in range(PLAY_NEXT_CALLS):
+        started = time.perf_counter()
+        engine.play_next()
+        times.append(time.perf_counter() - started)
+    engine.stop()
+    engine.set_shuffle(False)
+    return summarize(times)
+
+
+def run_size(size, repeat, use_ui):
+    """Run every benchmark on a fresh library and settings folder of the given size"""
+    with tempfile.TemporaryDirectory(prefix='audion-bench-') as workdir:
+        # Audion keeps its playlist and caches in the home folder
+        home = os.path.join(workdir, 'home')
+        os.makedirs(home)
+        os.environ['HOME'] = home
+        os.environ['USERPROFILE'] = home
+
+        started = time.perf_counter()
+        library = build_library(workdir, size)
+        results = {'build_library': summarize([time.perf_counter() - started])}
+
+        root, app = create_app() if use_ui else (None, None)
+        engine = app.engine if app is not None else audion.PlaybackEngine()
+        # Background analysis would compete with the timed work and outlive the library
+        engine.analyzer.close()
+        try:
+            results['open_folder'] = timed(lambda: open_folder(root, app, engine, library), repeat)
+            if app is not None:
+                results['update_playlist_display'] = timed(app.update_playlist_display, repeat)
+            # Time spent on the calling thread, then including the write itself,
+            # with the scan's own writes out of the way first
+            engine.persistence.flush()
+            results['save_playlist'] = timed(engine.save_playlist, repeat)
+            results['save_playlist_flushed'] = timed(lambda: save_playlist(engine), repeat)
+            results['load_saved_playlist'] = timed(lambda: load_saved_playlist(root, app, engine), repeat)
+            results['play_next_shuffle'] = play_next_shuffle(engine)
+        finally:
+            engine.close()
+            if root is not None:
+                root.destroy()
+        return results
+
+
+def get_commit():
+    """The current git commit, if this is a git checkout"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Audion on large synthetic playlists")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="library sizes in tracks (default: 1000 10000 100000)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark (default: 3)")
+    parser.add_argument('--output', default='benchmark-results.json', help="where to write the JSON results")
+    parser.add_argument('--no-ui', action='store_true', help="benchmark the playback engine without a Tk window")
+    args = parser.parse_args()
+
+    report = {
+        'commit': get_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'ui': not args.no_ui,
+        'sizes': {},
+    }
+
+    for size in args.sizes:
+        print(f"Benchmarking {size} tracks...")
+        results = run_size(size, args.repeat, not args.no_ui)
+        report['sizes'][str(size)] = results
+        for name, result in results.items():
+            print(f"  {name:<26} min {result['min'] * 1000:10.1f} ms   mean {result['mean'] * 1000:10.1f} ms")
+
+    # A missing display only shows up once the first window is attempted
+    report['ui'] = report['ui'] and all('update_playlist_display' in results for results in report['sizes'].values())
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ Build script for creating Audion executable
 """
 import os
 import sys
+import argparse
 import subprocess
 import platform
 
@@ -16,7 +17,7 @@ def install_pyinstaller():
         print("📦 Installing PyInstaller...")
         subprocess.check_call([sys.executable, "-m", "pip", "install", "pyinstaller"])
 
-def create_spec_file():
+def create_spec_file(onedir=False):
     """Create PyInstaller spec file for customization"""
     system = platform.system()
     
@@ -29,6 +30,26 @@ def create_spec_file():
     elif system == 'Linux' and os.path.exists('assets/audion.png'):
         icon_path = 'assets/audion.png'
     
+    if onedir:
+        # Binaries and data sit next to the executable instead of being packed
+        # into it, so nothing has to be extracted to a temp folder at launch
+        exe_contents = "    [],\n    exclude_binaries=True,"
+        collect = '''
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.zipfiles,
+    a.datas,
+    strip=False,
+    upx=True,
+    upx_exclude=[],
+    name='Audion',
+)
+'''
+    else:
+        exe_contents = "    a.binaries,\n    a.zipfiles,\n    a.datas,\n    [],"
+        collect = ""
+    
     spec_content = f'''# -*- mode: python ; coding: utf-8 -*-
 
 block_cipher = None
@@ -54,10 +75,7 @@ pyz = PYZ(a.pure, a.zipped_data, cipher=block_cipher)
 exe = EXE(
     pyz,
     a.scripts,
-    a.binaries,
-    a.zipfiles,
-    a.datas,
-    [],
+{exe_contents}
     name='Audion',
     debug=False,
     bootloader_ignore_signals=False,
@@ -73,19 +91,19 @@ exe = EXE(
     entitlements_file=None,
     icon='{icon_path}' if icon_path else None,
 )
-'''
+{collect}'''
     
     with open('audion.spec', 'w') as f:
         f.write(spec_content)
     print("✅ Created audion.spec file")
 
-def build_executable():
+def build_executable(onedir=False):
     """Build the executable"""
     system = platform.system()
-    print(f"🔨 Building executable for {system}...")
+    print(f"🔨 Building {'folder' if onedir else 'executable'} for {system}...")
     
     # Create spec file first
-    create_spec_file()
+    create_spec_file(onedir)
     
     # Build using spec file
     cmd = [sys.executable, "-m", "PyInstaller", "--clean", "audion.spec"]
@@ -95,10 +113,11 @@ def build_executable():
         print(f"✅ Executable created successfully!")
         
         # Show location
+        exe_dir = "dist/Audion" if onedir else "dist"
         if system == "Windows":
-            exe_path = "dist/Audion.exe"
+            exe_path = f"{exe_dir}/Audion.exe"
         else:
-            exe_path = "dist/Audion"
+            exe_path = f"{exe_dir}/Audion"
             
         if os.path.exists(exe_path):
             print(f"📍 Executable location: {os.path.abspath(exe_path)}")
@@ -118,6 +137,11 @@ def build_executable():
     return True
 
 def main():
+    parser = argparse.ArgumentParser(description="Build the Audion executable")
+    parser.add_argument('--onedir', action='store_true',
+                        help="build a folder instead of a single file; starts faster since nothing is unpacked at launch")
+    args = parser.parse_args()
+    
     print("🎵 Audion Executable Builder")
     print("=" * 30)
     
@@ -130,7 +154,7 @@ def main():
     install_pyinstaller()
     
     # Build executable
-    success = build_executable()
+    success = build_executable(args.onedir)
     
     if success:
         print("\n🎉 Build completed successfully!")
@@ -324,12 +324,12 @@ Version=1.0
 Type=Application
 Name=Audion Music Player
 Comment=A modern music player built with Python
-Exec=$EXEC_PATH
+Exec=$EXEC_PATH %F
 Icon=$ICON_PATH
 Terminal=false
 StartupNotify=true
 Categories=AudioVideo;Audio;Player;
-MimeType=audio/mpeg;audio/mp3;audio/wav;audio/ogg;audio/flac;
+MimeType=audio/mpeg;audio/mp3;audio/wav;audio/ogg;audio/flac;audio/x-mpegurl;audio/x-scpls;
 Keywords=music;audio;player;mp3;wav;ogg;flac;
 EOF
 
@@ -0,0 +1,19 @@
+import os
+import sys
+
+# audion is a single module at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from audion import PlaybackEngine
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """A PlaybackEngine keeping its files in a temporary home, with no background analysis"""
+    monkeypatch.setenv('HOME', str(tmp_path))
+    engine = PlaybackEngine()
+    engine.analyzer.close()
+    yield engine
+    engine.close()
@@ -0,0 +1,83 @@
+import math
+import sys
+from array import array
+
+import pytest
+
+import audion
+from audion import PeaksFile, analyze_audio, compute_peaks, measure_loudness, write_peaks
+
+
+def sine(amplitude, seconds, sample_rate=44100, channels=2, frequency=997):
+    """Interleaved 16-bit PCM of a sine wave in every channel"""
+    samples = array('h')
+    for index in range(int(seconds * sample_rate)):
+        value = round(amplitude * 32767 * math.sin(2 * math.pi * frequency * index / sample_rate))
+        samples.extend([value] * channels)
+    return samples.tobytes()
+
+
+def test_sine_loudness():
+    # BS.1770's reference: a full scale 997 Hz sine in one channel is -3.01 LUFS
+    pytest.importorskip('numpy')
+    assert measure_loudness(sine(1.0, 3, channels=1), 44100, 1) == pytest.approx(-3.01, abs=0.05)
+    assert measure_loudness(sine(0.5, 3), 44100, 2) == pytest.approx(-6.02, abs=0.05)
+
+
+def test_sine_loudness_without_numpy(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'numpy', None)
+    # Unweighted, so without the K-weighting's 0.69 dB lift at 997 Hz
+    assert measure_loudness(sine(1.0, 3, channels=1), 44100, 1) == pytest.approx(-3.70, abs=0.05)
+    assert measure_loudness(sine(0.5, 3), 44100, 2) == pytest.approx(-6.71, abs=0.05)
+
+
+@pytest.mark.parametrize('numpy_installed', [True, False])
+def test_silence_and_short_tracks_have_no_loudness(numpy_installed, monkeypatch):
+    if not numpy_installed:
+        monkeypatch.setitem(sys.modules, 'numpy', None)
+    assert measure_loudness(bytes(44100 * 4 * 2), 44100, 2) is None
+    assert measure_loudness(sine(0.5, 0.2), 44100, 2) is None
+
+
+def test_failed_measurement_is_not_retried(tmp_path, monkeypatch, capsys):
+    path = tmp_path / 'song.mp3'
+    path.write_bytes(b'not really audio')
+    monkeypatch.setattr(audion, 'read_replaygain', lambda file_path: None)
+    monkeypatch.setattr(audion, 'decode_pcm', lambda file_path: (sine(0.5, 1), 44100, 2))
+
+    def fail(*decoded):
+        raise ModuleNotFoundError("No module named 'audioop'")
+    monkeypatch.setattr(audion, 'measure_loudness', fail)
+
+    _, values = analyze_audio(str(path))
+    assert values['gain'] is None and values['gain_source'] == 'none'
+    assert "Could not measure" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('numpy_installed', [True, False])
+def test_peaks_per_bucket(numpy_installed, monkeypatch):
+    if numpy_installed:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setitem(sys.modules, 'numpy', None)
+    # Two stereo buckets of two frames: a square wave at half scale, then a lone full scale sample
+    data = array('h', [16384, -16384, -16384, 16384, 0, 0, -32768, 0]).tobytes()
+    peaks, rms = compute_peaks(data, 44100, 2, buckets=2)
+    assert peaks == bytes([127, 255])
+    assert rms == bytes([127, 127])
+    # Leftover frames past the last whole bucket are left out
+    assert compute_peaks(data + bytes(4), 44100, 2, buckets=2) == (peaks, rms)
+    assert compute_peaks(data[:4], 44100, 2, buckets=2) == (b'', b'')
+
+
+def test_peaks_file_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'numpy', None)
+    peaks_path = str(tmp_path / 'peaks' / 'song.peaks')
+    write_peaks(peaks_path, sine(0.5, 2), 44100, 2)
+    peaks_file = PeaksFile(peaks_path)
+    try:
+        assert peaks_file.duration == pytest.approx(2.0)
+        assert len(peaks_file.peaks) == len(peaks_file.rms) == audion.WAVEFORM_BUCKETS
+        assert max(peaks_file.peaks) == 127 and min(peaks_file.peaks) >= 120
+    finally:
+        peaks_file.close()
@@ -0,0 +1,64 @@
+import os
+import socket
+
+import pytest
+
+from audion import InstanceServer, send_to_instance
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = InstanceServer(str(tmp_path / 'audion.sock'))
+    server.start()
+    yield server
+    server.close()
+
+
+def test_nothing_to_send_to(tmp_path):
+    assert send_to_instance(str(tmp_path / 'audion.sock'), ["show"]) is None
+
+
+def test_files_are_handed_over(server):
+    paths = ['/music/with spaces.mp3', '/music/caf\udce9.mp3']
+    replies = send_to_instance(server.address_path, [f"open {path}" for path in paths] + ["show"])
+    assert replies == [{'ok': True}] * 3
+    # Replies come once the commands are queued, so they are there straight away
+    assert server.get_commands() == [('open', paths[0]), ('open', paths[1]), ('show', '')]
+    assert server.get_commands() == []
+
+
+def test_unknown_commands_are_refused(server):
+    replies = send_to_instance(server.address_path, ["play", "", "show"])
+    assert replies == [{'ok': False, 'error': "Unknown command: play"}, {'ok': True}]
+    assert server.get_commands() == [('show', '')]
+    # Checking for a running instance sends nothing
+    assert send_to_instance(server.address_path, []) == []
+
+
+def test_one_window_listens(server):
+    second = InstanceServer(server.address_path)
+    with pytest.raises(RuntimeError):
+        second.start()
+    second.close()
+    assert send_to_instance(server.address_path, ["show"]) == [{'ok': True}]
+
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason="needs Unix domain sockets")
+def test_stale_socket_is_replaced(tmp_path):
+    path = str(tmp_path / 'audion.sock')
+    # Left behind by a window that crashed
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    assert send_to_instance(path, ["show"]) is None
+
+    server = InstanceServer(path)
+    server.start()
+    try:
+        assert oct(os.stat(path).st_mode & 0o777) == oct(0o600)
+        assert send_to_instance(path, ["show"]) == [{'ok': True}]
+    finally:
+        server.close()
+    assert not os.path.exists(path)
+    assert send_to_instance(path, ["show"]) is None
+    server.close()
@@ -0,0 +1,133 @@
+import os
+import time
+
+import pytest
+
+from audion import LibraryWatcher
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb'):
+        pass
+    return path
+
+
+def poll(watcher, *folders):
+    """Poll once, after moving the folders' mtimes on in case the clock is coarser than the test"""
+    for folder in folders:
+        mtime = os.stat(folder).st_mtime + 1
+        os.utime(folder, (mtime, mtime))
+    watcher.poll_folders()
+    return watcher.get_changes()
+
+
+@pytest.fixture
+def library(tmp_path):
+    root = str(tmp_path / 'music')
+    touch(os.path.join(root, 'Artist', 'Album', '01.mp3'))
+    touch(os.path.join(root, 'Artist', 'Album', 'cover.jpg'))
+    touch(os.path.join(root, 'single.ogg'))
+    return root
+
+
+@pytest.fixture
+def watcher(library):
+    watcher = LibraryWatcher(library)
+    watcher.scan_folders(library)
+    return watcher
+
+
+def test_unchanged_folders_report_nothing(watcher, library):
+    assert set(watcher.folders) == {library, os.path.join(library, 'Artist'), os.path.join(library, 'Artist', 'Album')}
+    watcher.poll_folders()
+    assert watcher.get_changes() == []
+
+
+def test_audio_files_added_and_removed(watcher, library):
+    album = os.path.join(library, 'Artist', 'Album')
+    added = touch(os.path.join(album, '02.FLAC'))
+    touch(os.path.join(album, 'notes.txt'))
+    os.remove(os.path.join(library, 'single.ogg'))
+    assert sorted(poll(watcher, album, library)) == [
+        ('added', added), ('removed', os.path.join(library, 'single.ogg'))
+    ]
+
+
+def test_renames_are_paired_by_inode(watcher, library):
+    album = os.path.join(library, 'Artist', 'Album')
+    old_path = os.path.join(album, '01.mp3')
+    new_path = os.path.join(library, '01 moved.mp3')
+    os.rename(old_path, new_path)
+    assert poll(watcher, album, library) == [('moved', old_path, new_path)]
+
+    old_folder = os.path.join(library, 'Artist')
+    new_folder = os.path.join(library, 'Renamed')
+    os.rename(old_folder, new_folder)
+    assert poll(watcher, library) == [('moved_folder', old_folder, new_folder)]
+    # The folders under it are watched at their new paths
+    assert os.path.join(new_folder, 'Album') in watcher.folders
+    added = touch(os.path.join(new_folder, 'Album', '03.mp3'))
+    assert poll(watcher, os.path.join(new_folder, 'Album')) == [('added', added)]
+
+
+def test_new_and_removed_folders(watcher, library):
+    new_folder = os.path.join(library, 'New', 'Disc 1')
+    added = touch(os.path.join(new_folder, '01.ogg'))
+    assert poll(watcher, library) == [('added', added)]
+    assert new_folder in watcher.folders
+
+    for name in os.listdir(new_folder):
+        os.remove(os.path.join(new_folder, name))
+    os.rmdir(new_folder)
+    os.rmdir(os.path.dirname(new_folder))
+    assert poll(watcher, library) == [('removed_folder', os.path.join(library, 'New'))]
+    assert new_folder not in watcher.folders
+
+
+def test_background_watch_reports_written_files(library):
+    watcher = LibraryWatcher(library, poll_interval=0.05)
+    watcher.start()
+    try:
+        # Wait until all three folders are watched, with inotify or by polling
+        deadline = time.monotonic() + 5
+        while len(watcher.watches) < 3 and len(watcher.folders) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        added = touch(os.path.join(library, 'Artist', 'Album', '02.mp3'))
+        changes = []
+        while not changes and time.monotonic() < deadline:
+            time.sleep(0.01)
+            changes = watcher.get_changes()
+    finally:
+        watcher.cancel()
+    assert changes == [('added', added)]
+
+
+def test_engine_follows_changes(engine, library):
+    album = os.path.join(library, 'Artist', 'Album')
+    playlist = [os.path.join(album, '01.mp3'), os.path.join(album, '02.mp3'), os.path.join(library, 'single.ogg')]
+    engine.set_playlist(playlist)
+    engine.metadata_cache.put(playlist[0], {'size': 0, 'mtime': 0.0, 'title': 'First'})
+
+    changes = [
+        ('moved_folder', os.path.join(library, 'Artist'), os.path.join(library, 'Renamed')),
+        ('removed', playlist[2]),
+        ('added', os.path.join(library, 'new.mp3')),
+        ('moved', os.path.join(library, 'new.mp3'), os.path.join(library, 'newer.mp3')),
+        ('added', os.path.join(library, 'gone.mp3')),
+        ('removed', os.path.join(library, 'gone.mp3')),
+    ]
+    assert engine.apply_library_changes(changes) == (1, 1)
+    renamed = os.path.join(library, 'Renamed', 'Album')
+    assert list(engine.playlist) == [
+        os.path.join(renamed, '01.mp3'), os.path.join(renamed, '02.mp3'), os.path.join(library, 'newer.mp3')
+    ]
+    assert engine.metadata_cache.peek(os.path.join(renamed, '01.mp3'))['title'] == 'First'
+    assert engine.metadata_cache.peek(playlist[0]) is None
+    engine.persistence.flush()
+    assert engine.playlist_store.load(engine.playlist_id)[0] == list(engine.playlist)
+
+    # Files already in the playlist aren't added again
+    assert engine.apply_library_changes([('added', os.path.join(library, 'newer.mp3'))]) == (0, 0)
+    assert engine.apply_library_changes([('removed_folder', os.path.join(library, 'Renamed'))]) == (0, 2)
+    assert list(engine.playlist) == [os.path.join(library, 'newer.mp3')]
@@ -0,0 +1,108 @@
+import os
+
+import pytest
+from mutagen.easyid3 import EasyID3
+
+from audion import MetadataCache
+
+# MPEG-1 Layer III, 128 kbit/s, 44.1 kHz: 417 byte frames of 1152 samples
+MP3_FRAME = b'\xff\xfb\x90\x00'.ljust(417, b'\x00')
+
+
+def tagged_mp3(path, frames=100, **tags):
+    path.write_bytes(MP3_FRAME * frames)
+    id3 = EasyID3()
+    for key, value in tags.items():
+        id3[key] = value
+    id3.save(str(path))
+    return str(path)
+
+
+@pytest.fixture
+def probes(monkeypatch):
+    """Paths MetadataCache probed, in order"""
+    probed = []
+    probe = MetadataCache.probe
+
+    def counting_probe(file_path):
+        probed.append(file_path)
+        return probe(file_path)
+    monkeypatch.setattr(MetadataCache, 'probe', staticmethod(counting_probe))
+    return probed
+
+
+def test_tags_are_read_once(tmp_path, probes):
+    path = tagged_mp3(tmp_path / 'song.mp3', title='Song', artist='Artist', album='Album', tracknumber='3/12')
+    cache = MetadataCache(str(tmp_path / 'metadata.db'))
+    entry = cache.get(path)
+    assert (entry['title'], entry['artist'], entry['album'], entry['track_number']) == ('Song', 'Artist', 'Album', 3)
+    assert entry['duration'] == pytest.approx(100 * 1152 / 44100, rel=0.05)
+    assert entry['seek_index']['format'] == 'mp3'
+    assert cache.get(path) is entry
+    assert probes == [path]
+    cache.close()
+
+
+def test_entries_are_kept_on_disk(tmp_path, probes):
+    path = tagged_mp3(tmp_path / 'song.mp3', title='Song')
+    db_path = str(tmp_path / 'metadata.db')
+    cache = MetadataCache(db_path)
+    cache.get(path)
+    cache.close()
+
+    cache = MetadataCache(db_path)
+    assert cache.peek(path)['title'] == 'Song'
+    assert cache.get(path)['title'] == 'Song'
+    assert cache.peek_many([path, str(tmp_path / 'other.mp3')]).keys() == {path}
+    assert probes == [path]
+    cache.close()
+
+
+def test_changed_files_are_read_again(tmp_path, probes):
+    path = tagged_mp3(tmp_path / 'song.mp3', title='Old')
+    cache = MetadataCache(str(tmp_path / 'metadata.db'))
+    cache.get(path)
+
+    # Retagged: the size changes, and the modification time is put back
+    stat = os.stat(path)
+    tagged_mp3(tmp_path / 'song.mp3', title='Much longer new title')
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cache.get(path)['title'] == 'Much longer new title'
+
+    # Same size, touched later
+    os.utime(path, (stat.st_atime + 10, stat.st_mtime + 10))
+    cache.get(path)
+    assert probes == [path] * 3
+
+    os.remove(path)
+    assert cache.get(path) is None
+    cache.close()
+
+
+def test_moved_and_deleted_files(tmp_path):
+    cache = MetadataCache(str(tmp_path / 'metadata.db'))
+    entry = {'size': 1, 'mtime': 1.0, 'duration': 60.0, 'title': 'Song'}
+    cache.put_many({'/music/album/a.mp3': dict(entry), '/music/album/b.mp3': dict(entry),
+                    '/music/albums/c.mp3': dict(entry), '/music/single.mp3': dict(entry)})
+
+    cache.rename('/music/album', '/music/renamed', folder=True)
+    cache.rename('/music/single.mp3', '/music/moved.mp3')
+    cache.remove('/music/albums', folder=True)
+    cache.close()
+
+    # Check what reached the database, not just the in-memory entries
+    cache = MetadataCache(str(tmp_path / 'metadata.db'))
+    paths = ['/music/album/a.mp3', '/music/renamed/a.mp3', '/music/renamed/b.mp3', '/music/albums/c.mp3',
+             '/music/single.mp3', '/music/moved.mp3']
+    assert sorted(cache.peek_many(paths)) == ['/music/moved.mp3', '/music/renamed/a.mp3', '/music/renamed/b.mp3']
+    cache.close()
+
+
+def test_unusable_database_keeps_entries_in_memory(tmp_path, capsys):
+    path = tagged_mp3(tmp_path / 'song.mp3', title='Song')
+    (tmp_path / 'metadata.db').mkdir()
+    cache = MetadataCache(str(tmp_path / 'metadata.db'))
+    assert "Could not open metadata cache" in capsys.readouterr().out
+    assert cache.get(path)['title'] == 'Song'
+    assert cache.peek(path)['title'] == 'Song'
+    cache.close()
@@ -0,0 +1,100 @@
+import json
+import sqlite3
+import threading
+import time
+
+from audion import PersistenceService
+
+
+def test_writes_under_a_key_are_coalesced(tmp_path):
+    service = PersistenceService(str(tmp_path / 'settings.json'), delay=60, max_delay=60)
+    written = []
+    for value in range(3):
+        service.schedule('playlist', lambda value=value: written.append(('playlist', value)))
+    service.schedule('queue', lambda: written.append(('queue', 0)))
+    # Scheduling again moves a write after the others
+    service.schedule('playlist', lambda: written.append(('playlist', 3)))
+    assert written == []
+    service.flush()
+    assert written == [('queue', 0), ('playlist', 3)]
+    service.flush()
+    assert len(written) == 2
+    service.close()
+
+
+def test_writes_run_once_changes_stop(tmp_path):
+    service = PersistenceService(str(tmp_path / 'settings.json'), delay=0.05)
+    done = threading.Event()
+    service.schedule('state', done.set)
+    assert done.wait(5)
+    service.close()
+
+
+def test_a_steady_stream_of_changes_is_still_written(tmp_path):
+    service = PersistenceService(str(tmp_path / 'settings.json'), delay=0.2, max_delay=0.3)
+    written = []
+    start = time.monotonic()
+    while time.monotonic() - start < 1.5 and not written:
+        service.schedule('position', lambda: written.append(time.monotonic()))
+        time.sleep(0.02)
+    service.close()
+    assert written and written[0] - start < 1.0
+
+
+def test_flush_waits_for_a_write_in_progress(tmp_path):
+    service = PersistenceService(str(tmp_path / 'settings.json'), delay=0)
+    started = threading.Event()
+    written = []
+
+    def slow_write():
+        started.set()
+        time.sleep(0.2)
+        written.append(True)
+    service.schedule('slow', slow_write)
+    assert started.wait(5)
+    service.flush()
+    assert written == [True]
+    service.close()
+
+
+def test_failed_writes_are_reported(tmp_path, capsys):
+    service = PersistenceService(str(tmp_path / 'settings.json'), delay=60)
+    written = []
+
+    def failing_write():
+        raise sqlite3.OperationalError("database is locked")
+    service.schedule('playlist', failing_write)
+    service.schedule('queue', lambda: written.append(True))
+    service.flush()
+    assert written == [True]
+    assert "Could not save: database is locked" in capsys.readouterr().out
+    service.close()
+
+
+def test_close_writes_what_is_pending(tmp_path):
+    config_path = tmp_path / 'settings.json'
+    service = PersistenceService(str(config_path), delay=60)
+    service.set('volume', 0.5)
+    service.set('volume', 0.7)
+    service.set('shuffle', True)
+    assert not config_path.exists()
+    service.close()
+    assert not service.thread.is_alive()
+    assert json.loads(config_path.read_text()) == {'volume': 0.7, 'shuffle': True}
+    assert not (tmp_path / 'settings.json.tmp').exists()
+
+    service = PersistenceService(str(config_path), delay=60)
+    assert service.get('volume') == 0.7 and service.get('repeat', 'off') == 'off'
+    # Setting a value it already has writes nothing
+    service.set('volume', 0.7)
+    assert not service.pending
+    service.close()
+
+
+def test_unreadable_settings_start_empty(tmp_path, capsys):
+    config_path = tmp_path / 'settings.json'
+    config_path.write_text('{"volume": ')
+    service = PersistenceService(str(config_path))
+    assert service.settings == {}
+    assert "Could not load settings" in capsys.readouterr().out
+    service.close()
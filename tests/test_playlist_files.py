@@ -0,0 +1,123 @@
+import os
+
+from audion import parse_m3u, parse_pls, read_playlist_file, split_playlist_title, write_playlist_file
+
+BASE = os.path.join(os.sep, 'music', 'lists')
+
+
+def test_m3u_entries_and_extinf():
+    lines = [
+        '#EXTM3U',
+        '#EXTINF:215,Artist - Song',
+        'song.mp3',
+        '',
+        '#EXTINF:-1 tvg-id="x",Unknown length',
+        '../albums/other.flac',
+        '# a comment',
+        '/absolute/track.ogg',
+    ]
+    assert list(parse_m3u(lines, BASE)) == [
+        (os.path.join(BASE, 'song.mp3'), 215.0, 'Artist - Song'),
+        (os.path.join(os.sep, 'music', 'albums', 'other.flac'), None, 'Unknown length'),
+        ('/absolute/track.ogg', None, None),
+    ]
+
+
+def test_m3u_urls():
+    lines = [
+        '#EXTINF:30,Radio',
+        'http://example.com/stream.mp3',
+        # The stream's EXTINF doesn't carry over to the next entry
+        'file:///music/My%20Album/01%20Song.mp3',
+    ]
+    assert list(parse_m3u(lines, BASE)) == [('/music/My Album/01 Song.mp3', None, None)]
+
+
+def test_m3u_extinf_that_cannot_be_read():
+    lines = ['#extinf:abc,Title', 'a.mp3', '#EXTINF:', 'b.mp3']
+    assert list(parse_m3u(lines, BASE)) == [
+        (os.path.join(BASE, 'a.mp3'), None, 'Title'),
+        (os.path.join(BASE, 'b.mp3'), None, None),
+    ]
+
+
+def test_pls_entries_in_number_order():
+    lines = [
+        '[playlist]',
+        'Title2=Second',
+        'file2=two.mp3',
+        'File1=one.mp3',
+        'LENGTH1=61',
+        'Title1=First',
+        'Length2=-1',
+        'File3=https://example.com/live',
+        'Title4=No file',
+        'File10=ten.mp3',
+        'NumberOfEntries=10',
+        'Version=2',
+    ]
+    assert list(parse_pls(lines, BASE)) == [
+        (os.path.join(BASE, 'one.mp3'), 61.0, 'First'),
+        (os.path.join(BASE, 'two.mp3'), None, 'Second'),
+        (os.path.join(BASE, 'ten.mp3'), None, None),
+    ]
+
+
+def test_pls_entry_is_yielded_once_a_later_one_starts():
+    entries = parse_pls(iter(['File1=one.mp3', 'File2=two.mp3']), BASE)
+    assert next(entries) == (os.path.join(BASE, 'one.mp3'), None, None)
+
+
+def test_utf8_with_bom(tmp_path):
+    path = tmp_path / 'list.m3u8'
+    path.write_bytes(b'\xef\xbb\xbf#EXTM3U\r\n#EXTINF:10,Caf\xc3\xa9\r\nCaf\xc3\xa9.mp3\r\n')
+    assert list(read_playlist_file(str(path))) == [(str(tmp_path / 'Café.mp3'), 10.0, 'Café')]
+
+
+def test_latin1_names_match_the_file_system(tmp_path):
+    path = tmp_path / 'old.m3u'
+    path.write_bytes(b'Caf\xe9.mp3\n')
+    [(entry, _, _)] = read_playlist_file(str(path))
+    assert entry == os.fsdecode(os.path.join(os.fsencode(str(tmp_path)), b'Caf\xe9.mp3'))
+
+
+def test_pls_file_is_chosen_by_extension(tmp_path):
+    path = tmp_path / 'list.PLS'
+    path.write_bytes(b'[playlist]\nFile1=a.mp3\nLength1=5\n')
+    assert list(read_playlist_file(str(path))) == [(str(tmp_path / 'a.mp3'), 5.0, None)]
+
+
+def test_written_m3u_is_relative_to_its_folder(tmp_path):
+    inside = str(tmp_path / 'album' / 'Song.mp3')
+    outside = os.path.join(os.sep, 'elsewhere', 'caf\udce9.mp3')
+    path = str(tmp_path / 'list.m3u')
+    assert write_playlist_file(path, [(inside, 200.4, 'Artist - Song'), (outside, None, None)]) == 2
+    assert open(path, 'rb').read() == (
+        b'#EXTM3U\n'
+        b'#EXTINF:200,Artist - Song\n' + os.path.join('album', 'Song.mp3').encode() + b'\n'
+        b'#EXTINF:-1,caf\xe9\n/elsewhere/caf\xe9.mp3\n'
+    )
+    assert list(read_playlist_file(path)) == [(inside, 200.0, 'Artist - Song'), (outside, None, 'caf\udce9')]
+    assert not os.path.exists(f"{path}.tmp")
+
+
+def test_written_pls_reads_back(tmp_path):
+    tracks = [(str(tmp_path / 'a.mp3'), 61.0, 'First'), (str(tmp_path / 'sub' / 'b.mp3'), None, None)]
+    path = str(tmp_path / 'list.pls')
+    write_playlist_file(path, tracks)
+    text = open(path, encoding='utf-8').read()
+    assert text.startswith('[playlist]\nFile1=a.mp3\nTitle1=First\nLength1=61\n')
+    assert text.endswith('NumberOfEntries=2\nVersion=2\n')
+    assert list(read_playlist_file(path)) == tracks
+
+
+def test_empty_playlist(tmp_path):
+    path = str(tmp_path / 'empty.pls')
+    assert write_playlist_file(path, []) == 0
+    assert list(read_playlist_file(path)) == []
+
+
+def test_split_playlist_title():
+    assert split_playlist_title('Artist - Song - Live') == ('Artist', 'Song - Live')
+    assert split_playlist_title('Just a title') == (None, 'Just a title')
+    assert split_playlist_title(None) == (None, None)
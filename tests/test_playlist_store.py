@@ -0,0 +1,147 @@
+import json
+import sqlite3
+
+import pytest
+
+from audion import PlaybackEngine, PlaybackListener, PlaylistStore
+
+
+def old_database(path, paths, current_index, shuffle):
+    """A database as saved by the single-playlist versions"""
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("CREATE TABLE playlist (position INTEGER PRIMARY KEY, path TEXT NOT NULL)")
+        conn.execute("CREATE TABLE state (key TEXT PRIMARY KEY, value TEXT)")
+        conn.executemany("INSERT INTO playlist (position, path) VALUES (?, ?)", enumerate(paths))
+        conn.execute("INSERT INTO state VALUES ('current_index', ?)", (json.dumps(current_index),))
+        conn.execute("INSERT INTO state VALUES ('shuffle', ?)", (json.dumps(shuffle),))
+        conn.execute("INSERT INTO state VALUES ('volume', '0.5')")
+    conn.close()
+
+
+def test_single_playlist_is_moved_into_the_library(tmp_path):
+    db_path = str(tmp_path / 'audion.db')
+    shuffle = {'seed': 7, 'epoch': 2, 'cursor': 1}
+    old_database(db_path, ['/music/b.mp3', '/music/a.mp3', '/music/b.mp3'], 2, shuffle)
+
+    store = PlaylistStore(db_path)
+    playlist_id = store.get_active()
+    assert store.list_playlists() == [(playlist_id, PlaylistStore.DEFAULT_NAME, 3)]
+    assert store.load(playlist_id) == (['/music/b.mp3', '/music/a.mp3', '/music/b.mp3'], 2)
+    assert store.get_state(f"shuffle:{playlist_id}") == shuffle
+    assert store.get_state('shuffle') is None
+    assert store.get_state('current_index') is None
+    assert store.get_state('volume') == 0.5
+    store.close()
+
+    # The old table is gone, so opening again changes nothing
+    store = PlaylistStore(db_path)
+    assert store.load(store.get_active()) == (['/music/b.mp3', '/music/a.mp3', '/music/b.mp3'], 2)
+    assert store.conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0] == 2
+    store.close()
+
+
+def test_json_playlist_is_imported_once(tmp_path):
+    json_path = tmp_path / 'playlist.json'
+    json_path.write_text(json.dumps({'playlist': ['/music/x.mp3', '/music/y.mp3'], 'current_index': 1}))
+    db_path = str(tmp_path / 'audion.db')
+
+    store = PlaylistStore(db_path, str(json_path))
+    assert store.load(store.get_active()) == (['/music/x.mp3', '/music/y.mp3'], 1)
+    assert store.get_state('migrated') is True
+    store.replace(store.get_active(), ['/music/z.mp3'], 0)
+    store.close()
+
+    store = PlaylistStore(db_path, str(json_path))
+    assert store.load(store.get_active()) == (['/music/z.mp3'], 0)
+    store.close()
+
+
+def test_unreadable_json_still_starts(tmp_path, capsys):
+    json_path = tmp_path / 'playlist.json'
+    json_path.write_bytes(b'{"playlist": [')
+    store = PlaylistStore(str(tmp_path / 'audion.db'), str(json_path))
+    assert store.load(store.get_active()) == ([], 0)
+    assert store.get_state('migrated') is True
+    assert "Could not import old playlist" in capsys.readouterr().out
+    store.close()
+
+
+def test_playlists_share_tracks(tmp_path):
+    store = PlaylistStore(str(tmp_path / 'audion.db'))
+    library = store.get_active()
+    mix = store.create("Mix", folder='/music')
+    store.replace(library, ['/music/a.mp3', '/music/b.mp3'], 1)
+    store.append(library, ['/music/c.mp3'])
+    store.replace(mix, ['/music/c.mp3', '/music/d.mp3'], 0)
+    store.append(mix, ['/music/a.mp3'])
+    store.replace_queue(['/music/e.mp3', '/music/a.mp3'])
+
+    assert store.load(library) == (['/music/a.mp3', '/music/b.mp3', '/music/c.mp3'], 1)
+    assert store.load(mix) == (['/music/c.mp3', '/music/d.mp3', '/music/a.mp3'], 0)
+    assert store.load_queue() == ['/music/e.mp3', '/music/a.mp3']
+    assert store.find("Mix") == mix and store.find_folder('/music') == mix
+    assert store.get_playlist(mix) == ("Mix", '/music')
+    assert store.conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0] == 5
+
+    # Tracks still in another playlist or the queue are kept
+    store.set_state(f"shuffle:{mix}", {'seed': 1})
+    store.delete(mix)
+    assert store.get_playlist(mix) is None
+    assert store.get_state(f"shuffle:{mix}") is None
+    tracks = {row[0] for row in store.conn.execute("SELECT path FROM tracks")}
+    assert tracks == {'/music/a.mp3', '/music/b.mp3', '/music/c.mp3', '/music/e.mp3'}
+    store.close()
+
+
+def test_active_playlist_falls_back_when_deleted(tmp_path):
+    store = PlaylistStore(str(tmp_path / 'audion.db'))
+    library = store.get_active()
+    other = store.create("Other")
+    store.set_active(other)
+    store.delete(other)
+    assert store.get_active() == library
+    store.delete(library)
+    # With no playlists left, a new default one is made
+    assert store.get_playlist(store.get_active()) == (PlaylistStore.DEFAULT_NAME, None)
+    store.close()
+
+
+@pytest.mark.parametrize('contents', [b'not a database' * 100, None])
+def test_unusable_database_falls_back_to_memory(tmp_path, capsys, contents):
+    db_path = tmp_path / 'audion.db'
+    if contents is None:
+        # Can't be opened at all
+        db_path.mkdir()
+    else:
+        db_path.write_bytes(contents)
+    store = PlaylistStore(str(db_path))
+    assert store.error is not None
+    assert "Could not open playlists" in capsys.readouterr().out
+    playlist_id = store.get_active()
+    store.replace(playlist_id, ['/music/a.mp3'], 0)
+    assert store.load(playlist_id) == (['/music/a.mp3'], 0)
+    store.close()
+    if contents is not None:
+        assert db_path.read_bytes() == contents
+
+
+def test_engine_reports_playlists_kept_in_memory(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    (tmp_path / '.audion_playlist.db').write_bytes(b'not a database' * 100)
+    statuses = []
+
+    class Listener(PlaybackListener):
+        def on_status(self, text, level):
+            statuses.append((text, level))
+
+    engine = PlaybackEngine(Listener())
+    try:
+        engine.analyzer.close()
+        assert engine.load_saved_playlist() is None
+        assert statuses[0][0].startswith("Playlists won't be saved") and statuses[0][1] == 'error'
+        engine.append_tracks(['/music/a.mp3'])
+        engine.persistence.flush()
+        assert engine.playlist_store.load(engine.playlist_id)[0] == ['/music/a.mp3']
+    finally:
+        engine.close()
@@ -0,0 +1,106 @@
+import os
+import random
+
+import pytest
+from mutagen.id3 import ID3, TIT2
+
+from audion import FINGERPRINT_SAMPLE_SIZE, MetadataCache, TrackRelinker, compute_fingerprint, fingerprint_length
+
+
+def audio_file(path, size, seed=0):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    path.write_bytes(random.Random(seed).randbytes(size))
+    return str(path)
+
+
+def relink(paths, cache, search_folders=()):
+    relinker = TrackRelinker(paths, cache, search_folders)
+    relinker.start()
+    relinker.thread.join(5)
+    assert relinker.is_done()
+    return relinker.relinked
+
+
+def test_tags_are_left_out(tmp_path):
+    path = audio_file(tmp_path / 'song.mp3', 5000)
+    fingerprint = compute_fingerprint(path)
+    assert fingerprint_length(fingerprint) == 5000
+
+    tags = ID3()
+    tags.add(TIT2(encoding=3, text='A title long enough to change the size'))
+    tags.save(path)
+    with open(path, 'ab') as f:
+        f.write(b'TAG'.ljust(128, b'\0'))
+    assert os.path.getsize(path) > 5000 + 128
+    assert compute_fingerprint(path) == fingerprint
+
+
+def test_flac_metadata_is_left_out(tmp_path):
+    audio = random.Random(1).randbytes(3000)
+    first = tmp_path / 'first.flac'
+    second = tmp_path / 'second.flac'
+    # A STREAMINFO block, then a last block of padding
+    first.write_bytes(b'fLaC' + b'\x00\x00\x00\x22' + bytes(34) + b'\x81\x00\x00\x04' + bytes(4) + audio)
+    second.write_bytes(b'fLaC' + b'\x00\x00\x00\x22' + bytes(34) + b'\x81\x00\x01\x00' + bytes(256) + audio)
+    assert compute_fingerprint(str(first)) == compute_fingerprint(str(second))
+    assert fingerprint_length(compute_fingerprint(str(first))) == 3000
+
+
+def test_large_files_are_sampled(tmp_path):
+    size = 10 * FINGERPRINT_SAMPLE_SIZE
+    path = audio_file(tmp_path / 'long.mp3', size)
+    fingerprint = compute_fingerprint(path)
+
+    def changed_at(offset):
+        with open(path, 'r+b') as f:
+            f.seek(offset)
+            byte = f.read(1)
+            f.seek(offset)
+            f.write(bytes([byte[0] ^ 0xff]))
+        return compute_fingerprint(path) != fingerprint
+
+    # Only the start, middle and end are read
+    assert not changed_at(2 * FINGERPRINT_SAMPLE_SIZE)
+    assert changed_at(size // 2)
+    assert changed_at(size - 1)
+
+
+def test_moved_tracks_are_found_by_fingerprint(tmp_path):
+    cache = MetadataCache(str(tmp_path / 'metadata.db'))
+    album = tmp_path / 'music' / 'Album'
+    moved = audio_file(album / 'Disc 1' / '01.mp3', 4000, seed=1)
+    copy = audio_file(album / 'Disc 2' / '01 copy.mp3', 4000, seed=1)
+    renamed = audio_file(album / '02 renamed.mp3', 4000, seed=2)
+    elsewhere = audio_file(tmp_path / 'backup' / '03.mp3', 4000, seed=3)
+    # Same size and extension, different audio
+    audio_file(album / 'decoy.mp3', 4000, seed=4)
+
+    missing = [str(album / name) for name in ('01.mp3', '01 again.mp3', '02.mp3', '03.mp3', '04.mp3')]
+    fingerprints = [compute_fingerprint(path) for path in (moved, moved, renamed, elsewhere)]
+    cache.put_many({path: {'size': 4000, 'mtime': 0.0, 'fingerprint': fingerprint}
+                    for path, fingerprint in zip(missing, fingerprints)})
+    cache.put_many({missing[4]: {'size': 4000, 'mtime': 0.0}})
+
+    relinked = relink(missing, cache)
+    assert relinked.keys() == set(missing[:3])
+    # Two missing copies of the same audio are given different files
+    assert {relinked[missing[0]], relinked[missing[1]]} == {moved, copy}
+    assert relinked[missing[2]] == renamed
+
+    relinked = relink(missing, cache, [str(tmp_path / 'backup')])
+    assert relinked[missing[3]] == elsewhere and missing[4] not in relinked
+    cache.close()
+
+
+def test_cached_fingerprints_are_checked_first(tmp_path, monkeypatch):
+    cache = MetadataCache(str(tmp_path / 'metadata.db'))
+    new_path = audio_file(tmp_path / 'music' / 'new.mp3', 4000)
+    old_path = str(tmp_path / 'music' / 'old.mp3')
+    fingerprint = compute_fingerprint(new_path)
+    cache.put_many({path: {'size': 4000, 'mtime': 0.0, 'fingerprint': fingerprint} for path in (old_path, new_path)})
+
+    def no_hashing(file_path):
+        pytest.fail(f"{file_path} was hashed")
+    monkeypatch.setattr('audion.compute_fingerprint', no_hashing)
+    assert relink([old_path], cache) == {old_path: new_path}
+    cache.close()
@@ -0,0 +1,115 @@
+import os
+
+from audion import SearchIndex, SearchIndexer, TrackList, TrackTable
+
+
+def song(artist, album, name):
+    return os.path.join(os.sep, 'music', artist, album, f"{name}.mp3")
+
+
+BEATLES = song('The Beatles', 'Abbey Road', '01 Come Together')
+SOMETHING = song('The Beatles', 'Abbey Road', '02 Something')
+HEY_JUDE = song('The Beatles', 'Singles', 'Hey Jude')
+MILES = song('Miles Davis', 'Kind of Blue', '01 So What')
+
+
+def build(paths, get_tags=None):
+    table = TrackTable()
+    playlist = TrackList(table, paths)
+    index = SearchIndex(table)
+    index.add(playlist, get_tags)
+    return index, playlist
+
+
+def rows(matches):
+    return [matches[row] for row in range(len(matches))]
+
+
+def test_terms_match_word_prefixes_in_every_field():
+    index, playlist = build([BEATLES, SOMETHING, HEY_JUDE, MILES])
+    assert rows(index.search('beat', playlist)) == [0, 1, 2]
+    assert rows(index.search('ABBEY road', playlist)) == [0, 1]
+    assert rows(index.search('road beatles som', playlist)) == [1]
+    assert rows(index.search('blue', playlist)) == [3]
+    assert rows(index.search('eatles', playlist)) == []
+    assert index.search('  -- ', playlist) is None
+
+
+def test_tags_are_searched():
+    tags = {MILES: {'title': 'So What', 'artist': 'Miles Davis', 'album': 'Kind of Blue (Legacy)'}}
+    index, playlist = build([BEATLES, MILES], lambda paths: {path: tags[path] for path in paths if path in tags})
+    assert rows(index.search('legacy', playlist)) == [1]
+    assert index.indexed[playlist.ids[1]] == SearchIndex.TAGGED
+    assert index.indexed[playlist.ids[0]] == SearchIndex.INDEXED
+
+    index.update_tags(BEATLES, {'title': 'Come Together', 'artist': 'The Beatles', 'album': 'Remastered'})
+    assert rows(index.search('remaster', playlist)) == [0]
+    # Tags are only added once
+    index.update_tags(BEATLES, {'title': 'Other', 'album': 'Other'})
+    assert rows(index.search('other', playlist)) == []
+
+
+def test_positions_follow_the_playlist_order():
+    index, playlist = build([BEATLES, SOMETHING, HEY_JUDE, MILES])
+    assert rows(index.search('beatles', playlist)) == [0, 1, 2]
+
+    playlist.sort()
+    index.invalidate_positions()
+    assert list(playlist) == [MILES, BEATLES, SOMETHING, HEY_JUDE]
+    assert rows(index.search('beatles', playlist)) == [1, 2, 3]
+
+    # Tracks no longer in the playlist stay indexed but don't match
+    playlist.remove_indexes({1})
+    index.invalidate_positions()
+    matches = index.search('beatles', playlist)
+    assert len(matches) == 2 and rows(matches) == [1, 2]
+    assert matches.row_of(2) == 1 and matches.row_of(0) == -1
+
+
+def test_copies_of_a_track_each_get_a_row():
+    paths = [MILES, BEATLES, HEY_JUDE, BEATLES, MILES, BEATLES]
+    index, playlist = build(paths)
+    assert rows(index.search('together', playlist)) == [1, 3, 5]
+    assert rows(index.search('what', playlist)) == [0, 4]
+    # Few matches in a long playlist take the sorted positions path
+    playlist.extend([song('Other', 'Album', f"{number:03}") for number in range(100)])
+    index.add(playlist)
+    index.invalidate_positions()
+    assert rows(index.search('together', playlist)) == [1, 3, 5]
+
+
+def test_new_tracks_are_taken_once():
+    table = TrackTable()
+    playlist = TrackList(table, [BEATLES, SOMETHING, BEATLES])
+    index = SearchIndex(table)
+    new_ids = index.take_new_ids(playlist)
+    assert new_ids == [playlist.ids[0], playlist.ids[1]]
+    assert index.take_new_ids(playlist) == []
+
+    # Tags read while the batch is queued are applied when it is merged
+    index.update_tags(SOMETHING, {'title': 'Something', 'album': 'Anthology'})
+    index.merge(SearchIndex.build_postings(table, new_ids))
+    index.prepare(playlist)
+    assert rows(index.search('anthology', playlist)) == [1]
+    assert rows(index.search('abbey', playlist)) == [0, 1, 2]
+
+
+def test_indexer_builds_batches_in_the_background():
+    table = TrackTable()
+    paths = [song('Artist', f"Album {number // 10}", f"{number:03} Track") for number in range(25)]
+    playlist = TrackList(table, paths)
+    index = SearchIndex(table)
+    indexer = SearchIndexer(table, batch_size=10)
+    try:
+        indexer.submit(index.take_new_ids(playlist))
+        assert not indexer.is_done()
+        batches = []
+        while not indexer.is_done():
+            batches.extend(indexer.get_batches())
+        assert [len(batch[0]) for batch in batches] == [10, 10, 5]
+        for batch in batches:
+            index.merge(batch)
+    finally:
+        indexer.close()
+    assert rows(index.search('album 2', playlist)) == list(range(20, 25))
+    assert len(index.search('artist', playlist)) == 25
@@ -0,0 +1,217 @@
+import io
+
+import audion
+from audion import build_seek_index, find_audio_range, open_at_time, parse_mp3_frame_header
+
+# MPEG-1 Layer III, 128 kbit/s, 44.1 kHz, joint stereo, no CRC: 417 byte frames
+MPEG1_HEADER = b'\xff\xfb\x90\x00'
+MPEG1_FRAME_LENGTH = 417
+# MPEG-2 Layer III, 64 kbit/s, 22.05 kHz, mono: 208 byte frames
+MPEG2_MONO_HEADER = b'\xff\xf3\x80\xc0'
+MPEG2_FRAME_LENGTH = 208
+
+
+def id3v2_tag(body_size):
+    """An empty ID3v2.4 tag with a body of body_size bytes, its size written syncsafe"""
+    size = bytes((body_size >> shift) & 0x7F for shift in (21, 14, 7, 0))
+    return b'ID3\x04\x00\x00' + size + bytes(body_size)
+
+
+def mp3_frame(header=MPEG1_HEADER, length=MPEG1_FRAME_LENGTH, body=b''):
+    return (header + body).ljust(length, b'\x00')
+
+
+def xing_frame(tag=b'Xing', flags=0x7, frames=100, audio_size=None, toc=None,
+               header=MPEG1_HEADER, length=MPEG1_FRAME_LENGTH, side_info=32):
+    """A first frame holding a Xing/Info header after the side information"""
+    body = bytes(side_info) + tag + flags.to_bytes(4, 'big')
+    if flags & 1:
+        body += frames.to_bytes(4, 'big')
+    if flags & 2:
+        body += audio_size.to_bytes(4, 'big')
+    if flags & 4:
+        body += bytes(toc)
+    return mp3_frame(header, length, body)
+
+
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_frame_header_fields():
+    frame = parse_mp3_frame_header(MPEG1_HEADER)
+    assert frame == {'mpeg1': True, 'mono': False, 'bitrate': 128000, 'length': MPEG1_FRAME_LENGTH}
+    frame = parse_mp3_frame_header(MPEG2_MONO_HEADER)
+    assert frame == {'mpeg1': False, 'mono': True, 'bitrate': 64000, 'length': MPEG2_FRAME_LENGTH}
+    # Padding adds a byte
+    assert parse_mp3_frame_header(b'\xff\xfb\x92\x00')['length'] == MPEG1_FRAME_LENGTH + 1
+
+
+def test_frame_header_rejects_other_data():
+    assert parse_mp3_frame_header(b'ID3\x04') is None
+    # Layer II, free bitrate, reserved sample rate
+    assert parse_mp3_frame_header(b'\xff\xfd\x90\x00') is None
+    assert parse_mp3_frame_header(b'\xff\xfb\x00\x00') is None
+    assert parse_mp3_frame_header(b'\xff\xfb\x9c\x00') is None
+    assert parse_mp3_frame_header(b'\xff\xfb') is None
+
+
+def test_xing_toc_after_id3_tag(tmp_path):
+    toc = [round(i * 2.55) for i in range(100)]
+    frames = [mp3_frame() for _ in range(20)]
+    audio_size = MPEG1_FRAME_LENGTH * 21
+    tag = id3v2_tag(100)
+    path = write(tmp_path, 'vbr.mp3', tag + xing_frame(audio_size=audio_size, toc=toc) + b''.join(frames))
+
+    index = build_seek_index(path)
+    assert index == {
+        'format': 'mp3',
+        'frame_start': len(tag),
+        'audio_start': len(tag) + MPEG1_FRAME_LENGTH,
+        'audio_size': audio_size,
+        'toc': toc,
+    }
+
+
+def test_xing_without_byte_count_uses_the_file_size(tmp_path):
+    toc = list(range(0, 200, 2))
+    path = write(tmp_path, 'vbr.mp3', xing_frame(flags=0x5, toc=toc) + mp3_frame() * 9)
+    index = build_seek_index(path)
+    assert index['audio_size'] == MPEG1_FRAME_LENGTH * 10
+    assert index['toc'] == toc
+
+
+def test_info_header_means_constant_bitrate(tmp_path):
+    path = write(tmp_path, 'cbr.mp3', xing_frame(tag=b'Info', flags=0x3, audio_size=4170) + mp3_frame() * 9)
+    assert build_seek_index(path) == {
+        'format': 'mp3', 'frame_start': 0, 'audio_start': MPEG1_FRAME_LENGTH, 'bitrate': 128000,
+    }
+
+
+def test_xing_without_toc_gives_no_index(tmp_path):
+    path = write(tmp_path, 'vbr.mp3', xing_frame(flags=0x3, audio_size=4170) + mp3_frame() * 9)
+    assert build_seek_index(path) == {}
+
+
+def test_no_header_is_treated_as_constant_bitrate(tmp_path):
+    # Junk before the first frame is skipped
+    path = write(tmp_path, 'plain.mp3', b'\x00\xff\x00' + mp3_frame() * 10)
+    assert build_seek_index(path) == {'format': 'mp3', 'audio_start': 3, 'bitrate': 128000}
+
+
+def test_mpeg2_mono_header_position(tmp_path):
+    toc = list(range(100))
+    first = xing_frame(audio_size=MPEG2_FRAME_LENGTH * 5, toc=toc, header=MPEG2_MONO_HEADER,
+                       length=MPEG2_FRAME_LENGTH, side_info=9)
+    path = write(tmp_path, 'mono.mp3', first + mp3_frame(MPEG2_MONO_HEADER, MPEG2_FRAME_LENGTH) * 4)
+    index = build_seek_index(path)
+    assert index['toc'] == toc
+    assert index['audio_start'] == MPEG2_FRAME_LENGTH
+
+
+def test_not_an_mp3(tmp_path):
+    assert build_seek_index(write(tmp_path, 'noise.mp3', bytes(range(256)) * 4)) == {}
+    assert build_seek_index(write(tmp_path, 'song.ogg', b'OggS' + bytes(100))) == {}
+    assert build_seek_index(str(tmp_path / 'missing.mp3')) == {}
+
+
+def test_mp3_toc_seek_starts_on_a_frame(tmp_path):
+    toc = [round(i * 2.56) for i in range(100)]
+    frames = b''.join(mp3_frame(body=bytes([n]) * 8) for n in range(1, 40))
+    data = xing_frame(audio_size=MPEG1_FRAME_LENGTH * 40, toc=toc) + frames
+    index = build_seek_index(write(tmp_path, 'vbr.mp3', data))
+
+    stream, start = open_at_time(io.BytesIO(data), index, 5.0, 10.0)
+    assert start == 5.0
+    head = stream.read(12)
+    assert head[:4] == MPEG1_HEADER
+    # Half way through the duration is half way through the audio, rounded up to a frame
+    frame_number = head[4]
+    assert frame_number == 20
+
+
+def test_mp3_constant_bitrate_seek(tmp_path):
+    frames = b''.join(mp3_frame(body=bytes([n]) * 8) for n in range(1, 40))
+    index = build_seek_index(write(tmp_path, 'cbr.mp3', frames))
+    # 128 kbit/s is 16000 bytes a second, so half a second in is byte 8000, inside
+    # the 20th frame; the stream starts on the frame after it
+    stream, start = open_at_time(io.BytesIO(frames), index, 0.5, 0)
+    assert start == 0.5
+    assert stream.read(5) == MPEG1_HEADER + bytes([21])
+
+
+def streaminfo(sample_rate=44100, channels=2, bits=16, samples=441000):
+    """A 34 byte STREAMINFO block body"""
+    fields = (sample_rate << 44) | ((channels - 1) << 41) | ((bits - 1) << 36) | samples
+    return (4096).to_bytes(2, 'big') * 2 + bytes(6) + fields.to_bytes(8, 'big') + bytes(range(16))
+
+
+def metadata_block(block_type, body, last=False):
+    return bytes([block_type | (0x80 if last else 0)]) + len(body).to_bytes(3, 'big') + body
+
+
+def seek_point(sample, offset, frame_samples=4096):
+    return sample.to_bytes(8, 'big') + offset.to_bytes(8, 'big') + frame_samples.to_bytes(2, 'big')
+
+
+def flac_file(points, audio=b''):
+    seektable = b''.join(seek_point(*point) for point in points)
+    # A placeholder point, then an unrelated block that is skipped
+    seektable += b'\xff' * 8 + bytes(10)
+    return (b'fLaC' + metadata_block(0, streaminfo()) + metadata_block(3, seektable)
+            + metadata_block(4, b'vorbis comment') + metadata_block(1, bytes(20), last=True) + audio)
+
+
+def test_flac_seektable(tmp_path):
+    points = [(88200, 5000), (0, 0), (44100, 2500)]
+    data = flac_file(points, audio=bytes(6000))
+    index = build_seek_index(write(tmp_path, 'song.flac', data))
+    assert index == {
+        'format': 'flac',
+        'audio_start': len(data) - 6000,
+        'sample_rate': 44100,
+        'streaminfo': streaminfo().hex(),
+        'points': [[0, 0], [44100, 2500], [88200, 5000]],
+    }
+
+
+def test_flac_without_seektable(tmp_path):
+    data = b'fLaC' + metadata_block(0, streaminfo(), last=True) + bytes(100)
+    assert build_seek_index(write(tmp_path, 'song.flac', data)) == {}
+    assert build_seek_index(write(tmp_path, 'fake.flac', b'RIFF' + bytes(100))) == {}
+    # Cut off in the middle of the metadata
+    assert build_seek_index(write(tmp_path, 'cut.flac', flac_file([(0, 0)])[:50])) == {}
+
+
+def test_flac_seek_splices_streaminfo_onto_the_seek_point(tmp_path):
+    audio = bytes(range(256)) * 40
+    data = flac_file([(0, 0), (44100, 2500), (88200, 5000)], audio)
+    index = build_seek_index(write(tmp_path, 'song.flac', data))
+
+    stream, start = open_at_time(io.BytesIO(data), index, 1.5, 10.0)
+    assert start == 1.0
+    header = stream.read(4 + 4 + 34)
+    assert header[:4] == b'fLaC'
+    # STREAMINFO is now the last and only metadata block
+    assert header[4:8] == b'\x80\x00\x00\x22'
+    info = header[8:]
+    assert info[:13] == streaminfo()[:13]
+    # Total samples and MD5 are unknown for the spliced stream
+    assert info[13] & 0x0F == 0 and info[14:18] == bytes(4) and info[18:] == bytes(16)
+    assert stream.read(16) == audio[2500:2516]
+
+
+def test_flac_seek_too_far_from_a_point_is_left_to_the_decoder(tmp_path):
+    data = flac_file([(0, 0), (44100, 2500)], bytes(6000))
+    index = build_seek_index(write(tmp_path, 'song.flac', data))
+    assert open_at_time(io.BytesIO(data), index, 1.0 + audion.SEEK_INDEX_MAX_GAP + 0.5, 10.0) is None
+
+
+def test_audio_range_leaves_out_tags():
+    tag = id3v2_tag(50)
+    data = tag + mp3_frame() * 3 + b'TAG' + bytes(125)
+    assert find_audio_range(io.BytesIO(data), len(data)) == (len(tag), len(data) - 128)
+    flac = flac_file([(0, 0)], bytes(300))
+    assert find_audio_range(io.BytesIO(flac), len(flac)) == (len(flac) - 300, len(flac))
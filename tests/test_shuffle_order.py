@@ -0,0 +1,142 @@
+from audion import ShuffleOrder
+
+
+def play(order, count, current=-1):
+    """Advance count times, as play_next does, returning the tracks played"""
+    played = []
+    for _ in range(count):
+        current = order.advance(current)
+        played.append(current)
+    return played
+
+
+def test_each_pass_plays_every_track_once():
+    order = ShuffleOrder(50, seed=7)
+    first = play(order, 50)
+    assert sorted(first) == list(range(50))
+    assert order.epoch == 0
+    second = play(order, 49, first[-1])
+    assert order.epoch == 1
+    # The last track of a pass isn't replayed straight away
+    assert second[0] != first[-1]
+    assert len(set(second)) == len(second)
+
+
+def test_order_depends_only_on_seed():
+    assert play(ShuffleOrder(30, seed=1), 30) == play(ShuffleOrder(30, seed=1), 30)
+    assert play(ShuffleOrder(30, seed=1), 30) != play(ShuffleOrder(30, seed=2), 30)
+
+
+def test_restored_state_continues_the_same_order():
+    order = ShuffleOrder(20, seed=3)
+    played = play(order, 25)
+    restored = ShuffleOrder(**order.get_state())
+    assert play(restored, 10, played[-1]) == play(order, 10, played[-1])
+
+
+def test_peek_does_not_move_the_cursor():
+    order = ShuffleOrder(10, seed=4)
+    current = order.advance(-1)
+    upcoming = order.peek(3, current)
+    assert play(order, 3, current) == upcoming
+
+
+def test_peek_skips_the_current_track_after_a_reshuffle():
+    order = ShuffleOrder(5, seed=5)
+    played = play(order, 5)
+    assert played[-1] not in order.peek(4, played[-1])
+
+
+def test_retreat_walks_back_through_history_across_passes():
+    order = ShuffleOrder(4, seed=6)
+    played = play(order, 7)
+    current = played[-1]
+    history = []
+    while True:
+        current = order.retreat(current)
+        if current is None:
+            break
+        history.append(current)
+    # Only the track skipped as a repeat after the reshuffle can be missing
+    assert history[:3] == played[-2::-1][:3]
+    assert history[-1] == played[0]
+
+
+def test_retreat_after_a_jump_returns_to_the_track_before_it():
+    order = ShuffleOrder(10, seed=8)
+    played = play(order, 3)
+    jumped_to = next(index for index in range(10) if index not in played)
+    assert order.retreat(jumped_to) == played[-1]
+
+
+def test_extend_keeps_the_tracks_played_and_coming_up():
+    order = ShuffleOrder(10, seed=9)
+    played = play(order, 4)
+    upcoming = order.peek(3, played[-1])
+    order.extend(25)
+    assert list(order.order[:4]) == played
+    assert order.peek(3, played[-1]) == upcoming
+    assert sorted(order.order) == list(range(25))
+    rest = play(order, 21, played[-1])
+    assert sorted(played + rest) == list(range(25))
+
+
+def test_extended_order_is_rebuilt_from_its_state():
+    order = ShuffleOrder(10, seed=10)
+    play(order, 2)
+    order.extend(15)
+    play(order, 3)
+    order.extend(40)
+    restored = ShuffleOrder(**order.get_state())
+    assert list(restored.order) == list(order.order)
+    assert restored.cursor == order.cursor
+
+
+def test_next_pass_shuffles_the_whole_extended_playlist():
+    order = ShuffleOrder(5, seed=11)
+    play(order, 1)
+    order.extend(8)
+    current = play(order, 7)[-1]
+    assert order.epoch == 0
+    order.advance(current)
+    assert order.epoch == 1
+    assert order.base_size == 8
+    assert order.growth == []
+    assert sorted(order.order) == list(range(8))
+
+
+def test_state_saved_before_growth_was_recorded_still_loads():
+    state = {'size': 12, 'seed': 12, 'epoch': 0, 'cursor': 3}
+    assert list(ShuffleOrder(**state).order) == list(ShuffleOrder(12, seed=12).order)
+
+
+def play_next(engine):
+    """Move to the next track the way play_next does, without any audio"""
+    engine.set_current_track(engine.consume_next_index())
+    return engine.current_file
+
+
+def test_sorting_starts_a_new_order(engine, tmp_path):
+    paths = []
+    for letter in 'tsrqponmlkjihgfedcba':
+        path = tmp_path / f"{letter}.mp3"
+        path.write_bytes(b'')
+        paths.append(str(path))
+    engine.set_playlist(paths)
+    engine.set_current_track(0)
+    engine.shuffle_mode = True
+    for _ in range(5):
+        play_next(engine)
+
+    current = engine.current_file
+    engine.sort_playlist()
+    assert engine.playlist[engine.current_index] == current
+    engine.persistence.flush()
+    assert engine.playlist_store.get_state(f"shuffle:{engine.playlist_id}") == engine.shuffle_order.get_state()
+    played = [play_next(engine) for _ in range(19)]
+    # The old order's positions would now point at other tracks, repeating some
+    assert len(set(played)) == len(played)
+
+    order = engine.get_shuffle_order()
+    back = [order.retreat(engine.playlist.index(path)) for path in reversed(played)]
+    assert [engine.playlist[index] for index in back[:-1]] == played[-2::-1]
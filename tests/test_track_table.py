@@ -0,0 +1,115 @@
+import os
+from array import array
+
+import pytest
+
+from audion import TrackList, TrackTable
+
+
+def library_paths(count):
+    return [os.path.join(os.sep, 'music', f"artist {index // 100}", f"album {index // 10}", f"{index:05} track.mp3")
+            for index in range(count)]
+
+
+def test_ids_are_stable_and_paths_come_back_unchanged():
+    table = TrackTable()
+    paths = library_paths(5000)
+    ids = [table.intern(path) for path in paths]
+    assert ids == list(range(5000))
+    # Interning again finds the same track, after the index has grown several times
+    assert [table.intern(path) for path in reversed(paths)] == ids[::-1]
+    assert [table.get_path(track_id) for track_id in ids] == paths
+    assert [table.find(path) for path in paths] == ids
+    assert len(table) == 5000
+
+
+def test_folders_are_stored_once():
+    table = TrackTable()
+    for path in library_paths(1000):
+        table.intern(path)
+    assert len(table.folders) == 100
+    assert table.get_name(table.find(library_paths(1)[0])) == '00000 track.mp3'
+
+
+def test_lookups_survive_a_crowded_index():
+    table = TrackTable()
+    # Start from the smallest index, so nearly every insert probes past a collision
+    table.slots = array('l', [TrackTable.EMPTY]) * 2
+    paths = library_paths(300) + ['relative.mp3', os.path.join(os.sep, 'music', 'same name.mp3'),
+                                  os.path.join(os.sep, 'other', 'same name.mp3')]
+    ids = [table.intern(path) for path in paths]
+    assert len(set(ids)) == len(paths)
+    assert [table.find(path) for path in paths] == ids
+    assert len(table.slots) >= 2 * len(paths)
+
+
+def test_unknown_paths():
+    table = TrackTable()
+    table.intern(os.path.join(os.sep, 'music', 'a.mp3'))
+    assert table.find(os.path.join(os.sep, 'music', 'b.mp3')) is None
+    assert table.find(os.path.join(os.sep, 'elsewhere', 'a.mp3')) is None
+    assert table.find(None) is None
+
+
+def test_names_that_are_not_valid_utf8():
+    table = TrackTable()
+    # How Python decodes a Latin-1 file name on a UTF-8 system
+    path = os.path.join(os.sep, 'music', 'caf\udce9.mp3')
+    accented = os.path.join(os.sep, 'music', 'café ☕.mp3')
+    assert table.get_path(table.intern(path)) == path
+    assert table.get_path(table.intern(accented)) == accented
+    assert table.find(path) != table.find(accented)
+
+
+def test_split_keeps_the_separator_on_the_folder():
+    path = os.path.join(os.sep, 'music', 'album', 'track.mp3')
+    folder, name = TrackTable.split(path)
+    assert folder == os.path.join(os.sep, 'music', 'album', '')
+    assert name == 'track.mp3'
+    assert TrackTable.split('track.mp3') == ('', 'track.mp3')
+
+
+def test_track_list_reads_and_writes_like_a_list():
+    table = TrackTable()
+    paths = library_paths(20)
+    tracks = TrackList(table, paths)
+    assert len(tracks) == 20
+    assert list(tracks) == paths
+    assert tracks[3] == paths[3]
+    assert tracks.get_name(3) == os.path.basename(paths[3])
+    assert paths[5] in tracks and 'missing.mp3' not in tracks and None not in tracks
+    assert tracks.index(paths[7]) == 7
+    with pytest.raises(ValueError):
+        tracks.index('missing.mp3')
+
+    tracks[0] = 'moved.mp3'
+    assert tracks[0] == 'moved.mp3' and paths[0] not in tracks
+    tracks.extend(['new.mp3', paths[1]])
+    assert len(tracks) == 22 and tracks[21] == paths[1]
+
+
+def test_track_list_sorts_and_removes_by_index():
+    table = TrackTable()
+    tracks = TrackList(table, ['c.mp3', 'a.mp3', 'b.mp3', 'a.mp3'])
+    tracks.sort()
+    assert list(tracks) == ['a.mp3', 'a.mp3', 'b.mp3', 'c.mp3']
+    tracks.remove_indexes({0, 3})
+    assert list(tracks) == ['a.mp3', 'b.mp3']
+
+
+def test_track_lists_share_one_table():
+    table = TrackTable()
+    first = TrackList(table, library_paths(10))
+    second = TrackList(table, library_paths(20))
+    assert len(table) == 20
+    assert list(second.ids[:10]) == list(first.ids)
+
+
+def test_copy_is_a_snapshot():
+    table = TrackTable()
+    tracks = TrackList(table, ['a.mp3', 'b.mp3'])
+    snapshot = tracks.copy()
+    tracks.extend(['c.mp3'])
+    tracks[0] = 'z.mp3'
+    assert list(snapshot) == ['a.mp3', 'b.mp3']
+    assert snapshot.table is table